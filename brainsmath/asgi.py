@@ -14,3 +14,6 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'brainsmath.settings')
 
 application = get_asgi_application()
+
+from core import ranking
+ranking.warm()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
+import os
 import dotenv
 from datetime import timedelta
 dotenv.load_dotenv()
@@ -43,15 +44,17 @@ INSTALLED_APPS = [
     'rest_framework_simplejwt',
     "rest_framework",
     'corsheaders',
-    'silk',
     'core'
 ]
 
 MIDDLEWARE = [
+    "core.metrics.MetricsMiddleware",
+    "core.throttling.AdmissionMiddleware",
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
-    "silk.middleware.SilkyMiddleware",
+    "core.routing.ReplicaRoutingMiddleware",
+    "core.profiling.SampledProfilingMiddleware",
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -59,6 +62,15 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# The project middleware above is sync and async capable, so ASGI requests stay on the event
+# loop. Silk records every request and query to the database and is sync only (under ASGI
+# every request then runs in a thread); only turn it on for local debugging. Its app and
+# its /silk/ UI are installed only then too.
+SILK_ENABLED = os.getenv("SILK_ENABLED") == "1"
+if SILK_ENABLED:
+    INSTALLED_APPS.insert(INSTALLED_APPS.index("core"), "silk")
+    MIDDLEWARE.insert(MIDDLEWARE.index("core.profiling.SampledProfilingMiddleware"), "silk.middleware.SilkyMiddleware")
+
 ROOT_URLCONF = 'brainsmath.urls'
 
 TEMPLATES = [
@@ -93,6 +105,40 @@ DATABASES = {
     'default': dj_database_url.config(default=os.getenv('DATABASE_URL'), conn_max_age=600)
 }
 
+# Django's default cache lives in each worker process. SHARED_CACHE_DIR adds a "shared"
+# alias, a file cache every worker on the host reads, for state they must agree on
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+}
+if os.getenv("SHARED_CACHE_DIR"):
+    CACHES["shared"] = {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("SHARED_CACHE_DIR"),
+    }
+
+# optional read replica (see core/routing.py): reads of GET requests go to it, except
+# for clients that wrote in the last STICKY_SECONDS; that memory lives in CACHE_ALIAS,
+# which must be shared by the workers (startup fails otherwise), e.g. set SHARED_CACHE_DIR
+if os.getenv('REPLICA_DATABASE_URL'):
+    DATABASES['replica'] = dj_database_url.config(env='REPLICA_DATABASE_URL', conn_max_age=600)
+    DATABASE_ROUTERS = ['core.routing.ReplicaRouter']
+
+# pragmas run on every new SQLite connection (see core/sqlite.py); None or "" keeps
+# the default. Ignored on other databases.
+SQLITE = {
+    "JOURNAL_MODE": os.getenv("SQLITE_JOURNAL_MODE", "wal"),
+    "SYNCHRONOUS": os.getenv("SQLITE_SYNCHRONOUS", "normal"),
+    "BUSY_TIMEOUT": os.getenv("SQLITE_BUSY_TIMEOUT", "5000"),  # ms to wait for a lock
+    "CACHE_SIZE": os.getenv("SQLITE_CACHE_SIZE", "-20000"),  # pages, or KiB when negative
+    "TRANSACTION_MODE": os.getenv("SQLITE_TRANSACTION_MODE", "IMMEDIATE"),
+}
+
+DATABASE_REPLICA = {
+    "ALIAS": "replica",
+    "STICKY_SECONDS": float(os.getenv("REPLICA_STICKY_SECONDS", "5")),
+    "CACHE_ALIAS": os.getenv("REPLICA_CACHE_ALIAS", "shared" if "shared" in CACHES else "default"),
+}
+
 
 
 
@@ -141,11 +187,112 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'core.authentication.CachedJWTAuthentication',
+    ),
+    # reverse proxies in front of the app; the client address is the one the
+    # outermost of them appended to X-Forwarded-For, or REMOTE_ADDR with 0.
+    # Left unset DRF would trust whatever X-Forwarded-For the client sends, and
+    # too low a count makes every client share the proxy's address and so one
+    # register/login/submit_ip throttle bucket. The production hosts above sit
+    # behind Railway's edge proxy, which appends the client address: one proxy
+    # wherever Railway sets RAILWAY_ENVIRONMENT_NAME, none elsewhere.
+    'NUM_PROXIES': int(os.getenv("NUM_PROXIES", "1" if os.getenv("RAILWAY_ENVIRONMENT_NAME") else "0")),
+}
+
+# per-process cache of authenticated users (see core/authentication.py); entries
+# live at most TTL seconds, TTL 0 looks the user up on every request
+AUTH_USER_CACHE = {
+    "TTL": int(os.getenv("AUTH_USER_CACHE_TTL", "60")),
+    "MAX_SIZE": 10000,
 }
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=120),  # You can set it to hours/days/etc.
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),
 }
+
+# per-worker order-statistic index used by /userrank/ (see core/ranking.py)
+RANKING_INDEX = {
+    "ENABLED": True,
+    "MAX_AGE": 3600,  # seconds before the index is fully reloaded
+    "CATCH_UP_LIMIT": 1000,  # changed rows applied incrementally before falling back to a full reload
+}
+
+# versioned cache for leaderboard and rank responses (see core/cache.py); any
+# Django cache backend works, point ALIAS at a shared one to share across workers
+RESPONSE_CACHE = {
+    "ENABLED": True,
+    "ALIAS": "default",
+    "TIMEOUT": 300,
+}
+
+# largest number of results accepted by POST /test/batch/
+TEST_BATCH_MAX_SIZE = 100
+
+# optional write-behind mode for POST /test/ (see core/ingest.py): submissions are
+# answered with 202 and bulk inserted by a background thread; a full queue falls
+# back to synchronous writes
+TEST_WRITE_BEHIND = {
+    "ENABLED": os.getenv("TEST_WRITE_BEHIND") == "1",
+    "MAX_SIZE": 10000,
+    "BATCH_SIZE": 200,
+    "FLUSH_INTERVAL": 0.5,  # seconds
+    "RETRIES": 3,  # further attempts at a failed flush before writing its items one by one
+    "RETRY_BACKOFF": 0.1,  # seconds before the first retry, doubled for each one after
+}
+
+# sampled request profiling (see core/profiling.py); ENDPOINTS holds per-path
+# overrides such as {"/leaderboard/": {"sample_rate": 0.1, "slow_ms": 200}},
+# and PUT /profiling/ changes them at runtime. Those runtime changes are stored in
+# the database, so every worker sees them within OVERRIDES_TTL. ENABLED False
+# overrides everything else. The test modules switch it off.
+PROFILING = {
+    "ENABLED": os.getenv("PROFILING_ENABLED", "1") == "1",
+    "SAMPLE_RATE": float(os.getenv("PROFILING_SAMPLE_RATE", "0.01")),
+    "SLOW_MS": 500,  # always keep requests slower than this; None to disable
+    "ENDPOINTS": {},
+    "FLUSH_SIZE": 100,
+    "FLUSH_INTERVAL": 10,  # seconds
+    "MAX_BUFFER": 1000,
+    "MAX_QUERIES": 20,  # slowest queries kept per profile
+    "OVERRIDES_TTL": 5,  # seconds between re-reads of runtime overrides
+}
+
+# request metrics served at /metrics (see core/metrics.py); with several worker
+# processes set METRICS_DIR to a directory they all share, e.g. under /tmp. Only
+# scrapes sending "Authorization: Bearer <METRICS_TOKEN>" and staff members logged
+# in to the admin may read them
+METRICS = {
+    "ENABLED": os.getenv("METRICS_ENABLED", "1") == "1",
+    "DIR": os.getenv("METRICS_DIR"),
+    "TOKEN": os.getenv("METRICS_TOKEN"),
+    "WRITE_INTERVAL": 5,  # seconds between dumps of this worker's snapshot
+}
+
+# token-bucket throttles of the write and auth endpoints (see core/throttling.py): RATE
+# refills the bucket, BURST is its size. STORE "memory" keeps buckets per worker,
+# "cache" shares them through CACHE_ALIAS. Client addresses come from
+# REST_FRAMEWORK["NUM_PROXIES"].
+THROTTLING = {
+    "ENABLED": os.getenv("THROTTLING_ENABLED", "1") == "1",
+    "STORE": os.getenv("THROTTLING_STORE", "memory"),
+    "CACHE_ALIAS": "default",
+    "MAX_BUCKETS": 100000,
+    "RATES": {
+        "submit": {"RATE": "60/min", "BURST": 20},  # per user
+        "submit_ip": {"RATE": "300/min", "BURST": 60},  # per address
+        "register": {"RATE": "10/hour", "BURST": 5},  # per address
+        "login": {"RATE": "20/min", "BURST": 10},  # per address
+    },
+}
+
+# per-worker cap on concurrent requests and writes; requests over it wait up to
+# QUEUE_TIMEOUT seconds for a slot, then get a 503 with Retry-After
+ADMISSION = {
+    "ENABLED": os.getenv("ADMISSION_ENABLED", "1") == "1",
+    "MAX_REQUESTS": int(os.getenv("ADMISSION_MAX_REQUESTS", "64")),
+    "MAX_WRITES": int(os.getenv("ADMISSION_MAX_WRITES", "8")),
+    "QUEUE_TIMEOUT": 0.1,
+    "RETRY_AFTER": 1,  # seconds
+    "EXEMPT_PATHS": ["/hi/", "/async/hi/", "/metrics"],
+}
@@ -16,3 +16,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'brainsmath.settings')
 
 application = get_wsgi_application()
+
+# load the in-memory ranking index before the first request hits this worker
+from core import ranking
+ranking.warm()
@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # connects the User signals that keep the auth user cache fresh
+        from . import authentication  # noqa: F401
+        # and the connection_created hook that tunes SQLite connections
+        from . import sqlite  # noqa: F401
+        # a replica needs read-your-writes stickiness every worker sees
+        from . import routing
+        routing.check()
@@ -0,0 +1,90 @@
+"""Async versions of the read-heavy endpoints, for serving under ASGI.
+
+They mirror the DRF views in views.py but are plain Django async views, so a
+slow ranking query parks a coroutine instead of a whole worker thread. The
+async ORM is used for the cheap lookups (version stamps, the authenticated
+user). Cache misses are computed by the sync code shared with views.py (raw
+SQL and serializers), which cache.aget_or_set and profiles.aget_or_set run in
+a worker thread, since Django has no async cursor API yet.
+"""
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework import exceptions, status
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.exceptions import InvalidToken
+
+from . import cache, leaderboard, profiles, ranking
+from .authentication import aauthenticate
+from .models import Counter
+from .serializers import UserDataSerializer
+
+
+def jsonResponse(data, status=status.HTTP_200_OK, cache_hit=None):
+    response = HttpResponse(JSONRenderer().render(data), status=status, content_type="application/json")
+    if cache_hit is not None:
+        response["X-Cache"] = "HIT" if cache_hit else "MISS"
+    return response
+
+
+async def cachedResponse(namespace, version, request, compute):
+    """Async counterpart of views.cachedResponse, with the same ETag handling."""
+    params = request.GET.dict()
+    etag = cache.etag(namespace, version, params)
+    if cache.matches(request, etag):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        data, hit = await cache.aget_or_set(namespace, version, params, compute)
+        response = jsonResponse(data, cache_hit=hit)
+    response["ETag"] = etag
+    return response
+
+
+@require_GET
+async def hi(request):
+    return jsonResponse("hi")
+
+
+@require_GET
+async def getLeaderboard(request):
+    try:
+        board = leaderboard.board_from_params(request.GET)
+        return await cachedResponse(
+            "leaderboard", await board.aversion(), request,
+            lambda: leaderboard.board_page(board, request.GET),
+        )
+    except leaderboard.InvalidCursor:
+        return jsonResponse({"detail": "Invalid cursor."}, status.HTTP_400_BAD_REQUEST)
+    except leaderboard.InvalidFilter as error:
+        return jsonResponse({"detail": str(error)}, status.HTTP_400_BAD_REQUEST)
+
+
+@require_GET
+async def getUserRank(request):
+    try:
+        board = leaderboard.window_board(request.GET)
+        ranking.rank_param(request.GET)
+    except leaderboard.InvalidFilter as error:
+        return jsonResponse({"detail": str(error)}, status.HTTP_400_BAD_REQUEST)
+    version = await board.aversion() if board else await Counter.aget(leaderboard.VERSION_KEY)
+    return await cachedResponse("userrank", version, request, lambda: ranking.lookup(request.GET, board))
+
+
+@require_GET
+async def getUserData(request):
+    try:
+        user = await aauthenticate(request, related=("settings", "stats"))
+    except (InvalidToken, exceptions.AuthenticationFailed) as error:
+        detail = error.detail if isinstance(error.detail, dict) else {"detail": error.detail}
+        return jsonResponse(detail, status.HTTP_401_UNAUTHORIZED)
+    if user is None:
+        return jsonResponse({"detail": "Authentication credentials were not provided."}, status.HTTP_401_UNAUTHORIZED)
+
+    version = await profiles.aversion(user.pk)
+    etag = profiles.etag(user, version)
+    if cache.matches(request, etag):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        data, hit = await profiles.aget_or_set(user, version, lambda: UserDataSerializer(user).data)
+        response = jsonResponse(data, cache_hit=hit)
+    response["ETag"] = etag
+    return response
@@ -0,0 +1,144 @@
+"""JWT authentication helpers.
+
+CachedJWTAuthentication is the default DRF authentication class: it verifies
+tokens exactly like simplejwt's JWTAuthentication but serves the user from a
+short-lived per-process cache, so authenticated requests normally run no
+auth query. Cached rows are dropped when a User is saved or deleted in this
+process; changes made elsewhere (another worker, queryset.update()) show up
+after at most AUTH_USER_CACHE["TTL"] seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+def _setting(name, default):
+    return getattr(settings, "AUTH_USER_CACHE", {}).get(name, default)
+
+
+class UserCache:
+    """LRU of user rows by id, each kept for at most TTL seconds.
+
+    Rows are stored as column values and a fresh User is built on every hit,
+    so requests never share (or mutate) the same instance.
+    """
+
+    def __init__(self):
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._rows.get(str(user_id))
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._rows.move_to_end(str(user_id))
+            self.hits += 1
+        expires_at, db, field_names, values = entry
+        return User.from_db(db, field_names, values)
+
+    def put(self, user):
+        field_names = tuple(field.attname for field in User._meta.concrete_fields)
+        entry = (
+            time.monotonic() + _setting("TTL", 60),
+            user._state.db,
+            field_names,
+            tuple(getattr(user, name) for name in field_names),
+        )
+        key = str(getattr(user, api_settings.USER_ID_FIELD))
+        with self._lock:
+            self._rows[key] = entry
+            self._rows.move_to_end(key)
+            while len(self._rows) > _setting("MAX_SIZE", 10000):
+                self._rows.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._rows.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self.hits = self.misses = 0
+
+
+user_cache = UserCache()
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    user_cache.invalidate(getattr(instance, api_settings.USER_ID_FIELD))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication whose user lookup goes through ``user_cache``."""
+
+    def get_user(self, validated_token):
+        if not _setting("TTL", 60):
+            return super().get_user(validated_token)
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        user = user_cache.get(user_id)
+        if user is None:
+            user = super().get_user(validated_token)
+            user_cache.put(user)
+            return user
+
+        # the same checks JWTAuthentication runs on a freshly loaded user
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and (
+            validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password)
+        ):
+            raise AuthenticationFailed("The user's password has been changed.", code="password_changed")
+        return user
+
+
+async def aauthenticate(request, related=()):
+    """Async counterpart of JWTAuthentication.authenticate for plain Django views.
+
+    Token parsing and signature checks are pure CPU work; the only I/O is the
+    user lookup, done with the async ORM (joining ``related`` in the same
+    query). Returns None when no token was sent and raises InvalidToken or
+    AuthenticationFailed like the DRF class.
+    """
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    if header is None:
+        return None
+    raw_token = authentication.get_raw_token(header)
+    if raw_token is None:
+        return None
+
+    validated_token = authentication.get_validated_token(raw_token)
+    try:
+        user_id = validated_token[api_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise AuthenticationFailed("Token contained no recognizable user identification")
+
+    user = await (
+        User.objects.select_related(*related)
+        .filter(**{api_settings.USER_ID_FIELD: user_id})
+        .afirst()
+    )
+    if user is None:
+        raise AuthenticationFailed("User not found", code="user_not_found")
+    if not user.is_active:
+        raise AuthenticationFailed("User is inactive", code="user_inactive")
+    return user
@@ -0,0 +1,98 @@
+"""Versioned response cache for read-heavy endpoints.
+
+Entries are keyed by a namespace, a version stamp and the request parameters.
+Writers never delete entries: they bump the version (a Counter row), so the
+next read misses and stale entries simply age out of the backend. Works with
+any Django cache backend, including local-memory and file-based ones.
+
+The same key doubles as an ETag, so a client that already holds the current
+payload can be answered with a 304 as soon as the version stamp is read.
+"""
+import hashlib
+import threading
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+
+def _setting(name, default):
+    return getattr(settings, "RESPONSE_CACHE", {}).get(name, default)
+
+
+class CacheStats:
+    """Per-process hit/miss counters, by namespace."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: {"hits": 0, "misses": 0})
+
+    def record(self, namespace, hit):
+        with self._lock:
+            self._counts[namespace]["hits" if hit else "misses"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {namespace: dict(counts) for namespace, counts in self._counts.items()}
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+stats = CacheStats()
+
+
+def make_key(namespace, version, params):
+    encoded = "&".join(f"{name}={value}" for name, value in sorted(params.items()))
+    digest = hashlib.md5(encoded.encode()).hexdigest()
+    return f"response:{namespace}:v{version}:{digest}"
+
+
+def etag(namespace, version, params):
+    """Strong ETag for the entry: changes with the version and with the parameters."""
+    digest = hashlib.md5(make_key(namespace, version, params).encode()).hexdigest()
+    return f'"{namespace}-{digest[:16]}"'
+
+
+def matches(request, tag):
+    """True if the request's If-None-Match already names ``tag``."""
+    header = request.headers.get("If-None-Match", "")
+    return header.strip() == "*" or tag in [value.strip().removeprefix("W/") for value in header.split(",")]
+
+
+def get_or_set(namespace, version, params, compute):
+    """Return (value, hit) for the entry, computing and storing it on a miss."""
+    if not _setting("ENABLED", True):
+        return compute(), False
+
+    cache = caches[_setting("ALIAS", "default")]
+    key = make_key(namespace, version, params)
+    value = cache.get(key)
+    if value is not None:
+        stats.record(namespace, True)
+        return value, True
+
+    stats.record(namespace, False)
+    value = compute()
+    cache.set(key, value, _setting("TIMEOUT", 300))
+    return value, False
+
+
+async def aget_or_set(namespace, version, params, compute):
+    """Async get_or_set; ``compute`` is synchronous and runs in a worker thread."""
+    if not _setting("ENABLED", True):
+        return await sync_to_async(compute)(), False
+
+    cache = caches[_setting("ALIAS", "default")]
+    key = make_key(namespace, version, params)
+    value = await cache.aget(key)
+    if value is not None:
+        stats.record(namespace, True)
+        return value, True
+
+    stats.record(namespace, False)
+    value = await sync_to_async(compute)()
+    await cache.aset(key, value, _setting("TIMEOUT", 300))
+    return value, False
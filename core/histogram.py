@@ -0,0 +1,214 @@
+"""Histogram of best qpm, for "faster than N% of players".
+
+core_qpmbest holds each user's best qpm per scope and core_qpmbucket how many
+users' bests fall in each fixed-width bucket of that scope. A scope is a
+``mode:difficulty`` pair where either side may be ``*``, so the global
+histogram is ``*:*``. submitTest moves the user between buckets when a best
+improves, so a percentile is a sum over at most BUCKET_COUNT rows instead of a
+ranking of every user.
+"""
+import math
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Max, Q, Value, When
+
+from .leaderboard import MODES, InvalidFilter
+from .models import Counter, QpmBest, QpmBucket, Test
+
+
+VERSION_KEY = "histogram"
+BUCKET_WIDTH = 5
+# the last bucket is open ended: everything from 295 qpm up
+BUCKET_COUNT = 60
+
+
+def bucket_of(qpm):
+    return max(0, min(int(qpm // BUCKET_WIDTH), BUCKET_COUNT - 1))
+
+
+def scope_key(mode=None, difficulty=None):
+    return f"{mode or '*'}:{'*' if difficulty is None else difficulty}"
+
+
+def scopes_of(mode, difficulty):
+    """Every scope a test with this mode and difficulty counts towards."""
+    return (scope_key(), scope_key(mode), scope_key(difficulty=difficulty), scope_key(mode, difficulty))
+
+
+def _move(deltas):
+    """Add ``deltas[(scope, bucket)]`` to the bucket counts with one UPDATE."""
+    changes = {key: delta for key, delta in deltas.items() if delta}
+    if not changes or _add(changes) == len(changes):
+        return
+    # first user in some of these buckets: create them, then count this move
+    existing = set(QpmBucket.objects.filter(_matching(changes)).values_list("scope", "bucket"))
+    missing = {key: delta for key, delta in changes.items() if key not in existing}
+    QpmBucket.objects.bulk_create(
+        [QpmBucket(scope=scope, bucket=bucket, users=0) for scope, bucket in missing], ignore_conflicts=True)
+    _add(missing)
+
+
+def _matching(keys):
+    condition = Q()
+    for scope, bucket in keys:
+        condition |= Q(scope=scope, bucket=bucket)
+    return condition
+
+
+def _add(changes):
+    delta = Case(*[When(_matching([key]), then=Value(delta)) for key, delta in changes.items()],
+                 output_field=IntegerField())
+    return QpmBucket.objects.filter(_matching(changes)).update(users=F("users") + delta)
+
+
+def record_tests(tests):
+    """Fold freshly saved tests into their users' bests and the bucket counts.
+
+    Must run inside the transaction that saved ``tests``. Reads every touched
+    best with one locking query. Returns True when any best changed.
+    """
+    candidates = {}
+    for test in tests:
+        for scope in scopes_of(test.mode, test.difficulty):
+            key = (test.user_id, scope)
+            candidates[key] = max(candidates.get(key, test.qpm), test.qpm)
+    if not candidates:
+        return False
+
+    existing = {
+        (row.user_id, row.scope): row
+        for row in QpmBest.objects.select_for_update().filter(
+            user_id__in={user_id for user_id, _ in candidates}, scope__in={scope for _, scope in candidates})
+    }
+
+    created, updated, deltas = [], defaultdict(list), defaultdict(int)
+    for (user_id, scope), qpm in candidates.items():
+        row = existing.get((user_id, scope))
+        if row is None:
+            created.append(QpmBest(user_id=user_id, scope=scope, qpm=qpm))
+        elif qpm > row.qpm:
+            updated[qpm].append(row.pk)
+            deltas[(scope, bucket_of(row.qpm))] -= 1
+        else:
+            continue
+        deltas[(scope, bucket_of(qpm))] += 1
+
+    if not created and not updated:
+        return False
+    if created:
+        # the locking read can't lock rows that don't exist yet: when a concurrent
+        # submission inserts one first, start over, which now locks its committed row
+        # and counts the user in its bucket once
+        try:
+            with transaction.atomic():
+                QpmBest.objects.bulk_create(created)
+        except IntegrityError:
+            return record_tests(tests)
+    # a new best usually improves all four scopes of its test at once: one UPDATE for them
+    for qpm, ids in updated.items():
+        QpmBest.objects.filter(pk__in=ids).update(qpm=qpm)
+    _move(deltas)
+    # bumped even when only qpm moved within a bucket: cached ?user= percentiles show it
+    Counter.increment(VERSION_KEY)
+    return True
+
+
+def rebuild(batch_size=1000):
+    """Recompute every scope's bests and bucket counts from core_test. Returns the number of users."""
+    bests = {}
+    rows = Test.objects.order_by().values_list("user_id", "mode", "difficulty").annotate(best=Max("qpm"))
+    for user_id, mode, difficulty, qpm in rows.iterator(chunk_size=batch_size):
+        for scope in scopes_of(mode, difficulty):
+            key = (user_id, scope)
+            bests[key] = max(bests.get(key, qpm), qpm)
+
+    counts = defaultdict(int)
+    for (_, scope), qpm in bests.items():
+        counts[(scope, bucket_of(qpm))] += 1
+
+    QpmBest.objects.all().delete()
+    QpmBucket.objects.all().delete()
+    QpmBest.objects.bulk_create(
+        [QpmBest(user_id=user_id, scope=scope, qpm=qpm) for (user_id, scope), qpm in bests.items()],
+        batch_size=batch_size,
+    )
+    QpmBucket.objects.bulk_create(
+        [QpmBucket(scope=scope, bucket=bucket, users=users) for (scope, bucket), users in counts.items()],
+        batch_size=batch_size,
+    )
+    Counter.increment(VERSION_KEY)
+    return sum(1 for _, scope in bests if scope == scope_key())
+
+
+def distribution(scope):
+    """Users per bucket of ``scope``, as a list indexed by bucket and trimmed after the last non-empty one."""
+    counts = [0] * BUCKET_COUNT
+    for bucket, users in QpmBucket.objects.filter(scope=scope).values_list("bucket", "users"):
+        counts[bucket] = users
+    while counts and not counts[-1]:
+        counts.pop()
+    return counts
+
+
+def percentile(counts, qpm, own=False):
+    """Share of players slower than ``qpm``, in percent, from bucket ``counts``.
+
+    Players in the same bucket are assumed to be spread evenly across it.
+    ``own`` means ``qpm`` is one of the counted bests, which is left out.
+    """
+    bucket = bucket_of(qpm)
+    within = counts[bucket] if bucket < len(counts) else 0
+    if own:
+        within = max(within - 1, 0)
+    others = sum(counts) - (1 if own else 0)
+    if others <= 0:
+        return 100.0
+    fraction = min(max((qpm - bucket * BUCKET_WIDTH) / BUCKET_WIDTH, 0), 1)
+    slower = sum(counts[:bucket]) + within * fraction
+    return round(100 * slower / others, 1)
+
+
+def scope_from_params(params):
+    mode = params.get("mode") or None
+    if mode is not None and mode not in MODES:
+        raise InvalidFilter(f"Unknown mode {mode!r}.")
+    difficulty = params.get("difficulty") or None
+    if difficulty is not None:
+        try:
+            difficulty = int(difficulty)
+        except ValueError:
+            raise InvalidFilter("difficulty must be an integer.")
+    return mode, difficulty
+
+
+def lookup(params):
+    """The /percentile/ payload: the distribution, plus the percentile of ?user=name or ?qpm=value."""
+    mode, difficulty = scope_from_params(params)
+    scope = scope_key(mode, difficulty)
+    username, qpm = params.get("user"), params.get("qpm")
+    if username is None and qpm is not None:
+        try:
+            qpm = float(qpm)
+        except ValueError:
+            qpm = math.nan
+        if not math.isfinite(qpm):
+            raise InvalidFilter("qpm must be a number.")
+
+    counts = distribution(scope)
+    result = {
+        "mode": mode,
+        "difficulty": difficulty,
+        "players": sum(counts),
+        "bucket_width": BUCKET_WIDTH,
+        "distribution": [{"qpm": bucket * BUCKET_WIDTH, "users": users} for bucket, users in enumerate(counts)],
+        "user": username,
+        "qpm": None,
+        "percentile": None,
+    }
+    if username is not None:
+        qpm = QpmBest.objects.filter(scope=scope, user__username=username).values_list("qpm", flat=True).first()
+    if qpm is not None:
+        result["qpm"] = qpm
+        result["percentile"] = percentile(counts, qpm, own=username is not None)
+    return result
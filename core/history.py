@@ -0,0 +1,124 @@
+"""A user's test history, page by page or rolled up per day or week.
+
+Pages are ordered newest first by (creation, id) and continue from a cursor,
+so each one is a range scan on test_user_creation_idx however far back it is.
+The aggregate mode groups in SQL and returns one point per period with the
+average and maximum qpm, raw and accuracy, which is what progress charts draw.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.db.models import Avg, Count, Max, Q
+from django.db.models.functions import TruncDay, TruncWeek
+from django.utils import timezone
+
+from .leaderboard import InvalidCursor, InvalidFilter
+from .models import Test
+from .serializers import TEST_ROWS, serialize_datetime
+
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+AGGREGATES = {"day": TruncDay, "week": TruncWeek}
+AGGREGATED_FIELDS = ("qpm", "raw", "accuracy")
+
+CREATION = TEST_ROWS.columns.index("creation")
+ID = TEST_ROWS.columns.index("id")
+
+
+def encode_cursor(creation, pk=None):
+    payload = {"c": creation.isoformat()}
+    if pk is not None:
+        payload["t"] = pk
+    encoded = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(encoded).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (creation, test_id) for a cursor made by encode_cursor; test_id is None for aggregates."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        creation = datetime.fromisoformat(payload["c"])
+        pk = int(payload["t"]) if "t" in payload else None
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidCursor(cursor)
+    if timezone.is_naive(creation):
+        raise InvalidCursor(cursor)
+    return creation, pk
+
+
+def page_size(params):
+    try:
+        limit = int(params.get("limit", PAGE_SIZE))
+    except ValueError:
+        raise InvalidFilter("limit must be an integer.")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise InvalidFilter(f"limit must be between 1 and {MAX_PAGE_SIZE}.")
+    return limit
+
+
+def tests_page(user, limit, cursor=None):
+    """Up to ``limit`` of the user's tests, newest first, after ``cursor``."""
+    tests = Test.objects.filter(user=user)
+    if cursor is not None:
+        creation, pk = decode_cursor(cursor)
+        if pk is None:
+            raise InvalidCursor(cursor)
+        tests = tests.filter(Q(creation__lt=creation) | Q(creation=creation, id__lt=pk))
+    rows = list(tests.order_by("-creation", "-id").values_list(*TEST_ROWS.columns)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "results": TEST_ROWS.many(rows),
+        "next": encode_cursor(rows[-1][CREATION], rows[-1][ID]) if has_more else None,
+    }
+
+
+def aggregate_page(user, period, limit, cursor=None):
+    """Per-period count, averages and maxima of the user's tests, newest period first."""
+    tests = Test.objects.filter(user=user)
+    if cursor is not None:
+        start, pk = decode_cursor(cursor)
+        if pk is not None:
+            raise InvalidCursor(cursor)
+        # everything before the start of the last period sent, so the filter stays on the index
+        tests = tests.filter(creation__lt=start)
+    metrics = {}
+    for field in AGGREGATED_FIELDS:
+        metrics[f"{field}_avg"] = Avg(field)
+        metrics[f"{field}_max"] = Max(field)
+    rows = list(
+        tests
+        .annotate(period=AGGREGATES[period]("creation"))
+        .values("period")
+        .annotate(tests=Count("id"), **metrics)
+        .order_by("-period")[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    results = []
+    for row in rows:
+        results.append({
+            "period": serialize_datetime(row["period"]),
+            "tests": row["tests"],
+            **{name: round(row[name], 2) for name in metrics},
+        })
+    return {
+        "period": period,
+        "results": results,
+        "next": encode_cursor(rows[-1]["period"]) if has_more else None,
+    }
+
+
+def lookup(user, params):
+    """The /history/ payload for ``user``: ?aggregate=day|week rolls tests up, ?cursor= continues."""
+    limit = page_size(params)
+    period = params.get("aggregate")
+    if not period:
+        return tests_page(user, limit, params.get("cursor"))
+    if period not in AGGREGATES:
+        raise InvalidFilter(f"aggregate must be one of {', '.join(AGGREGATES)}.")
+    return aggregate_page(user, period, limit, params.get("cursor"))
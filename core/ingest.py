@@ -0,0 +1,186 @@
+"""Optional write-behind ingestion for submitTest.
+
+When TEST_WRITE_BEHIND["ENABLED"] is set, validated submissions are put on a
+bounded in-process queue and a background thread bulk inserts them, flushing
+whenever BATCH_SIZE items are waiting or FLUSH_INTERVAL seconds have passed.
+If the queue is full the caller writes synchronously instead (backpressure).
+Pending items are flushed when the process exits.
+
+Queued items have already been answered with a 202, so a failed flush is
+retried RETRIES times with exponential backoff, and a batch that still fails
+is written one item at a time: a bad row loses only itself, and is logged
+with its payload so it can be replayed.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from . import submissions
+from .models import Test
+
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, "TEST_WRITE_BEHIND", {}).get(name, default)
+
+
+def enabled():
+    return _setting("ENABLED", False)
+
+
+class WriteBehindQueue:
+
+    def __init__(self, max_size=10000, batch_size=200, flush_interval=0.5, retries=3, retry_backoff=0.1,
+                 autostart=True):
+        self.autostart = autostart
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "flushed": 0,
+            "flushes": 0,
+            "failed": 0,
+            "retries": 0,
+            "last_flush_seconds": 0.0,
+            "total_flush_seconds": 0.0,
+        }
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="test-write-behind", daemon=True)
+                self._thread.start()
+
+    def put(self, user, item):
+        """Queue one validated payload. Returns False if the queue is full."""
+        if self.autostart:
+            self.start()
+        try:
+            self._queue.put_nowait((user, item))
+        except queue.Full:
+            self._count("rejected")
+            return False
+        self._count("enqueued")
+        return True
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["depth"] = self.depth()
+        return stats
+
+    def stop(self, timeout=10):
+        """Stop the worker and flush whatever is still queued."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def flush(self):
+        """Write every queued item now, on the calling thread."""
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                return
+            self._write(batch)
+
+    def _count(self, name, by=1):
+        with self._stats_lock:
+            self._stats[name] += by
+
+    def _drain(self, limit, wait=0):
+        batch = []
+        deadline = time.monotonic() + wait
+        while len(batch) < limit:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._drain(self.batch_size, wait=self.flush_interval)
+            if batch:
+                close_old_connections()
+                self._write(batch)
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retries")
+                time.sleep(delay)
+                delay *= 2
+            try:
+                self._insert(batch)
+            except Exception:
+                logger.warning("Write-behind flush of %d tests failed (attempt %d of %d)",
+                               len(batch), attempt + 1, self.retries + 1, exc_info=True)
+            else:
+                written = len(batch)
+                break
+        else:
+            written = self._insert_each(batch)
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self._stats["flushed"] += written
+            self._stats["failed"] += len(batch) - written
+            self._stats["flushes"] += 1
+            self._stats["last_flush_seconds"] = elapsed
+            self._stats["total_flush_seconds"] += elapsed
+
+    def _insert(self, batch):
+        by_user = defaultdict(list)
+        for user, item in batch:
+            by_user[user.pk].append(Test(user=user, **item))
+        with transaction.atomic():
+            tests = Test.objects.bulk_create([test for tests in by_user.values() for test in tests])
+            submissions.record(tests)
+
+    def _insert_each(self, batch):
+        """Last resort for a batch that keeps failing: one transaction per item. Returns how many were written."""
+        written = 0
+        for user, item in batch:
+            try:
+                self._insert([(user, item)])
+            except Exception:
+                logger.exception("Dropped write-behind test for user %s: %r", user.pk, item)
+            else:
+                written += 1
+        return written
+
+
+writer = WriteBehindQueue(
+    max_size=_setting("MAX_SIZE", 10000),
+    batch_size=_setting("BATCH_SIZE", 200),
+    flush_interval=_setting("FLUSH_INTERVAL", 0.5),
+    retries=_setting("RETRIES", 3),
+    retry_backoff=_setting("RETRY_BACKOFF", 0.1),
+)
+atexit.register(writer.stop)
@@ -0,0 +1,478 @@
+import base64
+import binascii
+import json
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from . import periods, routing
+from .models import Counter, FilteredBest, Test, UserBest
+from .serializers import row_serializer
+
+
+VERSION_KEY = "leaderboard"
+FILTERED_VERSION_KEY = "leaderboard:filtered"  # one counter per scope: "leaderboard:filtered:<scope>"
+COUNT_KEY = "leaderboard:users"
+
+
+LEADERBOARD_COLUMNS = """
+    b.test_id AS id,
+    b.qpm,
+    b.raw,
+    b.accuracy,
+    b.mode,
+    b.difficulty,
+    b.creation,
+    b.number,
+    b.time,
+    b.user_id,
+    b.username
+"""
+
+
+def record_test(test):
+    """Update the user's best row for a freshly saved test.
+
+    Must run inside the transaction that saved ``test``. Returns True when
+    the user's best changed. On a tie the older test keeps its place.
+    """
+    best = UserBest.objects.select_for_update().filter(user_id=test.user_id).first()
+    if best is None:
+        return _insert_best(test)
+    if test.qpm <= best.qpm:
+        return False
+
+    best.copy_from(test, test.user.username)
+    best.version = Counter.bump(VERSION_KEY)
+    best.save()
+    return True
+
+
+def _insert_best(test):
+    """Create the user's first best row from ``test``.
+
+    The locking read can't lock a row that doesn't exist yet, so two first
+    submissions may both get here. The loser's INSERT fails inside its
+    savepoint; by then the winner's row is committed, and record_test() again
+    locks it and compares like any later submission.
+    """
+    best = UserBest(user_id=test.user_id)
+    best.copy_from(test, test.user.username)
+    try:
+        with transaction.atomic():
+            best.version = Counter.bump(VERSION_KEY)
+            best.save(force_insert=True)
+            Counter.increment(COUNT_KEY)
+    except IntegrityError:
+        return record_test(test)
+    return True
+
+
+COPIED_FIELDS = ("test_id", "username", "qpm", "raw", "accuracy", "mode", "difficulty", "creation", "number", "time")
+
+
+def scopes_of(mode, time, number, difficulty):
+    """Scopes of the filtered boards a test in this bucket ranks on.
+
+    A scope is ``mode:length:difficulty``, where length is the time in ms for
+    the time mode and the question count for the questions mode, and ``*``
+    leaves a part unfiltered. A length is only ever filtered together with its
+    mode, and the fully unfiltered board is core_userbest, so that is five.
+    """
+    length = time if mode == "time" else number
+    return (
+        f"*:*:{difficulty}",
+        f"{mode}:*:*",
+        f"{mode}:*:{difficulty}",
+        f"{mode}:{length}:*",
+        f"{mode}:{length}:{difficulty}",
+    )
+
+
+def version_key(scope):
+    return f"{FILTERED_VERSION_KEY}:{scope}"
+
+
+def record_filtered_tests(tests):
+    """Fold freshly saved tests into the filtered boards' rows.
+
+    Must run inside the transaction that saved ``tests``. Reads every touched
+    row with one locking query and bumps the version of each scope whose
+    board changed, so a new best leaves the cached pages of other filters
+    alone. Returns True when any row changed.
+    """
+    candidates = {}
+    for test in tests:
+        for scope in scopes_of(test.mode, test.time, test.number, test.difficulty):
+            key = (test.user_id, scope)
+            if key not in candidates or test.qpm > candidates[key].qpm:
+                candidates[key] = test
+    if not candidates:
+        return False
+
+    existing = {
+        (row.user_id, row.scope): row
+        for row in FilteredBest.objects.select_for_update().filter(
+            user_id__in={user_id for user_id, _ in candidates}, scope__in={scope for _, scope in candidates})
+    }
+
+    created, updated, changed = [], defaultdict(list), set()
+    for (user_id, scope), test in candidates.items():
+        row = existing.get((user_id, scope))
+        if row is None:
+            row = FilteredBest(user_id=user_id, scope=scope)
+            row.copy_from(test, test.user.username)
+            created.append(row)
+        elif test.qpm > row.qpm:
+            updated[test].append(row.pk)
+        else:
+            continue
+        changed.add(scope)
+
+    if not changed:
+        return False
+    if created:
+        # the locking read can't lock rows that don't exist yet: when a concurrent
+        # submission inserts one first, start over, which now locks its committed row
+        try:
+            with transaction.atomic():
+                FilteredBest.objects.bulk_create(created)
+        except IntegrityError:
+            return record_filtered_tests(tests)
+    # a new best usually tops all five scopes of its test at once: one UPDATE for them
+    for test, ids in updated.items():
+        row = FilteredBest()
+        row.copy_from(test, test.user.username)
+        FilteredBest.objects.filter(pk__in=ids).update(**{field: getattr(row, field) for field in COPIED_FIELDS})
+    Counter.increment_all(version_key(scope) for scope in changed)
+    return True
+
+
+def rebuild_filtered(batch_size=1000):
+    """Recompute every FilteredBest row from core_test. Returns the row count.
+
+    Reads each user's best test per bucket (mode, time, number, difficulty),
+    the finest grain any filter has, and folds those into the scopes. Works
+    on value tuples: a large table has hundreds of thousands of buckets.
+    """
+    fields = COPIED_FIELDS[2:]
+    bucket_bests = (
+        Test.objects
+        .annotate(position=Window(
+            RowNumber(),
+            partition_by=[F("user_id"), F("mode"), F("time"), F("number"), F("difficulty")],
+            order_by=[F("qpm").desc(), F("id").asc()],
+        ))
+        .filter(position=1)
+        .values_list("id", "user_id", "user__username", *fields)
+    )
+    best = {}
+    for row in bucket_bests.iterator(chunk_size=batch_size):
+        values = dict(zip(fields, row[3:]))
+        for scope in scopes_of(values["mode"], values["time"], values["number"], values["difficulty"]):
+            key = (row[1], scope)
+            current = best.get(key)
+            if current is None or (values["qpm"], -row[0]) > (current[3], -current[0]):
+                best[key] = row
+
+    rows = [
+        FilteredBest(user_id=user_id, scope=scope, test_id=row[0], username=row[2], **dict(zip(fields, row[3:])))
+        for (user_id, scope), row in best.items()
+    ]
+    FilteredBest.objects.all().delete()
+    FilteredBest.objects.bulk_create(rows, batch_size=batch_size)
+    Counter.increment_all(version_key(scope) for scope in {scope for _, scope in best})
+    return len(rows)
+
+
+def best_tests():
+    """Each user's best test, one per user, ties broken by the oldest test."""
+    return (
+        Test.objects
+        .annotate(position=Window(
+            RowNumber(),
+            partition_by=[F("user_id")],
+            order_by=[F("qpm").desc(), F("id").asc()],
+        ))
+        .filter(position=1)
+        .select_related("user")
+    )
+
+
+def rebuild(batch_size=1000):
+    """Recompute the whole UserBest table from core_test. Returns the row count."""
+    version = Counter.bump(VERSION_KEY)
+    rows = []
+    for test in best_tests().iterator(chunk_size=batch_size):
+        best = UserBest(user_id=test.user_id, version=version)
+        best.copy_from(test, test.user.username)
+        rows.append(best)
+
+    UserBest.objects.all().delete()
+    UserBest.objects.bulk_create(rows, batch_size=batch_size)
+    Counter.objects.update_or_create(key=COUNT_KEY, defaults={"value": len(rows)})
+    return len(rows)
+
+
+def count():
+    """Number of ranked users, read from a maintained counter rather than COUNT(*)."""
+    return Counter.get(COUNT_KEY)
+
+
+def _fetch(query, params):
+    with routing.read_connection().cursor() as cursor:
+        cursor.execute(query, params)
+        rows = row_serializer(tuple(col[0] for col in cursor.description))
+        return rows.many(cursor.fetchall())
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(row, direction):
+    payload = json.dumps({"q": row["qpm"], "t": row["id"], "d": direction}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (direction, qpm, test_id) for a cursor made by encode_cursor."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        direction, qpm, test_id = payload["d"], float(payload["q"]), int(payload["t"])
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidCursor(cursor)
+    if direction not in ("next", "prev"):
+        raise InvalidCursor(cursor)
+    return direction, qpm, test_id
+
+
+class Board:
+    """A ranked set of rows the pagination helpers can page through.
+
+    ``source`` is the FROM clause (aliased ``b``), ``where`` an optional
+    condition on it and ``id_column`` the test id used to break qpm ties.
+    """
+
+    def __init__(self, source, params=(), where="", id_column="b.test_id", columns=LEADERBOARD_COLUMNS,
+                 count_query=None, count_params=(), version_key=VERSION_KEY, scope=""):
+        self.source = source
+        self.params = list(params)
+        self.where = where
+        self.id_column = id_column
+        self.columns = columns
+        self.count_query = count_query
+        self.count_params = list(count_params)
+        self.version_key = version_key
+        self.scope = scope
+
+    def fetch(self, condition, condition_params, order, limit, offset=0):
+        where = " AND ".join(f"({part})" for part in (self.where, condition) if part)
+        query = f"""
+            SELECT {self.columns}
+            FROM {self.source}
+            {"WHERE " + where if where else ""}
+            ORDER BY {order}
+            LIMIT %s OFFSET %s
+        """
+        return _fetch(query, self.params + list(condition_params) + [limit, offset])
+
+    def version(self):
+        """Counter value that changes whenever this board may have changed.
+
+        ``scope`` is appended for boards whose rows depend on more than the
+        counter, such as "this week" turning into next week.
+        """
+        value = Counter.get(self.version_key)
+        return f"{value}:{self.scope}" if self.scope else value
+
+    async def aversion(self):
+        value = await Counter.aget(self.version_key)
+        return f"{value}:{self.scope}" if self.scope else value
+
+    def count(self):
+        if self.count_query is None:
+            return count()
+        with routing.read_connection().cursor() as cursor:
+            cursor.execute(self.count_query, self.count_params)
+            return cursor.fetchone()[0]
+
+
+GLOBAL_BOARD = Board("core_userbest b")
+
+MODES = [choice for choice, _ in Test.mode_choices]
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def filtered_board(mode=None, time=None, number=None, difficulty=None):
+    """Each user's best test among those matching the filters.
+
+    ``time`` is in seconds, like the buckets in UserDataSerializer. Giving a
+    time or number implies the matching mode. The rows come from
+    core_filteredbest, one per user and scope, so every page is a range scan
+    on filteredbest_rank_idx however many tests match.
+    """
+    if time is not None:
+        mode = mode or "time"
+    if number is not None:
+        mode = mode or "questions"
+    if mode is not None and mode not in MODES:
+        raise InvalidFilter(f"Unknown mode {mode!r}.")
+    if (time is not None and mode != "time") or (number is not None and mode != "questions"):
+        raise InvalidFilter("time only applies to the time mode and number to the questions mode.")
+
+    length = time * 1000 if time is not None else number
+    scope = ":".join("*" if part is None else str(part) for part in (mode, length, difficulty))
+    return Board(
+        "core_filteredbest b", [scope], where="b.scope = %s",
+        count_query="SELECT COUNT(*) FROM core_filteredbest WHERE scope = %s", count_params=[scope],
+        version_key=version_key(scope),
+    )
+
+
+def period_board(window, start):
+    """Each user's best test in the ``window`` period starting on ``start``."""
+    if window not in periods.WINDOWS:
+        raise InvalidFilter(f"Unknown window {window!r}.")
+    params = [window, start]
+    return Board(
+        "core_periodbest b", params, where="b.period = %s AND b.period_start = %s",
+        count_query="SELECT COUNT(*) FROM core_periodbest WHERE period = %s AND period_start = %s",
+        count_params=params, version_key=periods.VERSION_KEY, scope=f"{window}:{start.isoformat()}",
+    )
+
+
+def window_board(params):
+    """The board for a ``window`` (and optional ``date``) query parameter, or None for all-time."""
+    window = params.get("window")
+    if not window or window == "all":
+        return None
+    if window not in periods.WINDOWS:
+        raise InvalidFilter(f"window must be one of all, {', '.join(periods.WINDOWS)}.")
+    try:
+        start = periods.parse_start(window, params.get("date"))
+    except ValueError as error:
+        raise InvalidFilter(str(error))
+    return period_board(window, start)
+
+
+def board_from_params(params):
+    """Pick the board for /leaderboard/ query parameters."""
+    board = window_board(params)
+    if board is not None:
+        if any(params.get(name) for name in ("mode", "time", "number", "difficulty")):
+            raise InvalidFilter("window can't be combined with mode, time, number or difficulty.")
+        return board
+
+    filters = {}
+    for name in ("time", "number", "difficulty"):
+        if params.get(name):
+            try:
+                filters[name] = int(params[name])
+            except ValueError:
+                raise InvalidFilter(f"{name} must be an integer.")
+    if params.get("mode"):
+        filters["mode"] = params["mode"]
+    if not filters:
+        return GLOBAL_BOARD
+    return filtered_board(**filters)
+
+
+PAGE_SIZE = 50
+
+
+def page_param(params):
+    """The ?page= parameter as a 1-based page number."""
+    try:
+        page_number = int(params.get("page", 1))
+    except ValueError:
+        raise InvalidFilter("page must be an integer.")
+    if page_number < 1:
+        raise InvalidFilter("page must be at least 1.")
+    return page_number
+
+
+def board_page(board, params, limit=PAGE_SIZE):
+    """The /leaderboard/ payload for a board and its query parameters."""
+    cursor = params.get("cursor")
+    if cursor is None and "page" in params:
+        data = page(limit, (page_param(params) - 1) * limit, board)
+    else:
+        data = cursor_page(limit, cursor, board)
+    data["count"] = board.count()
+    return data
+
+
+def page(limit, offset, board=GLOBAL_BOARD):
+    """Offset page of the board plus next/previous cursors."""
+    rows = board.fetch("", [], f"b.qpm DESC, {board.id_column} ASC", limit + 1, offset)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "results": rows,
+        "next": encode_cursor(rows[-1], "next") if has_more else None,
+        "previous": encode_cursor(rows[0], "prev") if offset and rows else None,
+    }
+
+
+def cursor_page(limit, cursor=None, board=GLOBAL_BOARD):
+    """Keyset page of the board ordered by (qpm desc, test id asc).
+
+    Every page is a range scan on the board's qpm index, so its cost does not
+    depend on how deep into the board it is.
+    """
+    if cursor is None:
+        return page(limit, 0, board)
+
+    direction, qpm, test_id = decode_cursor(cursor)
+    id_column = board.id_column
+    if direction == "next":
+        condition = f"b.qpm <= %s AND (b.qpm < %s OR {id_column} > %s)"
+        order = f"b.qpm DESC, {id_column} ASC"
+    else:
+        condition = f"b.qpm >= %s AND (b.qpm > %s OR {id_column} < %s)"
+        order = f"b.qpm ASC, {id_column} DESC"
+
+    rows = board.fetch(condition, [qpm, qpm, test_id], order, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if direction == "prev":
+        rows.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, True
+
+    return {
+        "results": rows,
+        "next": encode_cursor(rows[-1], "next") if has_next and rows else None,
+        "previous": encode_cursor(rows[0], "prev") if has_previous and rows else None,
+    }
+
+
+def user_rank(username, board=GLOBAL_BOARD):
+    where = f"WHERE {board.where}" if board.where else ""
+    query = f"""
+        WITH result AS (
+            SELECT
+                {board.columns},
+                ROW_NUMBER() OVER (ORDER BY b.qpm DESC, {board.id_column} ASC) AS "index"
+            FROM {board.source}
+            {where}
+        )
+        SELECT * FROM result
+        WHERE username = %s
+    """
+    return _fetch(query, board.params + [username])
+
+
+def user_at_rank(rank, board=GLOBAL_BOARD):
+    results = board.fetch("", [], f"b.qpm DESC, {board.id_column} ASC", 1, rank - 1)
+    for row in results:
+        row["index"] = rank
+    return results
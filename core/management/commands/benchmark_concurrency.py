@@ -0,0 +1,60 @@
+import json
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from core.benchmarking import process_tree_rss, summarize
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent GETs at a running server and report latency, throughput and the server's memory. "
+        "Compare e.g. `gunicorn brainsmath.wsgi -w 4` against `uvicorn brainsmath.asgi:application --workers 4`, "
+        "passing each master's pid with --server-pid so both runs are compared at equal memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument("--paths", nargs="+", default=["/leaderboard/", "/async/leaderboard/"])
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--requests", type=int, default=2000, help="requests per path")
+        parser.add_argument("--token", help="JWT access token sent as a Bearer header")
+        parser.add_argument("--server-pid", type=int, help="pid whose process tree RSS is reported")
+        parser.add_argument("--timeout", type=float, default=30)
+
+    def handle(self, *args, **options):
+        headers = {"Authorization": f"Bearer {options['token']}"} if options["token"] else {}
+        report = {"url": options["url"], "concurrency": options["concurrency"], "paths": {}}
+
+        for path in options["paths"]:
+            url = options["url"].rstrip("/") + path
+
+            def fetch(_):
+                request = urllib.request.Request(url, headers=headers)
+                started = time.perf_counter()
+                try:
+                    with urllib.request.urlopen(request, timeout=options["timeout"]) as response:
+                        response.read()
+                        ok = response.status < 400
+                except (urllib.error.URLError, OSError):
+                    ok = False
+                return (time.perf_counter() - started) * 1000, ok
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                results = list(pool.map(fetch, range(options["requests"])))
+            elapsed = time.perf_counter() - started
+
+            report["paths"][path] = {
+                "requests": len(results),
+                "errors": sum(1 for _, ok in results if not ok),
+                "throughput_rps": round(len(results) / elapsed, 1),
+                **summarize([timing for timing, _ in results]),
+            }
+            if options["server_pid"]:
+                report["paths"][path]["server_rss_mib"] = process_tree_rss(options["server_pid"])
+
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,169 @@
+import json
+import subprocess
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from core import urls
+from core.benchmarking import summarize
+
+
+def test_payload(i):
+    return {"qpm": 40 + i % 50, "raw": 50, "accuracy": 90, "mode": "time", "difficulty": 3, "number": 0, "time": 60000}
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive every endpoint in core/urls.py through the Django test client and report "
+        "p50/p95/p99 latency, throughput and queries per request as JSON. Write endpoints "
+        "insert rows, so run it against a seeded scratch database (see seed_data)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+        parser.add_argument("--warmup", type=int, default=5)
+        parser.add_argument("--username", help="user to authenticate as (default: the most active one)")
+        parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+        parser.add_argument("--no-auth-cache", action="store_true",
+                            help="look the user up on every authenticated request")
+        parser.add_argument("--only", nargs="*", default=[], help="only run scenarios whose name contains one of these")
+        parser.add_argument("--throttling", action="store_true",
+                            help="keep the rate limits on (by default they would turn most writes into 429s)")
+
+    def scenarios(self, user):
+        profile = {"auth": True}
+        return {
+            "user/": [
+                {"name": "GET /user/", "method": "get", **profile},
+                {"name": "PUT /user/", "method": "put", "data": lambda i: {"font": "ubuntu"}, **profile},
+            ],
+            "leaderboard/": [
+                {"name": "GET /leaderboard/", "method": "get"},
+                {"name": "GET /leaderboard/?page=20", "method": "get", "params": {"page": 20}},
+                {"name": "GET /leaderboard/?time=60&difficulty=3", "method": "get",
+                 "params": {"time": 60, "difficulty": 3}},
+                {"name": "GET /leaderboard/?window=week", "method": "get", "params": {"window": "week"}},
+            ],
+            "hi/": [{"name": "GET /hi/", "method": "get"}],
+            "test/": [{"name": "POST /test/", "method": "post", "data": test_payload, **profile}],
+            "test/batch/": [
+                {"name": "POST /test/batch/ (10 items)", "method": "post",
+                 "data": lambda i: [test_payload(i + n) for n in range(10)], **profile},
+            ],
+            "register/": [
+                {"name": "POST /register/", "method": "post",
+                 "data": lambda i: {"username": f"bench-register-{time.time_ns()}-{i}",
+                                    "email": "bench@example.com", "password": "bench-password"}},
+            ],
+            "userrank/": [
+                {"name": "GET /userrank/?user", "method": "get", "params": {"user": user.username}},
+                {"name": "GET /userrank/?rank", "method": "get", "params": {"rank": 10}},
+                {"name": "GET /userrank/?user&window=month", "method": "get",
+                 "params": {"user": user.username, "window": "month"}},
+            ],
+            "percentile/": [
+                {"name": "GET /percentile/?user", "method": "get", "params": {"user": user.username}},
+                {"name": "GET /percentile/?user&mode=time&difficulty=3", "method": "get",
+                 "params": {"user": user.username, "mode": "time", "difficulty": 3}},
+            ],
+            "history/": [
+                {"name": "GET /history/", "method": "get", **profile},
+                {"name": "GET /history/?aggregate=day", "method": "get", "params": {"aggregate": "day"}, **profile},
+                {"name": "GET /history/?aggregate=week", "method": "get", "params": {"aggregate": "week"}, **profile},
+            ],
+            # staff only, so for seeded users this measures the permission check
+            "profiling/": [{"name": "GET /profiling/", "method": "get", **profile}],
+            "async/user/": [{"name": "GET /async/user/", "method": "get", **profile}],
+            "async/leaderboard/": [{"name": "GET /async/leaderboard/", "method": "get"}],
+            "async/hi/": [{"name": "GET /async/hi/", "method": "get"}],
+            "async/userrank/": [
+                {"name": "GET /async/userrank/?user", "method": "get", "params": {"user": user.username}},
+            ],
+        }
+
+    def handle(self, *args, **options):
+        if options["username"]:
+            user = User.objects.get(username=options["username"])
+        else:
+            user = User.objects.annotate(tests=Count("test")).order_by("-tests").first()
+        if user is None:
+            raise CommandError("no users to authenticate as; run seed_data first")
+
+        scenarios = self.scenarios(user)
+        routes = [str(pattern.pattern) for pattern in urls.urlpatterns]
+        missing = [route for route in routes if route not in scenarios]
+        if missing:
+            raise CommandError(f"no benchmark scenario for {', '.join(missing)}; add one to scenarios()")
+
+        client = Client(HTTP_HOST="localhost")
+        token = str(RefreshToken.for_user(user).access_token)
+        overrides = {}
+        if options["no_cache"]:
+            overrides["RESPONSE_CACHE"] = {"ENABLED": False}
+        if options["no_auth_cache"]:
+            overrides["AUTH_USER_CACHE"] = {"TTL": 0}
+        if not options["throttling"]:
+            overrides["THROTTLING"] = {**settings.THROTTLING, "ENABLED": False}
+
+        report = {
+            "commit": self.commit(),
+            "vendor": connection.vendor,
+            "user": user.username,
+            "requests": options["requests"],
+            "response_cache": not options["no_cache"],
+            "auth_user_cache": not options["no_auth_cache"],
+            "endpoints": {},
+        }
+        with override_settings(**overrides):
+            for route in routes:
+                for scenario in scenarios[route]:
+                    if options["only"] and not any(part in scenario["name"] for part in options["only"]):
+                        continue
+                    report["endpoints"][scenario["name"]] = self.run(client, route, scenario, token, options)
+
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, client, route, scenario, token, options):
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {token}"} if scenario.get("auth") else {}
+        method = getattr(client, scenario["method"])
+
+        def call(i):
+            if "data" in scenario:
+                return method(f"/{route}", json.dumps(scenario["data"](i)), content_type="application/json", **headers)
+            return method(f"/{route}", scenario.get("params", {}), **headers)
+
+        for i in range(options["warmup"]):
+            call(i)
+
+        timings, queries, statuses = [], 0, {}
+        started = time.perf_counter()
+        for i in range(options["requests"]):
+            with CaptureQueriesContext(connection) as captured:
+                request_started = time.perf_counter()
+                response = call(options["warmup"] + i)
+                timings.append((time.perf_counter() - request_started) * 1000)
+            queries += len(captured.captured_queries)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        elapsed = time.perf_counter() - started
+
+        return {
+            **summarize(timings),
+            "throughput_rps": round(len(timings) / elapsed, 1),
+            "queries_per_request": round(queries / len(timings), 2),
+            "statuses": statuses,
+        }
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
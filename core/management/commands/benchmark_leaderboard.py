@@ -0,0 +1,58 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core import leaderboard, seeding
+from core.benchmarking import summarize
+from core.models import Test
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed core_test with synthetic rows and time the global and filtered leaderboards. "
+        "Run it against a scratch database: seeding adds users and tests to whatever DATABASE_URL points at."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--users", type=int, default=10_000)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--skip-seed", action="store_true", help="reuse the rows already in the database")
+
+    def handle(self, *args, **options):
+        if not options["skip_seed"]:
+            if Test.objects.exists():
+                raise CommandError("core_test is not empty; use --skip-seed or point DATABASE_URL at a scratch database")
+            started = time.perf_counter()
+            seeding.seed(options["users"], options["rows"], seed=options["seed"], prefix="bench",
+                         batch_size=options["batch_size"])
+            self.stderr.write(f"seeded {options['rows']} tests in {time.perf_counter() - started:.1f}s")
+
+        boards = {
+            "global": {},
+            "time=60": {"time": 60},
+            "difficulty=3": {"difficulty": 3},
+            "time=60&difficulty=3": {"time": 60, "difficulty": 3},
+            "number=10&difficulty=5": {"number": 10, "difficulty": 5},
+            "mode=questions": {"mode": "questions"},
+        }
+        report = {"rows": Test.objects.count(), "vendor": connection.vendor, "boards": {}}
+        for name, filters in boards.items():
+            board = leaderboard.filtered_board(**filters) if filters else leaderboard.GLOBAL_BOARD
+            report["boards"][name] = {
+                "first_page": self.measure(lambda: leaderboard.cursor_page(50, None, board), options["repeat"]),
+                "count": self.measure(board.count, options["repeat"]),
+            }
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def measure(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return summarize(timings)
@@ -0,0 +1,56 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmarking import summarize
+from core.models import Test
+from core.serializers import TEST_ROWS, TestSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare TestSerializer with the precompiled TestRowSerializer on the same rows, "
+        "serialization alone and together with the query that loads the rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        limit = options["rows"]
+        tests = list(Test.objects.order_by("-id")[:limit])
+        if not tests:
+            raise CommandError("core_test is empty; run seed_data first")
+        values = list(Test.objects.order_by("-id").values_list(*TEST_ROWS.columns)[:limit])
+        if TestSerializer(tests, many=True).data != TEST_ROWS.many(values):
+            raise CommandError("TestRowSerializer output differs from TestSerializer")
+
+        cases = {
+            "serialize": {
+                "TestSerializer": lambda: TestSerializer(tests, many=True).data,
+                "TestRowSerializer": lambda: TEST_ROWS.many(values),
+            },
+            "query+serialize": {
+                "TestSerializer": lambda: TestSerializer(Test.objects.order_by("-id")[:limit], many=True).data,
+                "TestRowSerializer": lambda: TEST_ROWS.many(
+                    Test.objects.order_by("-id").values_list(*TEST_ROWS.columns)[:limit]
+                ),
+            },
+        }
+        report = {"rows": len(tests), "repeat": options["repeat"], "cases": {}}
+        for case, serializers in cases.items():
+            results = {name: self.measure(func, options["repeat"]) for name, func in serializers.items()}
+            results["speedup_p50"] = round(results["TestSerializer"]["p50_ms"] / results["TestRowSerializer"]["p50_ms"], 1)
+            report["cases"][case] = results
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def measure(self, func, repeat):
+        func()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return summarize(timings)
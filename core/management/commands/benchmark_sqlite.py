@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from core import ranking, sqlite
+from core.benchmarking import summarize
+
+
+# what Django and SQLite do out of the box: rollback journal, full sync, deferred transactions
+PROFILES = {
+    "default": {"JOURNAL_MODE": "delete", "SYNCHRONOUS": "full", "BUSY_TIMEOUT": None, "CACHE_SIZE": None,
+                "TRANSACTION_MODE": None},
+}
+
+
+def payload(i):
+    return {"qpm": 40 + i % 50, "raw": 50, "accuracy": 90, "mode": "time", "difficulty": 3, "number": 0, "time": 60000}
+
+
+class Role:
+    """Requests, failures and latencies of one kind of worker."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = []
+        self.lock_errors = 0
+        self.errors = 0
+
+    def record(self, elapsed_ms, ok, locked=False):
+        with self.lock:
+            self.timings.append(elapsed_ms)
+            if locked:
+                self.lock_errors += 1
+            elif not ok:
+                self.errors += 1
+
+    def report(self, seconds):
+        requests = len(self.timings)
+        return {
+            "requests": requests,
+            "throughput_rps": round(requests / seconds, 1),
+            "lock_errors": self.lock_errors,
+            "lock_error_rate": round(self.lock_errors / requests, 4) if requests else None,
+            "other_errors": self.errors,
+            **summarize(self.timings),
+        }
+
+
+class Command(BaseCommand):
+    help = (
+        "Run parallel submitTest writers and leaderboard/userrank readers against a SQLite database, "
+        "once with SQLite's defaults and once with settings.SQLITE, and report throughput and "
+        "'database is locked' rates. Writers insert tests, so use a seeded scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seconds", type=float, default=10, help="duration of each profile's run")
+        parser.add_argument("--writers", type=int, default=4)
+        parser.add_argument("--readers", type=int, default=8)
+        parser.add_argument("--profiles", nargs="+", default=["default", "configured"],
+                            help="'default' (SQLite's defaults) and/or 'configured' (settings.SQLITE)")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError(f"this benchmark is for SQLite, not {connection.vendor}")
+        users = list(User.objects.annotate(tests=Count("test")).order_by("-tests")[:options["writers"]])
+        if len(users) < options["writers"]:
+            raise CommandError("not enough users to write as; run seed_data first")
+        tokens = [str(RefreshToken.for_user(user).access_token) for user in users]
+        profiles = {**PROFILES, "configured": settings.SQLITE}
+        unknown = [name for name in options["profiles"] if name not in profiles]
+        if unknown:
+            raise CommandError(f"unknown profiles: {', '.join(unknown)}")
+
+        report = {"writers": options["writers"], "readers": options["readers"], "seconds": options["seconds"],
+                  "profiles": {}}
+        for name in options["profiles"]:
+            # the reads should reach the database, not the response cache, and the writers not the rate limits
+            with override_settings(SQLITE=profiles[name], RESPONSE_CACHE={"ENABLED": False},
+                                   THROTTLING={**settings.THROTTLING, "ENABLED": False}):
+                report["profiles"][name] = self.run(tokens, users, options)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def run(self, tokens, users, options):
+        # new connections pick up the profile's pragmas
+        connections.close_all()
+        ranking.index = ranking.RankingIndex()
+        pragmas = sqlite.current(connection)
+        connection.close()
+
+        writes, reads = Role(), Role()
+        deadline = time.monotonic() + options["seconds"]
+
+        def call(role, request):
+            started = time.perf_counter()
+            try:
+                response = request()
+            except OperationalError as error:
+                role.record((time.perf_counter() - started) * 1000, False, locked="locked" in str(error))
+            else:
+                role.record((time.perf_counter() - started) * 1000, response.status_code < 400)
+
+        def writer(token):
+            client = Client(HTTP_HOST="localhost", HTTP_AUTHORIZATION=f"Bearer {token}")
+            i = 0
+            try:
+                while time.monotonic() < deadline:
+                    call(writes, lambda: client.post("/test/", json.dumps(payload(i)), content_type="application/json"))
+                    i += 1
+            finally:
+                connection.close()
+
+        def reader(n):
+            client = Client(HTTP_HOST="localhost")
+            username = users[n % len(users)].username
+            i = 0
+            try:
+                while time.monotonic() < deadline:
+                    if i % 2:
+                        call(reads, lambda: client.get("/userrank/", {"user": username}))
+                    else:
+                        call(reads, lambda: client.get("/leaderboard/"))
+                    i += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer, args=(token,)) for token in tokens]
+        threads += [threading.Thread(target=reader, args=(n,)) for n in range(options["readers"])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return {"pragmas": pragmas, "writes": writes.report(elapsed), "reads": reads.report(elapsed)}
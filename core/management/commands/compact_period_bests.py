@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core import periods
+
+
+class Command(BaseCommand):
+    help = (
+        "Trim ended periods in core_periodbest: recent periods are kept whole, older ones "
+        "keep only their top rows. Run it daily (e.g. from cron)."
+    )
+
+    def add_arguments(self, parser):
+        for window, count in periods.RETENTION.items():
+            parser.add_argument(f"--keep-{window}s", type=int, default=count,
+                                help=f"{window} periods kept whole (default {count})")
+        parser.add_argument("--keep-top", type=int, default=periods.KEEP_TOP,
+                            help="rows kept of each older period; 0 deletes them entirely")
+        parser.add_argument("--rebuild", action="store_true",
+                            help="recompute the retained periods from core_test first")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        retention = {window: options[f"keep_{window}s"] for window in periods.WINDOWS}
+        with transaction.atomic():
+            if options["rebuild"]:
+                rebuilt = periods.rebuild(batch_size=options["batch_size"])
+                self.stdout.write(f"Rebuilt {rebuilt} period best rows")
+            deleted = periods.compact(retention, keep_top=options["keep_top"])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} period best rows; remaining {periods.counts()}"))
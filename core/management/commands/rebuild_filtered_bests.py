@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core import leaderboard
+
+
+class Command(BaseCommand):
+    help = "Rebuild the filtered leaderboards' best table (core_filteredbest) from core_test"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = leaderboard.rebuild_filtered(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} filtered best rows"))
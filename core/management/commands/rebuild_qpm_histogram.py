@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core import histogram
+
+
+class Command(BaseCommand):
+    help = "Rebuild the best qpm histogram (core_qpmbest, core_qpmbucket) from core_test"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = histogram.rebuild(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the qpm histogram for {count} users"))
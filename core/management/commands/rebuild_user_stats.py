@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core import profiles, streaks
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-user streak stats (core_userstats) from core_test"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = streaks.rebuild(batch_size=options["batch_size"])
+            profiles.bump_all()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} user stats rows"))
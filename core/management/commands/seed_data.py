@@ -0,0 +1,39 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core import seeding
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-seed a deterministic synthetic dataset (users, settings, tests, derived tables). "
+        f"Every seeded user has the password {seeding.PASSWORD!r}. Use a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--tests", type=int, default=100_000)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--days", type=int, default=365, help="spread test dates over this many days")
+        parser.add_argument("--prefix", default="seed", help="username prefix of the seeded users")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--replace", action="store_true", help="delete users with the prefix first")
+
+    def handle(self, *args, **options):
+        existing = User.objects.filter(username__startswith=options["prefix"])
+        if existing.exists():
+            if not options["replace"]:
+                raise CommandError(f"users named {options['prefix']}* already exist; pass --replace to reseed")
+            existing.delete()
+
+        started = time.perf_counter()
+        seeding.seed(
+            options["users"], options["tests"], seed=options["seed"], days=options["days"],
+            prefix=options["prefix"], batch_size=options["batch_size"],
+            log=lambda line: self.stderr.write(line) if options["verbosity"] > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {options['users']} users and {options['tests']} tests in {time.perf_counter() - started:.1f}s"
+        ))
@@ -0,0 +1,473 @@
+"""Request metrics in the Prometheus text format.
+
+MetricsMiddleware records, per route, a latency histogram, a status counter,
+the number of queries and the time spent in the database. Each thread writes
+to its own shard, so recording takes no lock; shards are only merged when the
+metrics are read.
+
+Every worker process has its own registry. When METRICS["DIR"] is set, each
+process periodically dumps its snapshot to ``<DIR>/metrics-<pid>.json`` and a
+scrape of /metrics merges all files, so any worker can answer for the whole
+server. Files of exited workers are folded into an aggregate file (see
+FileStore), so counters never go backwards and their gauges stop counting.
+/metrics is not public: see allowed().
+
+Other modules add their own numbers with register_collector(): a collector
+returns ``(name, labels, value)`` samples for metrics declared in METRICS.
+"""
+import atexit
+import glob
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import authentication, cache, ingest, profiling, routing, throttling
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+METRICS = {
+    "brainsmath_requests_total": ("counter", "Requests handled, by route, method and status."),
+    "brainsmath_request_duration_seconds": ("histogram", "Request latency, by route and method."),
+    "brainsmath_db_queries_total": ("counter", "Database queries run while handling requests, by route."),
+    "brainsmath_db_query_duration_seconds": ("histogram", "Time spent in the database per request, by route."),
+    "brainsmath_response_cache_requests_total": ("counter", "Response cache lookups, by namespace and result."),
+    "brainsmath_write_behind_items_total": ("counter", "Write-behind submissions, by outcome."),
+    "brainsmath_write_behind_depth": ("gauge", "Submissions waiting in the write-behind queue."),
+    "brainsmath_write_behind_retries_total": ("counter", "Write-behind flushes retried after a failure."),
+    "brainsmath_profiles_dropped_total": ("counter", "Request profiles dropped because the buffer was full."),
+    "brainsmath_auth_user_cache_requests_total": ("counter", "Authenticated user lookups, by cache result."),
+    "brainsmath_throttle_requests_total": ("counter", "Throttled endpoint requests, by scope and decision."),
+    "brainsmath_admission_rejected_total": ("counter", "Requests shed with a 503 by the concurrency limit, by limit."),
+    "brainsmath_admission_in_flight": ("gauge", "Requests holding a concurrency slot, by limit."),
+}
+
+
+def _setting(name, default):
+    return getattr(settings, "METRICS", {}).get(name, default)
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    rendered = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in sorted(labels.items())
+    )
+    return f"{name}{{{rendered}}}"
+
+
+class Registry:
+    """Per-process counters and histograms, sharded by thread."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._collectors = []
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {"counters": {}, "histograms": {}}
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=None, by=1):
+        counters = self._shard()["counters"]
+        key = _series(name, labels)
+        counters[key] = counters.get(key, 0) + by
+
+    def observe(self, name, labels, value):
+        histograms = self._shard()["histograms"]
+        key = _series(name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            # one slot per bucket, then +Inf, sum and count
+            histogram = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(self.buckets)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        """Merge every thread's shard and the collectors into one JSON-friendly dict."""
+        with self._shards_lock:
+            shards = list(self._shards)
+        merged = {"buckets": list(self.buckets), "counters": {}, "gauges": {}, "histograms": {}}
+        for shard in shards:
+            for key, value in list(shard["counters"].items()):
+                merged["counters"][key] = merged["counters"].get(key, 0) + value
+            for key, histogram in list(shard["histograms"].items()):
+                _add_histogram(merged["histograms"], key, list(histogram))
+
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception:
+                logger.exception("Metrics collector %r failed", collector)
+                continue
+            for name, labels, value in samples:
+                kind = "gauges" if METRICS[name][0] == "gauge" else "counters"
+                key = _series(name, labels)
+                merged[kind][key] = merged[kind].get(key, 0) + value
+        return merged
+
+    def reset(self):
+        with self._shards_lock:
+            for shard in self._shards:
+                shard["counters"].clear()
+                shard["histograms"].clear()
+
+
+def _add_histogram(histograms, key, histogram):
+    current = histograms.get(key)
+    if current is None:
+        histograms[key] = histogram
+    else:
+        histograms[key] = [a + b for a, b in zip(current, histogram)]
+
+
+def merge(snapshots):
+    """Sum snapshots from several processes."""
+    merged = {"buckets": list(LATENCY_BUCKETS), "counters": {}, "gauges": {}, "histograms": {}}
+    for snapshot in snapshots:
+        merged["buckets"] = snapshot.get("buckets", merged["buckets"])
+        for kind in ("counters", "gauges"):
+            for key, value in snapshot.get(kind, {}).items():
+                merged[kind][key] = merged[kind].get(key, 0) + value
+        for key, histogram in snapshot.get("histograms", {}).items():
+            _add_histogram(merged["histograms"], key, histogram)
+    return merged
+
+
+def render(snapshot):
+    """Format a snapshot as Prometheus text exposition."""
+    buckets = snapshot["buckets"]
+    by_name = {}
+    for kind in ("counters", "gauges", "histograms"):
+        for key, value in snapshot[kind].items():
+            by_name.setdefault(key.split("{", 1)[0], []).append((key, value))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text = METRICS.get(name, ("untyped", ""))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key, value in sorted(by_name[name]):
+            if kind != "histogram":
+                lines.append(f"{key} {value}")
+                continue
+            labels = key[len(name) + 1:-1] if "{" in key else ""
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], value[:-2]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {value[-2]}")
+            lines.append(f"{name}_count{suffix} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry(_setting("LATENCY_BUCKETS", LATENCY_BUCKETS))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_process = (None, None)
+
+
+def process_token():
+    """Tells this process from an earlier one with the same pid (forked workers get their own)."""
+    global _process
+    if _process[0] != os.getpid():
+        _process = (os.getpid(), uuid.uuid4().hex)
+    return _process[1]
+
+
+class FileStore:
+    """Shares snapshots between worker processes through one JSON file per pid.
+
+    Files of workers that have exited are retired the way prometheus_client's
+    multiprocess mode does it: their counters and histograms are folded into
+    metrics-aggregate.json, so totals never go backwards, their gauges are
+    dropped, and the file is removed. A worker that reuses a dead worker's pid
+    retires the old file before writing its own. Every reader and writer holds
+    an flock on the directory, so a file is never folded twice.
+    """
+
+    AGGREGATE = "metrics-aggregate.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._written_at = None
+
+    def path(self, pid=None):
+        return os.path.join(self.directory, f"metrics-{pid or os.getpid()}.json")
+
+    @contextmanager
+    def _locked(self):
+        # POSIX only, like the multi-worker servers that set METRICS["DIR"]
+        import fcntl
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            descriptor = os.open(self.directory, os.O_RDONLY)
+            try:
+                fcntl.flock(descriptor, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(descriptor)
+
+    def _load(self, path):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.warning("Skipping unreadable metrics file %s", path)
+            return None
+
+    def _dump(self, path, snapshot):
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(snapshot, file)
+        os.replace(temporary, path)
+
+    def _retire(self, path, snapshot):
+        """Fold a finished worker's counters and histograms into the aggregate file and remove its file."""
+        aggregate = os.path.join(self.directory, self.AGGREGATE)
+        folded = merge([self._load(aggregate) or {}, {**snapshot, "gauges": {}}])
+        self._dump(aggregate, folded)
+        os.remove(path)
+
+    def write(self, snapshot):
+        with self._locked():
+            path = self.path()
+            previous = self._load(path)
+            if previous is not None and previous.get("process") != process_token():
+                # an exited worker had this pid
+                self._retire(path, previous)
+            self._dump(path, {**snapshot, "process": process_token()})
+            self._written_at = time.monotonic()
+
+    def due(self, interval):
+        return self._written_at is None or time.monotonic() - self._written_at >= interval
+
+    def read_all(self):
+        """Snapshots of the live workers plus the aggregate of the exited ones."""
+        snapshots = []
+        with self._locked():
+            for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+                name = os.path.basename(path)
+                if name == self.AGGREGATE:
+                    continue
+                snapshot = self._load(path)
+                if snapshot is None:
+                    continue
+                try:
+                    pid = int(name[len("metrics-"):-len(".json")])
+                except ValueError:
+                    continue
+                if pid != os.getpid() and not _alive(pid):
+                    self._retire(path, snapshot)
+                    continue
+                snapshots.append(snapshot)
+            aggregate = self._load(os.path.join(self.directory, self.AGGREGATE))
+        if aggregate is not None:
+            snapshots.append(aggregate)
+        return snapshots
+
+
+_stores = {}
+
+
+def store():
+    """The FileStore for METRICS["DIR"], or None when metrics stay per process."""
+    directory = _setting("DIR", None)
+    if not directory:
+        return None
+    if directory not in _stores:
+        _stores[directory] = FileStore(directory)
+    return _stores[directory]
+
+
+def collect():
+    """Snapshot for the whole server: this process, plus every other worker when DIR is set."""
+    snapshot = registry.snapshot()
+    shared = store()
+    if shared is None:
+        return snapshot
+    shared.write(snapshot)
+    return merge(shared.read_all())
+
+
+def flush():
+    shared = store()
+    if shared is not None:
+        shared.write(registry.snapshot())
+
+
+atexit.register(flush)
+
+
+def allowed(request):
+    """A scrape carrying METRICS["TOKEN"] as its bearer token, or a staff member's admin session."""
+    token = _setting("TOKEN", None)
+    if token and hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+        return True
+    user = getattr(request, "user", None)
+    return user is not None and user.is_staff
+
+
+def metrics(request):
+    if not allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(collect()), content_type=CONTENT_TYPE)
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Sync or async, whichever the rest of the chain is, so ASGI requests stay on the event loop."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not _setting("ENABLED", True):
+            return self.get_response(request)
+
+        queries = QueryCounter()
+        started = time.perf_counter()
+        with routing.execute_wrapper(queries):
+            response = self.get_response(request)
+        self.record(request, response, queries, time.perf_counter() - started)
+
+        shared = store()
+        if shared is not None and shared.due(_setting("WRITE_INTERVAL", 5)):
+            self.write(shared)
+        return response
+
+    async def __acall__(self, request):
+        if not _setting("ENABLED", True):
+            return await self.get_response(request)
+
+        queries = QueryCounter()
+        started = time.perf_counter()
+        with routing.execute_wrapper(queries):
+            response = await self.get_response(request)
+        self.record(request, response, queries, time.perf_counter() - started)
+
+        shared = store()
+        if shared is not None and shared.due(_setting("WRITE_INTERVAL", 5)):
+            await sync_to_async(self.write, thread_sensitive=False)(shared)
+        return response
+
+    def record(self, request, response, queries, elapsed):
+        match = getattr(request, "resolver_match", None)
+        # unmatched paths share one label so scanners can't blow up the series count
+        route = "/" + match.route if match else "<unmatched>"
+        registry.inc("brainsmath_requests_total",
+                     {"route": route, "method": request.method, "status": response.status_code})
+        registry.observe("brainsmath_request_duration_seconds", {"route": route, "method": request.method}, elapsed)
+        registry.inc("brainsmath_db_queries_total", {"route": route}, queries.count)
+        registry.observe("brainsmath_db_query_duration_seconds", {"route": route}, queries.seconds)
+
+    def write(self, shared):
+        try:
+            shared.write(registry.snapshot())
+        except OSError:
+            logger.warning("Could not write metrics to %s", shared.directory, exc_info=True)
+
+
+def _cache_samples():
+    for namespace, counts in cache.stats.snapshot().items():
+        yield "brainsmath_response_cache_requests_total", {"namespace": namespace, "result": "hit"}, counts["hits"]
+        yield "brainsmath_response_cache_requests_total", {"namespace": namespace, "result": "miss"}, counts["misses"]
+
+
+def _write_behind_samples():
+    stats = ingest.writer.stats()
+    for outcome in ("enqueued", "rejected", "flushed", "failed"):
+        yield "brainsmath_write_behind_items_total", {"outcome": outcome}, stats[outcome]
+    yield "brainsmath_write_behind_depth", None, stats["depth"]
+    yield "brainsmath_write_behind_retries_total", None, stats["retries"]
+
+
+def _profiling_samples():
+    yield "brainsmath_profiles_dropped_total", None, profiling.buffer.dropped
+
+
+def _auth_samples():
+    yield "brainsmath_auth_user_cache_requests_total", {"result": "hit"}, authentication.user_cache.hits
+    yield "brainsmath_auth_user_cache_requests_total", {"result": "miss"}, authentication.user_cache.misses
+
+
+def _throttle_samples():
+    for (scope, result), count in list(throttling.stats.throttle.items()):
+        yield "brainsmath_throttle_requests_total", {"scope": scope, "result": result}, count
+    for limit, count in list(throttling.stats.rejected.items()):
+        yield "brainsmath_admission_rejected_total", {"limit": limit}, count
+    for limit, count in list(throttling.limiter.in_flight.items()):
+        yield "brainsmath_admission_in_flight", {"limit": limit}, count
+
+
+registry.register_collector(_cache_samples)
+registry.register_collector(_write_behind_samples)
+registry.register_collector(_profiling_samples)
+registry.register_collector(_auth_samples)
+registry.register_collector(_throttle_samples)
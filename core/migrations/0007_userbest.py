@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-18 10:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('core', '0006_alter_test_qpm_alter_test_raw'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserBest',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='best', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('username', models.CharField(max_length=150)),
+                ('qpm', models.FloatField()),
+                ('raw', models.FloatField()),
+                ('accuracy', models.SmallIntegerField()),
+                ('mode', models.CharField(choices=[('questions', 'questions'), ('time', 'time')], max_length=10)),
+                ('difficulty', models.SmallIntegerField()),
+                ('creation', models.DateTimeField()),
+                ('number', models.IntegerField()),
+                ('time', models.IntegerField()),
+                ('test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.test')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-qpm', 'test'], name='userbest_rank_idx'), models.Index(fields=['username'], name='userbest_username_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 10:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_counter_userbest_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='test',
+            index=models.Index(fields=['mode', 'time', 'difficulty', 'user', '-qpm'], name='test_mode_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='test',
+            index=models.Index(fields=['mode', 'number', 'difficulty', 'user', '-qpm'], name='test_mode_number_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_userstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('view', models.CharField(blank=True, max_length=255)),
+                ('method', models.CharField(max_length=10)),
+                ('status_code', models.SmallIntegerField()),
+                ('reason', models.CharField(choices=[('sampled', 'sampled'), ('slow', 'slow')], max_length=10)),
+                ('started_at', models.DateTimeField()),
+                ('duration_ms', models.FloatField()),
+                ('query_count', models.IntegerField()),
+                ('query_time_ms', models.FloatField()),
+                ('queries', models.JSONField(default=list)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['path', '-started_at'], name='profile_path_idx')],
+            },
+        ),
+    ]
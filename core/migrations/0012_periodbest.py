@@ -0,0 +1,39 @@
+# Generated by Django 5.2 on 2026-10-18 11:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_requestprofile'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeriodBest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'day'), ('week', 'week'), ('month', 'month')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('username', models.CharField(max_length=150)),
+                ('qpm', models.FloatField()),
+                ('raw', models.FloatField()),
+                ('accuracy', models.SmallIntegerField()),
+                ('mode', models.CharField(choices=[('questions', 'questions'), ('time', 'time')], max_length=10)),
+                ('difficulty', models.SmallIntegerField()),
+                ('creation', models.DateTimeField()),
+                ('number', models.IntegerField()),
+                ('time', models.IntegerField()),
+                ('test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.test')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['period', 'period_start', '-qpm', 'test'], name='periodbest_rank_idx')],
+                'constraints': [models.UniqueConstraint(fields=('period', 'period_start', 'user'), name='periodbest_user_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+
+COPIED_FIELDS = ("qpm", "raw", "accuracy", "mode", "difficulty", "creation", "number", "time")
+
+
+def backfill(apps, schema_editor):
+    """Fill core_userbest from core_test, like leaderboard.rebuild() with the historical models.
+
+    Without it the board starts empty, and a user's next submission would
+    become their best even when an older test was better.
+    """
+    Test = apps.get_model("core", "Test")
+    UserBest = apps.get_model("core", "UserBest")
+    Counter = apps.get_model("core", "Counter")
+
+    best_tests = (
+        Test.objects
+        .annotate(position=Window(
+            RowNumber(),
+            partition_by=[F("user_id")],
+            order_by=[F("qpm").desc(), F("id").asc()],
+        ))
+        .filter(position=1)
+        .select_related("user")
+    )
+    counter, _ = Counter.objects.get_or_create(key="leaderboard")
+    counter.value += 1
+    counter.save()
+    rows = [
+        UserBest(user_id=test.user_id, test_id=test.id, username=test.user.username, version=counter.value,
+                 **{field: getattr(test, field) for field in COPIED_FIELDS})
+        for test in best_tests.iterator(chunk_size=1000)
+    ]
+    UserBest.objects.all().delete()
+    UserBest.objects.bulk_create(rows, batch_size=1000)
+    Counter.objects.update_or_create(key="leaderboard:users", defaults={"value": len(rows)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_test_user_creation_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from django.db import migrations
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber, TruncDay, TruncMonth, TruncWeek
+from django.utils import timezone
+
+
+COPIED_FIELDS = ("qpm", "raw", "accuracy", "mode", "difficulty", "creation", "number", "time")
+TRUNCATE = {"day": TruncDay, "week": TruncWeek, "month": TruncMonth}
+
+
+def _since(window, today):
+    """Start of the oldest period periods.rebuild() keeps in full: 7 days, 8 weeks, 12 months back."""
+    if window == "day":
+        return today - timedelta(days=7)
+    if window == "week":
+        return today - timedelta(days=today.weekday(), weeks=8)
+    months = today.year * 12 + today.month - 1 - 12
+    return today.replace(year=months // 12, month=months % 12 + 1, day=1)
+
+
+def backfill(apps, schema_editor):
+    """Fill core_periodbest from core_test, like periods.rebuild() with the historical models.
+
+    Without it the current day, week and month boards start empty and a
+    user's next submission would become their best of the period even when
+    an earlier test in it was better.
+    """
+    Test = apps.get_model("core", "Test")
+    PeriodBest = apps.get_model("core", "PeriodBest")
+    Counter = apps.get_model("core", "Counter")
+
+    today = timezone.localdate()
+    rows = []
+    for window, truncate in TRUNCATE.items():
+        best_tests = (
+            Test.objects
+            .filter(creation__date__gte=_since(window, today))
+            .annotate(
+                start=truncate("creation"),
+                position=Window(
+                    RowNumber(),
+                    partition_by=[F("user_id"), truncate("creation")],
+                    order_by=[F("qpm").desc(), F("id").asc()],
+                ),
+            )
+            .filter(position=1)
+            .select_related("user")
+        )
+        for test in best_tests.iterator(chunk_size=1000):
+            start = test.start.date() if hasattr(test.start, "date") else test.start
+            rows.append(PeriodBest(
+                period=window, period_start=start, user_id=test.user_id, test_id=test.id,
+                username=test.user.username, **{field: getattr(test, field) for field in COPIED_FIELDS},
+            ))
+
+    PeriodBest.objects.all().delete()
+    PeriodBest.objects.bulk_create(rows, batch_size=1000)
+    counter, _ = Counter.objects.get_or_create(key="leaderboard:periods")
+    counter.value += 1
+    counter.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_test_difficulty_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+from collections import defaultdict
+
+from django.db import migrations
+from django.db.models import Max
+
+
+BUCKET_WIDTH = 5
+BUCKET_COUNT = 60
+
+
+def _scopes(mode, difficulty):
+    return ("*:*", f"{mode}:*", f"*:{difficulty}", f"{mode}:{difficulty}")
+
+
+def backfill(apps, schema_editor):
+    """Fill core_qpmbest and core_qpmbucket from core_test, like histogram.rebuild() with the historical models.
+
+    Without it /percentile/ starts with an empty distribution and a user's
+    next submission would become their best even when an older test was
+    better.
+    """
+    Test = apps.get_model("core", "Test")
+    QpmBest = apps.get_model("core", "QpmBest")
+    QpmBucket = apps.get_model("core", "QpmBucket")
+    Counter = apps.get_model("core", "Counter")
+
+    bests = {}
+    rows = Test.objects.order_by().values_list("user_id", "mode", "difficulty").annotate(best=Max("qpm"))
+    for user_id, mode, difficulty, qpm in rows.iterator(chunk_size=1000):
+        for scope in _scopes(mode, difficulty):
+            key = (user_id, scope)
+            bests[key] = max(bests.get(key, qpm), qpm)
+
+    counts = defaultdict(int)
+    for (_, scope), qpm in bests.items():
+        counts[(scope, max(0, min(int(qpm // BUCKET_WIDTH), BUCKET_COUNT - 1)))] += 1
+
+    QpmBest.objects.all().delete()
+    QpmBucket.objects.all().delete()
+    QpmBest.objects.bulk_create(
+        [QpmBest(user_id=user_id, scope=scope, qpm=qpm) for (user_id, scope), qpm in bests.items()],
+        batch_size=1000,
+    )
+    QpmBucket.objects.bulk_create(
+        [QpmBucket(scope=scope, bucket=bucket, users=users) for (scope, bucket), users in counts.items()],
+        batch_size=1000,
+    )
+    counter, _ = Counter.objects.get_or_create(key="histogram")
+    counter.value += 1
+    counter.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_backfill_periodbest'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
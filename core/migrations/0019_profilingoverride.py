@@ -0,0 +1,22 @@
+# Generated by Django 5.2 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_backfill_qpm_histogram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfilingOverride',
+            fields=[
+                ('path', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('enabled', models.BooleanField(null=True)),
+                ('sample_rate', models.FloatField(null=True)),
+                ('slow_ms', models.FloatField(null=True)),
+            ],
+        ),
+    ]
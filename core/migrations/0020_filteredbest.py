@@ -0,0 +1,54 @@
+# Generated by Django 5.2 on 2026-10-18 13:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_profilingoverride'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilteredBest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=32)),
+                ('username', models.CharField(max_length=150)),
+                ('qpm', models.FloatField()),
+                ('raw', models.FloatField()),
+                ('accuracy', models.SmallIntegerField()),
+                ('mode', models.CharField(choices=[('questions', 'questions'), ('time', 'time')], max_length=10)),
+                ('difficulty', models.SmallIntegerField()),
+                ('creation', models.DateTimeField()),
+                ('number', models.IntegerField()),
+                ('time', models.IntegerField()),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='test',
+            name='test_difficulty_idx',
+        ),
+        migrations.AddField(
+            model_name='filteredbest',
+            name='test',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.test'),
+        ),
+        migrations.AddField(
+            model_name='filteredbest',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='filteredbest',
+            index=models.Index(fields=['scope', '-qpm', 'test'], name='filteredbest_rank_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='filteredbest',
+            constraint=models.UniqueConstraint(fields=('user', 'scope'), name='filteredbest_user_unique'),
+        ),
+    ]
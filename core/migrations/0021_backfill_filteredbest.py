@@ -0,0 +1,70 @@
+from django.db import migrations
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+
+COPIED_FIELDS = ("qpm", "raw", "accuracy", "mode", "difficulty", "creation", "number", "time")
+
+
+def _scopes(mode, time, number, difficulty):
+    length = time if mode == "time" else number
+    return (
+        f"*:*:{difficulty}",
+        f"{mode}:*:*",
+        f"{mode}:*:{difficulty}",
+        f"{mode}:{length}:*",
+        f"{mode}:{length}:{difficulty}",
+    )
+
+
+def backfill(apps, schema_editor):
+    """Fill core_filteredbest from core_test, like leaderboard.rebuild_filtered() with the historical models.
+
+    Without it every filtered board starts empty and a user's next submission
+    would become their best in its scopes even when an older test was better.
+    """
+    Test = apps.get_model("core", "Test")
+    FilteredBest = apps.get_model("core", "FilteredBest")
+    Counter = apps.get_model("core", "Counter")
+
+    bucket_bests = (
+        Test.objects
+        .annotate(position=Window(
+            RowNumber(),
+            partition_by=[F("user_id"), F("mode"), F("time"), F("number"), F("difficulty")],
+            order_by=[F("qpm").desc(), F("id").asc()],
+        ))
+        .filter(position=1)
+        .values_list("id", "user_id", "user__username", *COPIED_FIELDS)
+    )
+    best = {}
+    for row in bucket_bests.iterator(chunk_size=1000):
+        values = dict(zip(COPIED_FIELDS, row[3:]))
+        for scope in _scopes(values["mode"], values["time"], values["number"], values["difficulty"]):
+            key = (row[1], scope)
+            current = best.get(key)
+            if current is None or (values["qpm"], -row[0]) > (current[3], -current[0]):
+                best[key] = row
+
+    FilteredBest.objects.all().delete()
+    FilteredBest.objects.bulk_create(
+        [FilteredBest(user_id=user_id, scope=scope, test_id=row[0], username=row[2],
+                      **dict(zip(COPIED_FIELDS, row[3:])))
+         for (user_id, scope), row in best.items()],
+        batch_size=1000,
+    )
+    for scope in {scope for _, scope in best}:
+        counter, _ = Counter.objects.get_or_create(key=f"leaderboard:filtered:{scope}")
+        counter.value += 1
+        counter.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_filteredbest'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
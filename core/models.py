@@ -1,4 +1,6 @@
+from datetime import timedelta
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
 
 class Test(models.Model):
@@ -20,6 +22,15 @@ class Test(models.Model):
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    class Meta:
+        # back the per-bucket bests read by core.leaderboard.rebuild_filtered and
+        # the history pages in core.history
+        indexes = [
+            models.Index(fields=["mode", "time", "difficulty", "user", "-qpm"], name="test_mode_time_idx"),
+            models.Index(fields=["mode", "number", "difficulty", "user", "-qpm"], name="test_mode_number_idx"),
+            models.Index(fields=["user", "creation", "id"], name="test_user_creation_idx"),
+        ]
+
     def __str__(self):
         return str(self.qpm)
 
@@ -31,3 +42,250 @@ class Settings(models.Model):
     def __str__(self):
         return str(self.theme)
 
+
+class UserBest(models.Model):
+    # denormalized copy of each user's best test, kept up to date by submitTest
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="best")
+    test = models.ForeignKey(Test, on_delete=models.CASCADE, related_name="+")
+    username = models.CharField(max_length=150)
+    qpm = models.FloatField()
+    raw = models.FloatField()
+    accuracy = models.SmallIntegerField()
+    mode = models.CharField(max_length=10 , choices=Test.mode_choices)
+    difficulty = models.SmallIntegerField()
+    creation = models.DateTimeField()
+    number = models.IntegerField()
+    time = models.IntegerField() # in ms
+    version = models.BigIntegerField(default=0) # Counter "leaderboard" value when this row last changed
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["version"], name="userbest_version_idx"),
+            models.Index(fields=["-qpm", "test"], name="userbest_rank_idx"),
+            models.Index(fields=["username"], name="userbest_username_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.username}: {self.qpm}"
+
+    def copy_from(self, test, username):
+        self.test = test
+        self.username = username
+        for field in ("qpm", "raw", "accuracy", "mode", "difficulty", "creation", "number", "time"):
+            setattr(self, field, getattr(test, field))
+
+
+class FilteredBest(models.Model):
+    # each user's best test per filtered leaderboard, kept up to date by submitTest; scope is
+    # "mode:length:difficulty" with * for an unfiltered part (see core.leaderboard.scopes_of)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    scope = models.CharField(max_length=32)
+    test = models.ForeignKey(Test, on_delete=models.CASCADE, related_name="+")
+    username = models.CharField(max_length=150)
+    qpm = models.FloatField()
+    raw = models.FloatField()
+    accuracy = models.SmallIntegerField()
+    mode = models.CharField(max_length=10 , choices=Test.mode_choices)
+    difficulty = models.SmallIntegerField()
+    creation = models.DateTimeField()
+    number = models.IntegerField()
+    time = models.IntegerField() # in ms
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "scope"], name="filteredbest_user_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["scope", "-qpm", "test"], name="filteredbest_rank_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.username}: {self.qpm}"
+
+    def copy_from(self, test, username):
+        self.test = test
+        self.username = username
+        for field in ("qpm", "raw", "accuracy", "mode", "difficulty", "creation", "number", "time"):
+            setattr(self, field, getattr(test, field))
+
+
+class PeriodBest(models.Model):
+    # each user's best test per day, week and month, kept up to date by submitTest;
+    # old periods are trimmed by the compact_period_bests command
+    period_choices = (
+        ('day', 'day'),
+        ('week', 'week'),
+        ('month', 'month'),
+    )
+
+    period = models.CharField(max_length=5, choices=period_choices)
+    period_start = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    test = models.ForeignKey(Test, on_delete=models.CASCADE, related_name="+")
+    username = models.CharField(max_length=150)
+    qpm = models.FloatField()
+    raw = models.FloatField()
+    accuracy = models.SmallIntegerField()
+    mode = models.CharField(max_length=10 , choices=Test.mode_choices)
+    difficulty = models.SmallIntegerField()
+    creation = models.DateTimeField()
+    number = models.IntegerField()
+    time = models.IntegerField() # in ms
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["period", "period_start", "user"], name="periodbest_user_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["period", "period_start", "-qpm", "test"], name="periodbest_rank_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.period_start} {self.username}: {self.qpm}"
+
+    def copy_from(self, test, username):
+        self.test = test
+        self.username = username
+        for field in ("qpm", "raw", "accuracy", "mode", "difficulty", "creation", "number", "time"):
+            setattr(self, field, getattr(test, field))
+
+
+class QpmBest(models.Model):
+    # each user's best qpm per histogram scope ("*:*", "time:*", "*:3", "time:3"), kept by core.histogram
+    scope = models.CharField(max_length=20)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    qpm = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "scope"], name="qpmbest_user_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.user_id}: {self.qpm}"
+
+
+class QpmBucket(models.Model):
+    # number of users whose best qpm in ``scope`` falls in bucket ``bucket`` (see core.histogram)
+    scope = models.CharField(max_length=20)
+    bucket = models.SmallIntegerField()
+    users = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "bucket"], name="qpmbucket_scope_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} #{self.bucket}: {self.users}"
+
+
+class Counter(models.Model):
+    # named, monotonically increasing counters used as cheap version stamps
+    key = models.CharField(max_length=64, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.key}={self.value}"
+
+    @classmethod
+    def get(cls, key):
+        return cls.objects.filter(key=key).values_list("value", flat=True).first() or 0
+
+    @classmethod
+    async def aget(cls, key):
+        return await cls.objects.filter(key=key).values_list("value", flat=True).afirst() or 0
+
+    @classmethod
+    def increment(cls, key, by=1):
+        """bump() for callers that don't need the new value: usually a single UPDATE."""
+        if not cls.objects.filter(key=key).update(value=F("value") + by):
+            cls.bump(key, by)
+
+    @classmethod
+    def increment_all(cls, keys, by=1):
+        """increment() for several keys: one UPDATE once they all exist."""
+        keys = set(keys)
+        if cls.objects.filter(key__in=keys).update(value=F("value") + by) < len(keys):
+            # a key created concurrently since the UPDATE has moved from 0 already
+            for key in keys - set(cls.objects.filter(key__in=keys).values_list("key", flat=True)):
+                cls.bump(key, by)
+
+    @classmethod
+    def bump(cls, key, by=1):
+        """Increment ``key`` and return its new value. Call inside a transaction."""
+        if not cls.objects.filter(key=key).update(value=F("value") + by):
+            counter, created = cls.objects.get_or_create(key=key, defaults={"value": by})
+            if created:
+                return counter.value
+            cls.objects.filter(key=key).update(value=F("value") + by)
+        return cls.get(key)
+
+
+class UserStats(models.Model):
+    # per-user activity summary, advanced by submitTest instead of recomputed from history
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="stats")
+    last_active = models.DateField(null=True, blank=True)
+    current_streak = models.PositiveIntegerField(default=0)
+    longest_streak = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.current_streak}/{self.longest_streak}"
+
+    def advance(self, day):
+        """Count a test played on ``day``. Returns False if nothing changed.
+
+        Days older than ``last_active`` are ignored; rebuild_user_stats fixes
+        those up from history.
+        """
+        if self.last_active is not None and day <= self.last_active:
+            return False
+        if self.last_active is not None and day == self.last_active + timedelta(days=1):
+            self.current_streak += 1
+        else:
+            self.current_streak = 1
+        self.last_active = day
+        self.longest_streak = max(self.longest_streak, self.current_streak)
+        return True
+
+    @classmethod
+    def from_dates(cls, dates, **kwargs):
+        stats = cls(**kwargs)
+        for day in sorted(dates):
+            stats.advance(day)
+        return stats
+
+class RequestProfile(models.Model):
+    # sampled request profiles written in batches by core.profiling
+    reason_choices = (
+        ('sampled', 'sampled'),
+        ('slow', 'slow'),
+    )
+
+    path = models.CharField(max_length=255)
+    view = models.CharField(max_length=255, blank=True)
+    method = models.CharField(max_length=10)
+    status_code = models.SmallIntegerField()
+    reason = models.CharField(max_length=10, choices=reason_choices)
+    started_at = models.DateTimeField()
+    duration_ms = models.FloatField()
+    query_count = models.IntegerField()
+    query_time_ms = models.FloatField()
+    queries = models.JSONField(default=list) # slowest queries as {"sql": ..., "ms": ...}
+
+    class Meta:
+        indexes = [models.Index(fields=["path", "-started_at"], name="profile_path_idx")]
+
+    def __str__(self):
+        return f"{self.method} {self.path} {self.duration_ms:.1f}ms"
+
+
+class ProfilingOverride(models.Model):
+    # runtime per-endpoint profiling settings set through PUT /profiling/; null keeps the configured value
+    path = models.CharField(max_length=255, primary_key=True)
+    enabled = models.BooleanField(null=True)
+    sample_rate = models.FloatField(null=True)
+    slow_ms = models.FloatField(null=True)
+
+    def __str__(self):
+        return self.path
@@ -0,0 +1,179 @@
+"""Daily, weekly and monthly leaderboards.
+
+core_periodbest holds each user's best test per period, so a windowed board
+is a range scan over one (period, period_start) slice of a small table rather
+than a best-per-user query over core_test. submitTest keeps the rows current;
+compact() trims periods that have ended so the table stays small.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Window
+from django.db.models.functions import RowNumber, TruncDay, TruncMonth, TruncWeek
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import Counter, PeriodBest, Test
+
+
+VERSION_KEY = "leaderboard:periods"
+WINDOWS = [choice for choice, _ in PeriodBest.period_choices]
+TRUNCATE = {"day": TruncDay, "week": TruncWeek, "month": TruncMonth}
+COPIED_FIELDS = ("test_id", "username", "qpm", "raw", "accuracy", "mode", "difficulty", "creation", "number", "time")
+
+# how many finished periods compact() keeps in full, and how many rows it keeps of older ones
+RETENTION = {"day": 7, "week": 8, "month": 12}
+KEEP_TOP = 100
+
+
+def period_start(window, day):
+    """First day of the ``window`` period containing ``day`` (weeks start on Monday)."""
+    if window == "day":
+        return day
+    if window == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def previous_start(window, start, count=1):
+    """Start of the period ``count`` periods before the one starting on ``start``."""
+    if window == "day":
+        return start - timedelta(days=count)
+    if window == "week":
+        return start - timedelta(weeks=count)
+    months = start.year * 12 + start.month - 1 - count
+    return start.replace(year=months // 12, month=months % 12 + 1)
+
+
+def parse_start(window, value=None):
+    """Period start for a ``date`` query parameter (any day in the period), defaulting to today."""
+    day = timezone.localdate()
+    if value:
+        day = parse_date(value) if isinstance(value, str) else value
+        if day is None:
+            raise ValueError("date must be YYYY-MM-DD.")
+    return period_start(window, day)
+
+
+def record_tests(tests):
+    """Fold freshly saved tests into the period rows of their users.
+
+    Must run inside the transaction that saved ``tests``. Reads every touched
+    row with one locking query and bumps the version once. Returns True when
+    any row changed.
+    """
+    candidates = {}
+    for test in tests:
+        day = timezone.localdate(test.creation)
+        for window in WINDOWS:
+            key = (window, period_start(window, day), test.user_id)
+            if key not in candidates or test.qpm > candidates[key].qpm:
+                candidates[key] = test
+    if not candidates:
+        return False
+
+    condition = Q()
+    for window, start, user_id in candidates:
+        condition |= Q(period=window, period_start=start, user_id=user_id)
+    existing = {
+        (row.period, row.period_start, row.user_id): row
+        for row in PeriodBest.objects.select_for_update().filter(condition)
+    }
+
+    created, updated = [], defaultdict(list)
+    for key, test in candidates.items():
+        row = existing.get(key)
+        if row is None:
+            row = PeriodBest(period=key[0], period_start=key[1], user_id=key[2])
+            row.copy_from(test, test.user.username)
+            created.append(row)
+        elif test.qpm > row.qpm:
+            updated[test].append(row.pk)
+
+    if not created and not updated:
+        return False
+    if created:
+        # the locking read can't lock rows that don't exist yet: when a concurrent
+        # submission inserts one first, start over, which now locks its committed row
+        try:
+            with transaction.atomic():
+                PeriodBest.objects.bulk_create(created)
+        except IntegrityError:
+            return record_tests(tests)
+    # a new personal best usually tops the day, week and month at once: one UPDATE for all three
+    for test, ids in updated.items():
+        row = PeriodBest()
+        row.copy_from(test, test.user.username)
+        PeriodBest.objects.filter(pk__in=ids).update(**{field: getattr(row, field) for field in COPIED_FIELDS})
+    Counter.increment(VERSION_KEY)
+    return True
+
+
+def best_tests(window, since):
+    """Each user's best test per ``window`` period, for tests created on or after ``since``."""
+    truncate = TRUNCATE[window]
+    return (
+        Test.objects
+        .filter(creation__date__gte=since)
+        .annotate(
+            start=truncate("creation"),
+            position=Window(
+                RowNumber(),
+                partition_by=[F("user_id"), truncate("creation")],
+                order_by=[F("qpm").desc(), F("id").asc()],
+            ),
+        )
+        .filter(position=1)
+        .select_related("user")
+    )
+
+
+def rebuild(batch_size=1000):
+    """Recompute the periods compact() would keep in full from core_test. Returns the row count."""
+    today = timezone.localdate()
+    rows = []
+    for window in WINDOWS:
+        since = previous_start(window, period_start(window, today), RETENTION[window])
+        for test in best_tests(window, since).iterator(chunk_size=batch_size):
+            start = test.start.date() if hasattr(test.start, "date") else test.start
+            row = PeriodBest(period=window, period_start=start, user_id=test.user_id)
+            row.copy_from(test, test.user.username)
+            rows.append(row)
+
+    PeriodBest.objects.all().delete()
+    PeriodBest.objects.bulk_create(rows, batch_size=batch_size)
+    Counter.increment(VERSION_KEY)
+    return len(rows)
+
+
+def compact(retention=None, keep_top=KEEP_TOP, today=None):
+    """Trim ended periods: keep ``retention[window]`` recent periods whole, only the top rows of older ones.
+
+    Returns the number of deleted rows.
+    """
+    retention = {**RETENTION, **(retention or {})}
+    today = today or timezone.localdate()
+    deleted = 0
+    for window in WINDOWS:
+        cutoff = previous_start(window, period_start(window, today), retention[window])
+        old = PeriodBest.objects.filter(period=window, period_start__lt=cutoff)
+        if keep_top:
+            ranked = old.annotate(position=Window(
+                RowNumber(),
+                partition_by=[F("period_start")],
+                order_by=[F("qpm").desc(), F("test_id").asc()],
+            )).filter(position__gt=keep_top)
+            ids = list(ranked.values_list("id", flat=True))
+            for offset in range(0, len(ids), 500):
+                deleted += PeriodBest.objects.filter(id__in=ids[offset:offset + 500]).delete()[0]
+        else:
+            deleted += old.delete()[0]
+    if deleted:
+        Counter.increment(VERSION_KEY)
+    return deleted
+
+
+def counts():
+    """Rows per window, for reporting how big the table is."""
+    return dict(PeriodBest.objects.order_by().values_list("period").annotate(rows=Count("id")))
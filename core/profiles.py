@@ -0,0 +1,67 @@
+"""Versioned cache of the /user/ profile payload.
+
+The payload only changes when the user submits tests or updates their
+settings, so it is cached per user under a version stamp made of two Counter
+rows: ``profile:<user id>``, bumped by those writes, and ``profiles``, bumped
+by bulk rebuilds that touch every user. The same stamp is the ETag, so a
+client holding the current payload gets a 304 after one indexed read.
+"""
+from django.db.models import F
+
+from . import cache
+from .models import Counter
+
+
+GLOBAL_KEY = "profiles"
+
+
+def version_key(user_id):
+    return f"profile:{user_id}"
+
+
+def _stamp(rows, user_id):
+    values = dict(rows)
+    return f"{values.get(GLOBAL_KEY, 0)}.{values.get(version_key(user_id), 0)}"
+
+
+def version(user_id):
+    rows = Counter.objects.filter(key__in=[GLOBAL_KEY, version_key(user_id)]).values_list("key", "value")
+    return _stamp(rows, user_id)
+
+
+async def aversion(user_id):
+    rows = Counter.objects.filter(key__in=[GLOBAL_KEY, version_key(user_id)]).values_list("key", "value")
+    return _stamp([row async for row in rows], user_id)
+
+
+def bump(user_ids):
+    """Invalidate the cached profiles of ``user_ids``. Call inside the writing transaction."""
+    keys = [version_key(user_id) for user_id in set(user_ids)]
+    if Counter.objects.filter(key__in=keys).update(value=F("value") + 1) == len(keys):
+        return
+    # first write for some of these users: create their rows, then count this write
+    existing = set(Counter.objects.filter(key__in=keys).values_list("key", flat=True))
+    missing = [key for key in keys if key not in existing]
+    Counter.objects.bulk_create([Counter(key=key, value=0) for key in missing], ignore_conflicts=True)
+    Counter.objects.filter(key__in=missing).update(value=F("value") + 1)
+
+
+def bump_all():
+    Counter.bump(GLOBAL_KEY)
+
+
+def etag(user, version):
+    return f'"{user.pk}-{version}"'
+
+
+def _params(user):
+    # ids can come back after a database reset; the join time tells those users apart
+    return {"user": user.pk, "joined": user.date_joined.timestamp()}
+
+
+def get_or_set(user, version, compute):
+    return cache.get_or_set("profile", version, _params(user), compute)
+
+
+async def aget_or_set(user, version, compute):
+    return await cache.aget_or_set("profile", version, _params(user), compute)
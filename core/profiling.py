@@ -0,0 +1,258 @@
+"""Sampled request profiling, a low-overhead replacement for always-on Silk.
+
+SampledProfilingMiddleware profiles a request when it is picked by the
+endpoint's SAMPLE_RATE, or keeps it afterwards if it took longer than SLOW_MS.
+With SLOW_MS set (500 by default) every request to an enabled endpoint gets
+the query wrapper, since slowness is only known at the end; unkept requests
+cost a timer and a list append per query. Only requests that can be neither
+sampled nor slow skip the wrapper entirely. Profiles are buffered in memory
+and a background thread writes them with one bulk INSERT once FLUSH_SIZE
+records are waiting or FLUSH_INTERVAL seconds have passed, so the profiled
+request never waits on it.
+
+Per-endpoint settings (keyed by request path) come from PROFILING["ENDPOINTS"]
+and can be changed at runtime with set_endpoint(), which stores overrides in
+core_profilingoverride. Every worker re-reads that table at most every
+OVERRIDES_TTL seconds, so a change reaches all of them within that time.
+PROFILING["ENABLED"] False switches profiling off everywhere, overrides
+included, and then the table is never read.
+"""
+import atexit
+import logging
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import routing
+from .models import ProfilingOverride, RequestProfile
+
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT_FIELDS = ("enabled", "sample_rate", "slow_ms")
+
+
+def _setting(name, default):
+    return getattr(settings, "PROFILING", {}).get(name, default)
+
+
+def get_overrides():
+    """Runtime overrides by path, without the fields left at their configured value."""
+    return {
+        row["path"]: {name: row[name] for name in ENDPOINT_FIELDS if row[name] is not None}
+        for row in ProfilingOverride.objects.values("path", *ENDPOINT_FIELDS)
+    }
+
+
+def set_endpoint(path, **changes):
+    """Override ``enabled``, ``sample_rate`` or ``slow_ms`` for one path; None clears a field.
+
+    Other workers pick the change up within OVERRIDES_TTL seconds.
+    """
+    unknown = set(changes) - set(ENDPOINT_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown profiling options: {', '.join(sorted(unknown))}")
+    if changes.get("enabled") is not None and not isinstance(changes["enabled"], bool):
+        raise ValueError("enabled must be true or false")
+    for name, upper in (("sample_rate", 1), ("slow_ms", None)):
+        value = changes.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0 or (upper and value > upper):
+            raise ValueError(f"{name} must be a number between 0 and {upper}" if upper else f"{name} must be a positive number")
+    with transaction.atomic():
+        existing = ProfilingOverride.objects.select_for_update().filter(path=path).first()
+        override = existing or ProfilingOverride(path=path)
+        for name, value in changes.items():
+            setattr(override, name, value)
+        if any(getattr(override, name) is not None for name in ENDPOINT_FIELDS):
+            override.save()
+        elif existing is not None:
+            existing.delete()
+    config.invalidate()
+    return get_overrides()
+
+
+class ProfilingConfig:
+    """Effective per-path settings, re-reading runtime overrides at most every OVERRIDES_TTL seconds."""
+
+    def __init__(self):
+        self._overrides = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > _setting("OVERRIDES_TTL", 5)
+
+    def _load(self, overrides):
+        with self._lock:
+            self._overrides = overrides
+            self._loaded_at = time.monotonic()
+
+    def for_path(self, path):
+        if _setting("ENABLED", False) and self._stale():
+            self._load(get_overrides())
+        return self._endpoint(path)
+
+    async def afor_path(self, path):
+        if _setting("ENABLED", False) and self._stale():
+            self._load(await sync_to_async(get_overrides)())
+        return self._endpoint(path)
+
+    def _endpoint(self, path):
+        endpoint = {
+            "enabled": True,
+            "sample_rate": _setting("SAMPLE_RATE", 0.01),
+            "slow_ms": _setting("SLOW_MS", None),
+        }
+        endpoint.update(_setting("ENDPOINTS", {}).get(path, {}))
+        endpoint.update(self._overrides.get(path, {}))
+        endpoint["enabled"] = _setting("ENABLED", False) and endpoint["enabled"]
+        return endpoint
+
+
+config = ProfilingConfig()
+
+
+class ProfileBuffer:
+    """Holds finished profiles until a background thread bulk inserts them."""
+
+    def __init__(self, autostart=True):
+        self.autostart = autostart
+        self._records = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profile-flush", daemon=True)
+                self._thread.start()
+
+    def add(self, record):
+        if self.autostart:
+            self.start()
+        with self._lock:
+            if len(self._records) >= _setting("MAX_BUFFER", 1000):
+                self.dropped += 1
+                return
+            self._records.append(record)
+            full = len(self._records) >= _setting("FLUSH_SIZE", 100)
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write every buffered profile now, on the calling thread."""
+        with self._lock:
+            records, self._records = self._records, []
+        if not records:
+            return 0
+        try:
+            RequestProfile.objects.bulk_create(records)
+        except Exception:
+            logger.warning("Dropped %d request profiles", len(records), exc_info=True)
+            return 0
+        return len(records)
+
+    def _run(self):
+        while True:
+            self._wake.wait(_setting("FLUSH_INTERVAL", 10))
+            self._wake.clear()
+            close_old_connections()
+            self.flush()
+
+
+buffer = ProfileBuffer()
+atexit.register(buffer.flush)
+
+
+class QueryRecorder:
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, (time.perf_counter() - started) * 1000))
+
+
+class SampledProfilingMiddleware:
+    """Sync or async, whichever the rest of the chain is, so ASGI requests stay on the event loop."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        sampled, slow_ms = self.pick(config.for_path(request.path_info))
+        if not sampled and slow_ms is None:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        started_at = timezone.now()
+        started = time.perf_counter()
+        with routing.execute_wrapper(recorder):
+            response = self.get_response(request)
+        self.record(request, response, recorder, started_at, time.perf_counter() - started, sampled, slow_ms)
+        return response
+
+    async def __acall__(self, request):
+        sampled, slow_ms = self.pick(await config.afor_path(request.path_info))
+        if not sampled and slow_ms is None:
+            return await self.get_response(request)
+
+        recorder = QueryRecorder()
+        started_at = timezone.now()
+        started = time.perf_counter()
+        with routing.execute_wrapper(recorder):
+            response = await self.get_response(request)
+        self.record(request, response, recorder, started_at, time.perf_counter() - started, sampled, slow_ms)
+        return response
+
+    def pick(self, endpoint):
+        """(sampled, slow_ms) for a request to ``endpoint``; (False, None) means don't profile it."""
+        if not endpoint["enabled"]:
+            return False, None
+        return random.random() < (endpoint["sample_rate"] or 0), endpoint["slow_ms"]
+
+    def record(self, request, response, recorder, started_at, elapsed, sampled, slow_ms):
+        duration_ms = elapsed * 1000
+        if not sampled and duration_ms < slow_ms:
+            return
+        slowest = sorted(recorder.queries, key=lambda query: query[1], reverse=True)
+        match = getattr(request, "resolver_match", None)
+        buffer.add(RequestProfile(
+            path=request.path_info[:255],
+            view=(match.view_name or "")[:255] if match else "",
+            method=request.method,
+            status_code=response.status_code,
+            reason="sampled" if sampled else "slow",
+            started_at=started_at,
+            duration_ms=duration_ms,
+            query_count=len(recorder.queries),
+            query_time_ms=sum(ms for _, ms in recorder.queries),
+            queries=[{"sql": sql[:2000], "ms": round(ms, 3)} for sql, ms in slowest[:_setting("MAX_QUERIES", 20)]],
+        ))
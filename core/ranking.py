@@ -0,0 +1,196 @@
+"""In-process order-statistic index over core_userbest.
+
+Each worker keeps every user's best in a list sorted by (qpm desc, test id asc),
+so "rank of user X" is a dict lookup plus a bisect and "user at rank K" is a
+list index. The index remembers the ``leaderboard`` Counter value it reflects;
+rows changed since then (UserBest.version is stamped from the same counter) are
+pulled in incrementally before answering. If another thread is already
+refreshing the index, the caller falls back to SQL instead of waiting.
+Lookups take a lock the updates hold too, so a lookup never sees a list
+halfway through an update or the list of one load with the dicts of another. The
+index always refreshes from the primary database, since a lagging replica
+would look like a counter that went backwards.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from . import leaderboard, routing
+from .models import Counter, UserBest
+from .serializers import row_serializer
+
+
+logger = logging.getLogger(__name__)
+
+ROW_FIELDS = ("test_id", "qpm", "raw", "accuracy", "mode", "difficulty", "creation",
+              "number", "time", "user_id", "username", "version")
+
+
+def _setting(name, default):
+    return getattr(settings, "RANKING_INDEX", {}).get(name, default)
+
+
+ROWS = row_serializer(ROW_FIELDS, ("id",) + ROW_FIELDS[1:])
+
+
+def _to_row(values):
+    row = ROWS.row(values)
+    row.pop("version")
+    return row
+
+
+def _sort_key(row):
+    return (-row["qpm"], row["id"], row["user_id"])
+
+
+class RankingIndex:
+
+    def __init__(self):
+        self._keys = []
+        self._rows = {}
+        self._usernames = {}
+        self._refresh_lock = threading.Lock()
+        # guards _keys, _rows and _usernames: held by lookups and by the updates to them
+        self._lock = threading.Lock()
+        self.version = None
+        self.loaded_at = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    def load(self, version, rows):
+        keys, by_user, usernames = [], {}, {}
+        for row in rows:
+            keys.append(_sort_key(row))
+            by_user[row["user_id"]] = row
+            usernames[row["username"]] = row["user_id"]
+        keys.sort()
+        with self._lock:
+            self._keys, self._rows, self._usernames = keys, by_user, usernames
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def apply(self, version, rows):
+        with self._lock:
+            for row in rows:
+                old = self._rows.get(row["user_id"])
+                if old is not None:
+                    position = bisect_left(self._keys, _sort_key(old))
+                    del self._keys[position]
+                    self._usernames.pop(old["username"], None)
+                insort(self._keys, _sort_key(row))
+                self._rows[row["user_id"]] = row
+                self._usernames[row["username"]] = row["user_id"]
+        self.version = max(self.version or 0, version)
+
+    def rank_of(self, username):
+        with self._lock:
+            user_id = self._usernames.get(username)
+            if user_id is None:
+                return None
+            row = self._rows[user_id]
+            return {**row, "index": bisect_left(self._keys, _sort_key(row)) + 1}
+
+    def at_rank(self, rank):
+        with self._lock:
+            if not 1 <= rank <= len(self._keys):
+                return None
+            user_id = self._keys[rank - 1][2]
+            return {**self._rows[user_id], "index": rank}
+
+    def expired(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > _setting("MAX_AGE", 3600)
+
+    def refresh(self):
+        """Bring the index up to date. Returns False if another thread is already doing it."""
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            with routing.primary():
+                return self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self):
+        version = Counter.get(leaderboard.VERSION_KEY)
+        if self.version == version and not self.expired():
+            return True
+
+        # a counter that went backwards means the database was restored or rebuilt
+        if not self.expired() and version > self.version:
+            limit = _setting("CATCH_UP_LIMIT", 1000)
+            changed = list(
+                UserBest.objects.filter(version__gt=self.version).values_list(*ROW_FIELDS)[:limit + 1]
+            )
+            if len(changed) <= limit:
+                self.apply(version, [_to_row(values) for values in changed])
+                return True
+
+        self.load(version, (_to_row(values) for values in UserBest.objects.values_list(*ROW_FIELDS).iterator()))
+        return True
+
+
+index = RankingIndex()
+
+
+def enabled():
+    return _setting("ENABLED", True)
+
+
+def warm():
+    """Load the index at worker startup; failures just leave it cold."""
+    if not enabled():
+        return
+    try:
+        index.refresh()
+    except DatabaseError:
+        logger.warning("Could not warm the ranking index", exc_info=True)
+
+
+def user_rank(username):
+    if enabled() and index.refresh():
+        row = index.rank_of(username)
+        return [row] if row else []
+    return leaderboard.user_rank(username)
+
+
+def user_at_rank(rank):
+    if enabled() and index.refresh():
+        row = index.at_rank(rank)
+        return [row] if row else []
+    return leaderboard.user_at_rank(rank)
+
+
+def rank_param(params):
+    """The ?rank= parameter as a 1-based rank, or None when absent."""
+    rank = params.get("rank")
+    if rank is None:
+        return None
+    try:
+        rank = int(rank)
+    except ValueError:
+        raise leaderboard.InvalidFilter("rank must be an integer.")
+    if rank < 1:
+        raise leaderboard.InvalidFilter("rank must be at least 1.")
+    return rank
+
+
+def lookup(params, board=None):
+    """The /userrank/ payload: by ?rank=K when given, else by ?user=name.
+
+    ``board`` is a windowed board from leaderboard.window_board(); those are
+    small enough to rank in SQL, the index only covers the all-time board.
+    """
+    rank = rank_param(params)
+    if board is not None:
+        if rank is not None:
+            return {"result": leaderboard.user_at_rank(rank, board)}
+        return {"result": leaderboard.user_rank(params.get("user"), board)}
+    if rank is not None:
+        return {"result": user_at_rank(rank)}
+    return {"result": user_rank(params.get("user"))}
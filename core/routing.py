@@ -0,0 +1,185 @@
+"""Read replica routing.
+
+When REPLICA_DATABASE_URL is set, the ``replica`` alias is configured and
+ReplicaRouter sends the reads of GET and HEAD requests to it: leaderboard and
+rank pages, /user/ profiles and the other read endpoints. Everything else,
+including every write, stays on ``default``.
+
+A replica lags behind its primary, so a client that has just written would
+not see its own write. ReplicaRoutingMiddleware remembers clients that made a
+successful write, by bearer token, for STICKY_SECONDS in the Django cache, and
+serves their reads from the primary until then. Anonymous clients are never
+sticky. That cache must be shared by all workers, or a client's next read,
+usually served by another worker, would miss its write: check() refuses to
+start with a replica and a per-process cache.
+
+Raw SQL has to pick its connection itself: use read_connection() instead of
+django.db.connection.
+"""
+import hashlib
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, router
+
+from .models import Test
+
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_replica_reads = ContextVar("replica_reads", default=False)
+
+
+def _setting(name, default):
+    return getattr(settings, "DATABASE_REPLICA", {}).get(name, default)
+
+
+def replica_alias():
+    """The replica's alias, or None when no replica is configured."""
+    alias = _setting("ALIAS", "replica")
+    return alias if alias in settings.DATABASES else None
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Route the ORM reads in this block to the replica (or, with enabled=False, to the primary)."""
+    token = _replica_reads.set(enabled)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def primary():
+    """Read from the primary in this block, e.g. for state that must never go backwards."""
+    return replica_reads(False)
+
+
+def read_connection():
+    """The connection raw SQL reads should use."""
+    return connections[router.db_for_read(Test)]
+
+
+@contextmanager
+def execute_wrapper(wrapper):
+    """connection.execute_wrapper() on every alias, so the replica's queries are seen too."""
+    with ExitStack() as stack:
+        for alias_connection in connections.all():
+            stack.enter_context(alias_connection.execute_wrapper(wrapper))
+        yield
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get():
+            return replica_alias()
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        return True
+
+
+def _cache():
+    return caches[_setting("CACHE_ALIAS", "default")]
+
+
+def shared():
+    """Whether CACHE_ALIAS is visible to every worker, i.e. not a per-process cache."""
+    return not isinstance(_cache(), (LocMemCache, DummyCache))
+
+
+def check():
+    """Raise ImproperlyConfigured when a replica is configured but stickiness would be per worker."""
+    if replica_alias() is not None and not shared():
+        alias = _setting("CACHE_ALIAS", "default")
+        raise ImproperlyConfigured(
+            f"DATABASE_REPLICA['CACHE_ALIAS'] {alias!r} is a per-process cache, so workers would not see each "
+            "other's writers; point REPLICA_CACHE_ALIAS at a shared cache, e.g. set SHARED_CACHE_DIR."
+        )
+
+
+def client_key(request):
+    """Cache key naming the client by its bearer token, or None for anonymous requests.
+
+    Not by address: behind the reverse proxy every client shares one, and a
+    single write would pin everyone's reads to the primary.
+    """
+    authorization = request.headers.get("Authorization")
+    if not authorization:
+        return None
+    return f"routing:sticky:auth:{hashlib.md5(authorization.encode()).hexdigest()}"
+
+
+def mark_written(request):
+    """Serve this client's reads from the primary for the next STICKY_SECONDS."""
+    seconds, key = _setting("STICKY_SECONDS", 5), client_key(request)
+    if seconds and key:
+        _cache().set(key, True, seconds)
+
+
+async def amark_written(request):
+    seconds, key = _setting("STICKY_SECONDS", 5), client_key(request)
+    if seconds and key:
+        await _cache().aset(key, True, seconds)
+
+
+def is_sticky(request):
+    key = client_key(request)
+    return key is not None and bool(_cache().get(key))
+
+
+async def ais_sticky(request):
+    key = client_key(request)
+    return key is not None and bool(await _cache().aget(key))
+
+
+class ReplicaRoutingMiddleware:
+    """Sync or async, whichever the rest of the chain is, so ASGI requests stay on the event loop."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if replica_alias() is None:
+            return self.get_response(request)
+
+        if request.method not in SAFE_METHODS:
+            response = self.get_response(request)
+            if response.status_code < 400:
+                mark_written(request)
+            return response
+
+        with replica_reads(not is_sticky(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if replica_alias() is None:
+            return await self.get_response(request)
+
+        if request.method not in SAFE_METHODS:
+            response = await self.get_response(request)
+            if response.status_code < 400:
+                await amark_written(request)
+            return response
+
+        with replica_reads(not await ais_sticky(request)):
+            return await self.get_response(request)
@@ -0,0 +1,105 @@
+"""Deterministic synthetic data for benchmarks and load tests.
+
+The same arguments always produce the same users and tests, so benchmark
+numbers from different commits are comparable.
+"""
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from . import histogram, leaderboard, periods, profiles, streaks
+from .models import Settings, Test
+
+
+TIMES = [30, 60, 120, 180]
+TIME_WEIGHTS = [35, 40, 15, 10]
+NUMBERS = [5, 10, 15, 25]
+NUMBER_WEIGHTS = [20, 40, 25, 15]
+DIFFICULTY_WEIGHTS = [15, 30, 30, 15, 10]
+PASSWORD = "benchmark-password"
+
+
+@contextmanager
+def explicit_creation():
+    """Let bulk_create keep the creation timestamps we assign instead of now()."""
+    field = Test._meta.get_field("creation")
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+def usernames(prefix, users):
+    return [f"{prefix}{i}" for i in range(users)]
+
+
+def seed(users, tests, seed=1, days=365, prefix="seed", batch_size=5000, log=None):
+    """Create ``users`` users and ``tests`` tests, then rebuild derived tables.
+
+    Every user gets the password ``PASSWORD`` (hashed once). Players have a
+    skill level and an activity rate, so qpm, difficulty and dates are spread
+    the way real players spread them: a few heavy players, many casual ones.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    password = make_password(PASSWORD)
+
+    with transaction.atomic():
+        User.objects.bulk_create(
+            [User(username=name, password=password, date_joined=now - timedelta(days=days))
+             for name in usernames(prefix, users)],
+            batch_size=batch_size,
+        )
+        user_ids = list(
+            User.objects.filter(username__startswith=prefix).order_by("id").values_list("id", flat=True)
+        )
+        Settings.objects.bulk_create(
+            [Settings(theme="discord", font="ubuntu", user_id=user_id) for user_id in user_ids],
+            batch_size=batch_size,
+        )
+
+    skill = {user_id: rng.gauss(60, 15) for user_id in user_ids}
+    # activity follows a long tail: most tests come from a minority of players
+    activity = [rng.paretovariate(1.2) for _ in user_ids]
+
+    with explicit_creation():
+        for start in range(0, tests, batch_size):
+            count = min(batch_size, tests - start)
+            players = rng.choices(user_ids, weights=activity, k=count)
+            batch = []
+            for user_id in players:
+                difficulty = rng.choices(range(1, 6), weights=DIFFICULTY_WEIGHTS)[0]
+                qpm = max(1.0, round(rng.gauss(skill[user_id] - (difficulty - 1) * 6, 8), 2))
+                if rng.random() < 0.6:
+                    mode, time, number = "time", rng.choices(TIMES, weights=TIME_WEIGHTS)[0] * 1000, 0
+                else:
+                    mode, time, number = "questions", 0, rng.choices(NUMBERS, weights=NUMBER_WEIGHTS)[0]
+                batch.append(Test(
+                    qpm=qpm,
+                    raw=round(qpm * rng.uniform(1.0, 1.25), 2),
+                    accuracy=max(0, min(100, int(rng.gauss(90, 6)))),
+                    mode=mode,
+                    difficulty=difficulty,
+                    number=number,
+                    time=time,
+                    user_id=user_id,
+                    creation=now - timedelta(seconds=rng.randint(0, days * 86400)),
+                ))
+            Test.objects.bulk_create(batch)
+            if log:
+                log(f"seeded {start + count}/{tests} tests")
+
+    with transaction.atomic():
+        leaderboard.rebuild()
+        leaderboard.rebuild_filtered()
+        periods.rebuild()
+        histogram.rebuild()
+        streaks.rebuild()
+        profiles.bump_all()
+    return user_ids
@@ -1,15 +1,130 @@
 from rest_framework import serializers
-from .models import Test , Settings
+from .models import Test , Settings , UserStats
 from django.contrib.auth.models import User
 from collections import defaultdict
-from datetime import timedelta
+from datetime import timedelta, timezone as dt_timezone
+from functools import lru_cache
+from django.conf import settings
 from django.contrib.auth.hashers import make_password
+from django.db import models
+from django.db.models import F , Q , Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+# buckets reported in the profile's best scores (time in seconds)
+BEST_SCORE_TIMES = [30, 60, 120, 180]
+BEST_SCORE_NUMBERS = [5, 10, 15, 25]
+BEST_SCORE_DIFFICULTIES = range(1, 6)
 
 class TestSerializer(serializers.ModelSerializer):
     class Meta:
         model = Test
         fields = '__all__'
 
+UTC_NAMES = {"UTC", "Etc/UTC"}
+
+
+def _output_timezone():
+    """Timezone datetimes are rendered in, or None when they stay in UTC (or USE_TZ is off)."""
+    if not settings.USE_TZ:
+        return None
+    current = timezone.get_current_timezone()
+    return None if str(current) in UTC_NAMES else current
+
+
+def serialize_datetime(value, output_timezone=None):
+    """Format a datetime exactly like DRF's DateTimeField does with the default settings.
+
+    ``output_timezone`` comes from _output_timezone(); resolve it once per batch.
+    """
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if settings.USE_TZ and value.utcoffset() is None:
+        # raw SQL on backends without timezone support hands back naive UTC
+        value = value.replace(tzinfo=dt_timezone.utc)
+    if output_timezone is not None:
+        value = value.astimezone(output_timezone)
+    text = value.isoformat()
+    return text[:-6] + "Z" if text.endswith("+00:00") else text
+
+
+def _float(value, output_timezone):
+    return float(value)
+
+
+def _converter(field):
+    if isinstance(field, models.DateTimeField):
+        return serialize_datetime
+    if isinstance(field, models.FloatField):
+        return _float
+    return None
+
+
+class TestRowSerializer:
+    """Turns Test value tuples into the primitives TestSerializer would produce.
+
+    Field lookups happen once, when the serializer is built for a column list;
+    serializing a row is then a zip over the columns and a conversion of the
+    few that need one (datetimes and floats). No model instances are created.
+    Columns are Test field names or attnames (``user``/``user_id``); any other
+    column, such as an annotation, is passed through unchanged.
+    """
+
+    def __init__(self, columns, names=None):
+        fields = {}
+        for field in Test._meta.concrete_fields:
+            fields[field.name] = fields[field.attname] = field
+        self.columns = tuple(columns)
+        self.names = tuple(names or columns)
+        self._attnames = tuple(fields[column].attname if column in fields else column for column in self.columns)
+        self._conversions = tuple(
+            (i, convert) for i, convert in
+            ((i, _converter(fields[column])) for i, column in enumerate(self.columns) if column in fields)
+            if convert is not None
+        )
+
+    def row(self, values):
+        return self.many([values])[0]
+
+    def instances(self, tests):
+        """Serialize Test instances already in memory, e.g. straight from bulk_create()."""
+        attnames = self._attnames
+        return self.many([tuple(getattr(test, attname) for attname in attnames) for test in tests])
+
+    def many(self, rows):
+        names, conversions = self.names, self._conversions
+        if not conversions:
+            return [dict(zip(names, values)) for values in rows]
+
+        output_timezone = _output_timezone()
+        result = []
+        for values in rows:
+            values = list(values)
+            for i, convert in conversions:
+                if values[i] is not None:
+                    values[i] = convert(values[i], output_timezone)
+            result.append(dict(zip(names, values)))
+        return result
+
+
+@lru_cache(maxsize=64)
+def row_serializer(columns, names=None):
+    """Shared TestRowSerializer for a column tuple, e.g. straight from cursor.description."""
+    return TestRowSerializer(columns, names)
+
+
+# same fields, in the same order, as TestSerializer
+TEST_ROWS = row_serializer(tuple(field.name for field in Test._meta.concrete_fields))
+
+
+class TestSubmissionSerializer(serializers.ModelSerializer):
+    # the owner comes from the authenticated request, not the payload
+    class Meta:
+        model = Test
+        fields = '__all__'
+        read_only_fields = ['user']
+
 class SettingsSerializer(serializers.ModelSerializer):
     class Meta:
         model = Settings
@@ -29,82 +144,75 @@ class UserDataSerializer(serializers.ModelSerializer):
         fields = ["username" , "streak" , "date_joined" , "best_scores" , "theme" , "font" , "tests"]
 
     def get_streak(self, obj):
-        user = obj
-        tests = Test.objects.filter(user=user).order_by("-creation")
-
-        test_dates = sorted(set([test.creation.date() for test in tests]) , reverse=False)
-
-        current_streak = 0
-        longest_streak = 1
-        user_streak = 1
-        isFirstStreak = True
-
-        for i in range(1, len(test_dates)):
-            if (test_dates[i] - test_dates[i - 1]).days == 1:
-                user_streak += 1
-                if isFirstStreak: current_streak += 1
-            else:
-                longest_streak = max(longest_streak, user_streak)
-                user_streak = 1
-                isFirstStreak = False
-
-        return {"user_streak": user_streak , "longest_streak": longest_streak}
-
-
+        try:
+            stats = obj.stats
+        except UserStats.DoesNotExist:
+            # not rebuilt yet: derive it from the distinct days the user played on
+            stats = UserStats.from_dates(Test.objects.filter(user=obj).dates("creation", "day"))
 
+        if stats.last_active is None:
+            return {"user_streak": 1 , "longest_streak": 1}
+        return {"user_streak": stats.current_streak , "longest_streak": stats.longest_streak}
 
     def get_best_scores(self, obj):
-        tests = Test.objects.filter(user=obj).order_by("-qpm")
-
+        time_values = [time * 1000 for time in BEST_SCORE_TIMES]
+        ranking = [F("qpm").desc(), F("id").asc()]
+
+        # one row per bucket: the best test for each tracked time and question count
+        tests = (
+            Test.objects
+            .filter(user=obj, difficulty__in=BEST_SCORE_DIFFICULTIES)
+            .filter(Q(time__in=time_values) | Q(number__in=BEST_SCORE_NUMBERS))
+            .annotate(
+                time_position=Window(RowNumber(), partition_by=[F("time")], order_by=ranking),
+                number_position=Window(RowNumber(), partition_by=[F("number")], order_by=ranking),
+            )
+            .filter(
+                Q(time_position=1, time__in=time_values)
+                | Q(number_position=1, number__in=BEST_SCORE_NUMBERS)
+            )
+        )
+
+        time_index = TEST_ROWS.columns.index("time")
+        number_index = TEST_ROWS.columns.index("number")
         time_scores = {}
         question_scores = {}
-
-        # Select the best test per (value, difficulty) combo
-        for test in tests:
-            if test.time and (test.time, test.difficulty) not in time_scores:
-                time_scores[(test.time, test.difficulty)] = test
-            if test.number and (test.number, test.difficulty) not in question_scores:
-                question_scores[(test.number, test.difficulty)] = test
-
-        time_results = []
-        for time in [30, 60, 120, 180]:
-            best_test = None
-            for difficulty in range(1, 6):
-                test = time_scores.get((time * 1000, difficulty))
-                if test and (not best_test or test.qpm > best_test.qpm):
-                    best_test = test
-            time_results.append({
-                "value": time,
-                "test": TestSerializer(best_test).data if best_test else None
-            })
-
-        question_results = []
-        for number in [5, 10, 15, 25]:
-            best_test = None
-            for difficulty in range(1, 6):
-                test = question_scores.get((number, difficulty))
-                if test and (not best_test or test.qpm > best_test.qpm):
-                    best_test = test
-            question_results.append({
-                "value": number,
-                "test": TestSerializer(best_test).data if best_test else None
-            })
+        for *values, time_position, number_position in tests.values_list(
+            *TEST_ROWS.columns, "time_position", "number_position"
+        ):
+            if time_position == 1 and values[time_index] in time_values:
+                time_scores[values[time_index] // 1000] = values
+            if number_position == 1 and values[number_index] in BEST_SCORE_NUMBERS:
+                question_scores[values[number_index]] = values
+
+        def results(values, scores):
+            return [
+                {"value": value, "test": TEST_ROWS.row(scores[value]) if value in scores else None}
+                for value in values
+            ]
 
         return {
-            "time": time_results,
-            "questions": question_results
+            "time": results(BEST_SCORE_TIMES, time_scores),
+            "questions": results(BEST_SCORE_NUMBERS, question_scores)
         }
 
+    def get_settings(self , obj):
+        # reuse the row joined by select_related("settings") instead of querying per field
+        try:
+            return obj.settings
+        except Settings.DoesNotExist:
+            return None
+
     def get_theme(self , obj):
-        data = Settings.objects.filter(user=obj).first()
-        return data.theme
+        data = self.get_settings(obj)
+        return data.theme if data else None
 
     def get_font(self , obj):
-        data = Settings.objects.filter(user=obj).first()
-        return data.font
+        data = self.get_settings(obj)
+        return data.font if data else None
 
     def get_tests(self , obj):
-        return TestSerializer(Test.objects.filter(user=obj).all()[:10] , many=True).data
+        return TEST_ROWS.many(Test.objects.filter(user=obj).order_by("-creation", "-id").values_list(*TEST_ROWS.columns)[:10])
 
 
 class LeaderboardEntitySerializer(serializers.ModelSerializer):
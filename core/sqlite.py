@@ -0,0 +1,89 @@
+"""SQLite connection tuning for small deployments that run on db.sqlite3.
+
+Every new SQLite connection gets the pragmas from settings.SQLITE. WAL lets
+leaderboard readers keep reading while submitTest writes. A busy timeout
+makes a writer wait for the lock instead of failing at once. synchronous
+NORMAL is safe under WAL and skips an fsync per commit, and a bigger page
+cache keeps the ranking indexes in memory. TRANSACTION_MODE IMMEDIATE takes
+the write lock when a transaction starts. A deferred transaction that reads
+first and then writes can't wait for the lock: it fails with "database is
+locked" whatever the busy timeout is.
+
+A setting that is None or "" keeps SQLite's (or Django's) default. Other
+database vendors are left alone.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+TRANSACTION_MODES = ("DEFERRED", "IMMEDIATE", "EXCLUSIVE")
+
+
+def _setting(name, default=None):
+    return getattr(settings, "SQLITE", {}).get(name, default)
+
+
+def _choice(name, value, choices):
+    if value in (None, ""):
+        return None
+    if str(value).lower() not in [choice.lower() for choice in choices]:
+        raise ImproperlyConfigured(f"SQLITE[{name!r}] must be one of {', '.join(choices)}, not {value!r}.")
+    return str(value)
+
+
+def _integer(name, value):
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ImproperlyConfigured(f"SQLITE[{name!r}] must be an integer, not {value!r}.")
+
+
+def pragmas():
+    """The PRAGMA statements settings.SQLITE asks for, in the order they are run."""
+    statements = []
+    journal_mode = _choice("JOURNAL_MODE", _setting("JOURNAL_MODE"), JOURNAL_MODES)
+    if journal_mode:
+        statements.append(f"PRAGMA journal_mode = {journal_mode}")
+    synchronous = _choice("SYNCHRONOUS", _setting("SYNCHRONOUS"), SYNCHRONOUS_LEVELS)
+    if synchronous:
+        statements.append(f"PRAGMA synchronous = {synchronous}")
+    for name, pragma in (("BUSY_TIMEOUT", "busy_timeout"), ("CACHE_SIZE", "cache_size")):
+        value = _integer(name, _setting(name))
+        if value is not None:
+            statements.append(f"PRAGMA {pragma} = {value}")
+    return statements
+
+
+def transaction_mode():
+    mode = _choice("TRANSACTION_MODE", _setting("TRANSACTION_MODE"), TRANSACTION_MODES)
+    return mode.upper() if mode else None
+
+
+@receiver(connection_created)
+def configure(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for statement in pragmas():
+            cursor.execute(statement)
+    mode = transaction_mode()
+    if mode:
+        # read by Django when it opens a transaction, like OPTIONS["transaction_mode"]
+        connection.transaction_mode = mode
+
+
+def current(connection):
+    """The pragmas in effect on ``connection``, for reports."""
+    values = {}
+    with connection.cursor() as cursor:
+        for pragma in ("journal_mode", "synchronous", "busy_timeout", "cache_size"):
+            cursor.execute(f"PRAGMA {pragma}")
+            values[pragma] = cursor.fetchone()[0]
+    values["transaction_mode"] = connection.transaction_mode or "DEFERRED"
+    return values
@@ -0,0 +1,64 @@
+from collections import defaultdict
+from itertools import groupby
+
+from django.db import IntegrityError, transaction
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Test, UserStats
+
+
+def record_tests(tests):
+    """Advance streaks for freshly saved tests, one stats row update per user.
+
+    Must run inside the transaction that saved ``tests``.
+    """
+    days = defaultdict(set)
+    for test in tests:
+        days[test.user_id].add(timezone.localdate(test.creation))
+
+    for user_id, user_days in days.items():
+        stats = UserStats.objects.select_for_update().filter(user_id=user_id).first()
+        if stats is None:
+            stats = _seed(user_id)
+            if stats is None:
+                continue
+        changed = [stats.advance(day) for day in sorted(user_days)]
+        if any(changed):
+            stats.save()
+
+
+def _seed(user_id):
+    """Create a missing stats row from the user's whole history, which already holds the new tests.
+
+    A user who played before stats were tracked has history but no row; like
+    UserDataSerializer.get_streak, count every day they played rather than
+    just today. Returns the row to advance instead if another writer created
+    it first, else None.
+    """
+    stats = UserStats.from_dates(Test.objects.filter(user_id=user_id).dates("creation", "day"), user_id=user_id)
+    try:
+        with transaction.atomic():
+            stats.save(force_insert=True)
+    except IntegrityError:
+        return UserStats.objects.select_for_update().get(user_id=user_id)
+    return None
+
+
+def rebuild(batch_size=1000):
+    """Recompute every UserStats row from core_test. Returns the row count."""
+    days = (
+        Test.objects
+        .annotate(day=TruncDate("creation"))
+        .values_list("user_id", "day")
+        .distinct()
+        .order_by("user_id", "day")
+    )
+    rows = [
+        UserStats.from_dates((day for _, day in group), user_id=user_id)
+        for user_id, group in groupby(days.iterator(chunk_size=batch_size), key=lambda pair: pair[0])
+    ]
+
+    UserStats.objects.all().delete()
+    UserStats.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
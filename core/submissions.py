@@ -0,0 +1,33 @@
+from django.db import transaction
+
+from . import histogram, leaderboard, periods, profiles, streaks
+from .models import Test
+
+
+def record(tests):
+    """Update leaderboard, streak and profile state for freshly saved tests.
+
+    Must run inside the transaction that saved ``tests``. Derived state is
+    touched once per user (and once per bucket), however many tests there are.
+    """
+    by_user = {}
+    for test in tests:
+        best = by_user.get(test.user_id)
+        if best is None or test.qpm > best.qpm:
+            by_user[test.user_id] = test
+
+    for test in by_user.values():
+        leaderboard.record_test(test)
+    leaderboard.record_filtered_tests(tests)
+    periods.record_tests(tests)
+    histogram.record_tests(tests)
+    streaks.record_tests(tests)
+    profiles.bump(by_user)
+
+
+def save_tests(user, items):
+    """Bulk insert validated test payloads for ``user`` and record them in one transaction."""
+    with transaction.atomic():
+        tests = Test.objects.bulk_create([Test(user=user, **item) for item in items])
+        record(tests)
+    return tests
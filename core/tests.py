@@ -1,13 +1,52 @@
+from io import StringIO
+from unittest import mock, skipUnless
 import json
-from django.test import TestCase, Client
+import os
+import subprocess
+import tempfile
+import threading
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import DatabaseError, connection, connections
+from django.test import RequestFactory, TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User
 from rest_framework.test import APIClient, APITestCase
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 from datetime import datetime, timedelta
-from .models import Test, Settings
-from .serializers import TestSerializer, SettingsSerializer, UserDataSerializer, LeaderboardEntitySerializer
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.utils import timezone
+from .models import (
+    FilteredBest, PeriodBest, ProfilingOverride, QpmBest, QpmBucket, RequestProfile, Test, Settings, UserBest, UserStats,
+)
+from . import (
+    authentication, cache as response_cache, histogram, ingest, leaderboard, metrics, periods, profiling,
+    ranking, routing, seeding, sqlite, submissions, throttling,
+)
+from .serializers import (
+    TEST_ROWS, TestSerializer, SettingsSerializer, UserDataSerializer, LeaderboardEntitySerializer, row_serializer,
+    serialize_datetime,
+)
+
+
+# Settings that are on in production but would make the suite random: sampled
+# profiles are flushed by a background thread, possibly after the test database
+# is gone, and every test client shares one address and so the same throttle
+# buckets. The tests that cover them switch them back on.
+TEST_SETTINGS = override_settings(PROFILING={**settings.PROFILING, 'ENABLED': False},
+                                  THROTTLING={**settings.THROTTLING, 'ENABLED': False})
+
+
+def setUpModule():
+    TEST_SETTINGS.enable()
+
+
+def tearDownModule():
+    TEST_SETTINGS.disable()
 
 
 class ModelTests(TestCase):
@@ -574,3 +613,1739 @@ class AuthenticationTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['username'], 'testuser')
 
+
+
+def hide_rows_once(model):
+    """Make the next locking read of ``model`` miss its rows, like a concurrent writer inserting them just after it"""
+    real = model.objects.select_for_update
+    calls = []
+
+    def select_for_update(*args, **kwargs):
+        calls.append(None)
+        return model.objects.none() if len(calls) == 1 else real(*args, **kwargs)
+    return mock.patch.object(model.objects, 'select_for_update', side_effect=select_for_update)
+
+
+class UserBestTests(APITestCase):
+    """Tests for the denormalized per-user best table"""
+
+    def setUp(self):
+        ranking.index = ranking.RankingIndex()
+        caches['default'].clear()
+        self.user1 = User.objects.create_user(username='bestuser1', password='testpassword123')
+        self.user2 = User.objects.create_user(username='bestuser2', password='testpassword123')
+        Settings.objects.create(theme='dark', font='Arial', user=self.user1)
+        Settings.objects.create(theme='dark', font='Arial', user=self.user2)
+
+    def submit(self, user, qpm):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+        return self.client.post('/test/', {
+            'qpm': qpm, 'raw': qpm, 'accuracy': 90, 'mode': 'time',
+            'difficulty': 3, 'number': 0, 'time': 60000,
+        }, format='json')
+
+    def test_submit_updates_best(self):
+        """Only a strictly better score replaces the stored best"""
+        first = self.submit(self.user1, 50)
+        self.submit(self.user1, 40)
+        self.submit(self.user1, 50)
+
+        best = UserBest.objects.get(user=self.user1)
+        self.assertEqual(best.qpm, 50)
+        self.assertEqual(best.test_id, first.data['id'])
+        self.assertEqual(best.username, 'bestuser1')
+
+        self.submit(self.user1, 70)
+        self.assertEqual(UserBest.objects.get(user=self.user1).qpm, 70)
+
+    def test_leaderboard_one_row_per_user_on_ties(self):
+        """A tied max qpm still yields a single leaderboard row"""
+        self.submit(self.user1, 80)
+        self.submit(self.user1, 80)
+        self.submit(self.user2, 90)
+
+        response = self.client.get('/leaderboard/')
+        results = response.data['results']
+        self.assertEqual([row['username'] for row in results], ['bestuser2', 'bestuser1'])
+
+        response = self.client.get('/userrank/', {'user': 'bestuser1'})
+        self.assertEqual(len(response.data['result']), 1)
+        self.assertEqual(response.data['result'][0]['index'], 2)
+
+    def test_concurrent_first_submission(self):
+        """Losing the race to insert the first best retries as an update instead of failing"""
+        first = Test.objects.create(qpm=60, raw=60, accuracy=90, mode='time', difficulty=3,
+                                    number=0, time=60000, user=self.user1)
+        leaderboard.record_test(first)
+        for qpm, improved in [(50, False), (70, True)]:
+            test = Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time', difficulty=3,
+                                       number=0, time=60000, user=self.user1)
+            with hide_rows_once(UserBest):
+                self.assertEqual(leaderboard.record_test(test), improved)
+        self.assertEqual(UserBest.objects.get(user=self.user1).qpm, 70)
+        self.assertEqual(leaderboard.count(), 1)
+
+    def test_backfill_command(self):
+        """The backfill command rebuilds bests from core_test"""
+        for qpm in [30, 60, 60]:
+            Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time', difficulty=3,
+                                number=0, time=60000, user=self.user1)
+        Test.objects.create(qpm=20, raw=20, accuracy=90, mode='time', difficulty=3,
+                            number=0, time=60000, user=self.user2)
+
+        call_command('backfill_user_best', stdout=StringIO())
+
+        self.assertEqual(UserBest.objects.count(), 2)
+        best = UserBest.objects.get(user=self.user1)
+        self.assertEqual(best.qpm, 60)
+        self.assertEqual(best.test_id, Test.objects.filter(user=self.user1, qpm=60).order_by('id').first().id)
+
+
+class RankingIndexTests(APITestCase):
+    """Tests for the in-process ranking index"""
+
+    def setUp(self):
+        caches['default'].clear()
+        ranking.index = ranking.RankingIndex()
+        self.users = [
+            User.objects.create_user(username=f'rankuser{i}', password='testpassword123')
+            for i in range(4)
+        ]
+        for user, qpm in zip(self.users, [40, 90, 60, 90]):
+            self.submit(user, qpm)
+
+    def submit(self, user, qpm):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+        self.client.post('/test/', {
+            'qpm': qpm, 'raw': qpm, 'accuracy': 90, 'mode': 'time',
+            'difficulty': 3, 'number': 0, 'time': 60000,
+        }, format='json')
+
+    def test_rank_matches_sql(self):
+        """Index ranks agree with the SQL ranking"""
+        for user in self.users:
+            from_index = ranking.user_rank(user.username)
+            from_sql = leaderboard.user_rank(user.username)
+            self.assertEqual(from_index[0]['index'], from_sql[0]['index'])
+        self.assertEqual(ranking.user_rank('rankuser1')[0]['index'], 1)
+        self.assertEqual(ranking.user_rank('rankuser3')[0]['index'], 2)
+        self.assertEqual(ranking.user_rank('nobody'), [])
+
+    def test_user_at_rank(self):
+        """The rank parameter returns the user at that position"""
+        response = self.client.get('/userrank/', {'rank': 3})
+        self.assertEqual(response.data['result'][0]['username'], 'rankuser2')
+        self.assertEqual(response.data['result'][0]['index'], 3)
+        response = self.client.get('/userrank/', {'rank': 10})
+        self.assertEqual(response.data['result'], [])
+
+    def test_incremental_update(self):
+        """New bests are picked up without a full reload"""
+        ranking.user_rank('rankuser0')
+        loaded_at = ranking.index.loaded_at
+
+        self.submit(self.users[0], 100)
+
+        self.assertEqual(ranking.user_rank('rankuser0')[0]['index'], 1)
+        self.assertEqual(ranking.user_rank('rankuser1')[0]['index'], 2)
+        self.assertEqual(ranking.index.loaded_at, loaded_at)
+
+    def test_falls_back_to_sql_while_refreshing(self):
+        """A busy index defers to the SQL ranking"""
+        ranking.index._refresh_lock.acquire()
+        try:
+            with self.assertNumQueries(1):
+                result = ranking.user_rank('rankuser2')
+        finally:
+            ranking.index._refresh_lock.release()
+        self.assertEqual(result[0]['index'], 3)
+
+    def test_invalid_rank(self):
+        """A rank that is not a positive integer is a 400"""
+        for path in ('/userrank/', '/async/userrank/'):
+            for rank in ('abc', '0', '-1'):
+                response = self.client.get(path, {'rank': rank})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, (path, rank))
+
+    def test_lookups_during_updates(self):
+        """Lookups stay consistent while another thread applies updates"""
+        index = ranking.RankingIndex()
+        rows = [{'id': i, 'qpm': float(i), 'user_id': i, 'username': f'u{i}'} for i in range(1, 201)]
+        index.load(0, rows)
+        errors, done = [], threading.Event()
+
+        def update():
+            for version in range(1, 300):
+                user_id = version % 200 + 1
+                index.apply(version, [{**rows[user_id - 1], 'qpm': float(version % 250)}])
+            done.set()
+
+        writer = threading.Thread(target=update)
+        writer.start()
+        try:
+            while not done.is_set():
+                for rank in (1, 100, 200):
+                    row = index.at_rank(rank)
+                    if row is None or index.rank_of(row['username'])['index'] < 1:
+                        errors.append(rank)
+        finally:
+            writer.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(index), 200)
+
+
+class LeaderboardPaginationTests(APITestCase):
+    """Tests for cursor pagination of the leaderboard"""
+
+    def setUp(self):
+        caches['default'].clear()
+        # two users tie on 70 so the test id breaks the tie
+        for i, qpm in enumerate([90, 70, 70, 50, 30]):
+            user = User.objects.create_user(username=f'pageuser{i}', password='testpassword123')
+            test = Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time', difficulty=3,
+                                       number=0, time=60000, user=user)
+            leaderboard.record_test(test)
+
+    def usernames(self, data):
+        return [row['username'] for row in data['results']]
+
+    def test_walk_forward_and_back(self):
+        """Next and previous cursors visit every row exactly once"""
+        first = leaderboard.cursor_page(2)
+        self.assertEqual(self.usernames(first), ['pageuser0', 'pageuser1'])
+        self.assertIsNone(first['previous'])
+
+        second = leaderboard.cursor_page(2, first['next'])
+        self.assertEqual(self.usernames(second), ['pageuser2', 'pageuser3'])
+
+        third = leaderboard.cursor_page(2, second['next'])
+        self.assertEqual(self.usernames(third), ['pageuser4'])
+        self.assertIsNone(third['next'])
+
+        back = leaderboard.cursor_page(2, third['previous'])
+        self.assertEqual(self.usernames(back), ['pageuser2', 'pageuser3'])
+
+        start = leaderboard.cursor_page(2, back['previous'])
+        self.assertEqual(self.usernames(start), ['pageuser0', 'pageuser1'])
+        self.assertIsNone(start['previous'])
+
+    def test_count_is_total_ranked_users(self):
+        """count reports every ranked user, not the page length"""
+        response = self.client.get('/leaderboard/')
+        self.assertEqual(response.data['count'], 5)
+        self.assertIsNone(response.data['next'])
+
+        # a second test for an existing user does not change the count
+        test = Test.objects.create(qpm=99, raw=99, accuracy=90, mode='time', difficulty=3,
+                                   number=0, time=60000, user=User.objects.get(username='pageuser4'))
+        leaderboard.record_test(test)
+        self.assertEqual(self.client.get('/leaderboard/').data['count'], 5)
+
+    def test_invalid_cursor(self):
+        """A malformed cursor is rejected"""
+        response = self.client.get('/leaderboard/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_page_parameter_still_supported(self):
+        """The legacy page parameter keeps working"""
+        response = self.client.get('/leaderboard/', {'page': 1})
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(response.data['count'], 5)
+
+    def test_invalid_page(self):
+        """A page that isn't a positive integer is rejected, on the async view too"""
+        for path in ('/leaderboard/', '/async/leaderboard/'):
+            for page in ('abc', '0', '-1'):
+                with self.subTest(path=path, page=page):
+                    response = self.client.get(path, {'page': page})
+                    self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FilteredLeaderboardTests(APITestCase):
+    """Tests for per-mode, per-duration and per-difficulty leaderboards"""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user1 = User.objects.create_user(username='filteruser1', password='testpassword123')
+        self.user2 = User.objects.create_user(username='filteruser2', password='testpassword123')
+        for user, qpm, mode, difficulty, number, time in [
+            (self.user1, 80, 'time', 3, 0, 60000),
+            (self.user1, 85, 'time', 3, 0, 60000),
+            (self.user1, 99, 'time', 5, 0, 30000),
+            (self.user2, 90, 'time', 3, 0, 60000),
+            (self.user2, 40, 'questions', 2, 10, 0),
+        ]:
+            submissions.record([Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode=mode, difficulty=difficulty,
+                                                    number=number, time=time, user=user)])
+
+    def test_time_and_difficulty_filter(self):
+        """Each user's best within the bucket, ranked by qpm"""
+        response = self.client.get('/leaderboard/', {'time': 60, 'difficulty': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(row['username'], row['qpm']) for row in response.data['results']],
+                         [('filteruser2', 90), ('filteruser1', 85)])
+        self.assertEqual(response.data['count'], 2)
+
+    def test_number_filter(self):
+        """number filters the questions mode"""
+        response = self.client.get('/leaderboard/', {'number': 10})
+        self.assertEqual([row['username'] for row in response.data['results']], ['filteruser2'])
+        self.assertEqual(response.data['count'], 1)
+
+    def test_mode_filter(self):
+        """mode alone ranks bests across every duration and difficulty"""
+        response = self.client.get('/leaderboard/', {'mode': 'time'})
+        self.assertEqual([(row['username'], row['qpm']) for row in response.data['results']],
+                         [('filteruser1', 99), ('filteruser2', 90)])
+
+    def test_filtered_pages_use_the_rollup_index(self):
+        """difficulty alone ranks bests across modes from core_filteredbest, not core_test"""
+        response = self.client.get('/leaderboard/', {'difficulty': 3})
+        self.assertEqual([(row['username'], row['qpm']) for row in response.data['results']],
+                         [('filteruser2', 90), ('filteruser1', 85)])
+        self.assertEqual(response.data['count'], 2)
+        if connection.vendor == 'sqlite':
+            board = leaderboard.filtered_board(difficulty=3)
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN SELECT b.test_id FROM {board.source} WHERE {board.where} '
+                               'ORDER BY b.qpm DESC, b.test_id ASC LIMIT 51', board.params)
+                plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn('filteredbest_rank_idx', plan)
+            self.assertNotIn('core_test', plan)
+
+    def test_rebuild_matches_incremental_rows(self):
+        """Rebuilding from core_test gives the rows submissions produced"""
+        def rows():
+            return sorted(FilteredBest.objects.values_list('user_id', 'scope', 'test_id', 'qpm'))
+
+        incremental = rows()
+        self.assertEqual(len(incremental), 19)
+        self.assertEqual(leaderboard.rebuild_filtered(), 19)
+        self.assertEqual(rows(), incremental)
+
+    def test_concurrent_first_submission_of_a_scope(self):
+        """Losing the race to insert a scope's row retries against the committed row instead of failing"""
+        for qpm, improved in [(50, False), (95, True)]:
+            test = Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time', difficulty=3,
+                                       number=0, time=60000, user=self.user1)
+            with hide_rows_once(FilteredBest):
+                self.assertEqual(leaderboard.record_filtered_tests([test]), improved)
+        self.assertEqual(self.client.get('/leaderboard/', {'time': 60, 'difficulty': 3}).data['results'][0]['qpm'], 95)
+
+    def test_invalid_filters(self):
+        """Unknown modes and mismatched filters are rejected"""
+        for params in [{'mode': 'speed'}, {'mode': 'questions', 'time': 60}, {'difficulty': 'hard'}]:
+            response = self.client.get('/leaderboard/', params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UserDataQueryBudgetTests(APITestCase):
+    """The profile payload costs a fixed number of queries"""
+
+    # profile version, user + settings + stats join, best scores, recent tests;
+    # the auth user comes from the cache
+    QUERY_BUDGET = 4
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='budgetuser', password='testpassword123')
+        Settings.objects.create(theme='dark', font='Arial', user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def add_tests(self, count):
+        Test.objects.bulk_create([
+            Test(qpm=40 + i % 50, raw=40, accuracy=90, mode='time', difficulty=1 + i % 5,
+                 number=0, time=60000, user=self.user)
+            for i in range(count)
+        ])
+
+    def test_query_budget_independent_of_history(self):
+        """Adding tests does not add queries"""
+        self.client.get('/user/')
+        for count in [1, 200]:
+            self.add_tests(count)
+            call_command('rebuild_user_stats', stdout=StringIO())
+            with self.assertNumQueries(self.QUERY_BUDGET):
+                response = self.client.get('/user/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['theme'], 'dark')
+            self.assertEqual(len(response.data['tests']), min(Test.objects.filter(user=self.user).count(), 10))
+
+
+class UserStatsTests(APITestCase):
+    """Tests for incrementally maintained streaks"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='statsuser', password='testpassword123')
+        Settings.objects.create(theme='dark', font='Arial', user=self.user)
+
+    def test_advance(self):
+        """Consecutive days extend the streak, gaps restart it"""
+        today = datetime(2025, 5, 10).date()
+        stats = UserStats.from_dates([today - timedelta(days=i) for i in [8, 7, 6, 5, 4, 2, 1, 0]])
+        self.assertEqual((stats.current_streak, stats.longest_streak), (3, 5))
+
+        self.assertFalse(stats.advance(today))
+        self.assertTrue(stats.advance(today + timedelta(days=1)))
+        self.assertEqual((stats.current_streak, stats.longest_streak), (4, 5))
+        self.assertTrue(stats.advance(today + timedelta(days=3)))
+        self.assertEqual((stats.current_streak, stats.longest_streak), (1, 5))
+
+    def test_submit_updates_stats(self):
+        """submitTest maintains the stats row"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        for _ in range(2):
+            self.client.post('/test/', {
+                'qpm': 50, 'raw': 50, 'accuracy': 90, 'mode': 'time',
+                'difficulty': 3, 'number': 0, 'time': 60000,
+            }, format='json')
+
+        stats = UserStats.objects.get(user=self.user)
+        self.assertEqual((stats.current_streak, stats.longest_streak), (1, 1))
+        self.assertIsNotNone(stats.last_active)
+
+        response = self.client.get('/user/')
+        self.assertEqual(response.data['streak'], {'user_streak': 1, 'longest_streak': 1})
+
+    def test_submit_seeds_missing_stats_from_history(self):
+        """A user who played before stats were tracked keeps their streak"""
+        now = timezone.now()
+        for days in [3, 2, 1]:
+            test = Test.objects.create(qpm=50, raw=50, accuracy=90, mode='time', difficulty=3,
+                                       number=0, time=60000, user=self.user)
+            Test.objects.filter(pk=test.pk).update(creation=now - timedelta(days=days))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        self.assertEqual(self.client.get('/user/').data['streak'], {'user_streak': 3, 'longest_streak': 3})
+
+        self.client.post('/test/', {
+            'qpm': 50, 'raw': 50, 'accuracy': 90, 'mode': 'time',
+            'difficulty': 3, 'number': 0, 'time': 60000,
+        }, format='json')
+
+        stats = UserStats.objects.get(user=self.user)
+        self.assertEqual((stats.current_streak, stats.longest_streak), (4, 4))
+        self.assertEqual(self.client.get('/user/').data['streak'], {'user_streak': 4, 'longest_streak': 4})
+
+    def test_rebuild_command(self):
+        """The rebuild command recomputes streaks from history"""
+        now = datetime.now()
+        for days_ago in [0, 1, 3, 4, 5]:
+            test = Test.objects.create(qpm=60, raw=55, accuracy=92, mode='time', difficulty=3,
+                                       number=0, time=60000, user=self.user)
+            # auto_now_add ignores the value passed to create()
+            Test.objects.filter(pk=test.pk).update(creation=now - timedelta(days=days_ago))
+
+        call_command('rebuild_user_stats', stdout=StringIO())
+
+        stats = UserStats.objects.get(user=self.user)
+        self.assertEqual((stats.current_streak, stats.longest_streak), (2, 3))
+        self.assertEqual(UserDataSerializer(self.user).data['streak'], {'user_streak': 2, 'longest_streak': 3})
+
+
+class BestScoresTests(TestCase):
+    """Tests for the windowed best-scores query"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='bestscores', password='testpassword123')
+        Settings.objects.create(theme='dark', font='Arial', user=self.user)
+        for qpm, difficulty, number, time in [
+            (50, 1, 0, 60000),
+            (70, 4, 0, 60000),
+            (95, 9, 0, 60000),   # difficulty outside 1-5 is not reported
+            (30, 2, 10, 0),
+            (45, 5, 10, 0),
+            (80, 3, 0, 45000),   # untracked duration
+        ]:
+            Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time' if time else 'questions',
+                                difficulty=difficulty, number=number, time=time, user=self.user)
+
+    def test_best_per_bucket(self):
+        """Every tracked bucket reports its best test or None"""
+        with self.assertNumQueries(1):
+            best_scores = UserDataSerializer().get_best_scores(self.user)
+
+        time_scores = {item['value']: item['test'] for item in best_scores['time']}
+        question_scores = {item['value']: item['test'] for item in best_scores['questions']}
+        self.assertEqual(list(time_scores), [30, 60, 120, 180])
+        self.assertEqual(list(question_scores), [5, 10, 15, 25])
+        self.assertEqual(time_scores[60]['qpm'], 70)
+        self.assertIsNone(time_scores[30])
+        self.assertEqual(question_scores[10]['qpm'], 45)
+        self.assertIsNone(question_scores[5])
+
+
+class ResponseCacheTests(APITestCase):
+    """Tests for the versioned leaderboard response cache"""
+
+    def setUp(self):
+        ranking.index = ranking.RankingIndex()
+        caches['default'].clear()
+        response_cache.stats.reset()
+        self.user = User.objects.create_user(username='cacheuser', password='testpassword123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def submit(self, qpm, difficulty=3):
+        return self.client.post('/test/', {
+            'qpm': qpm, 'raw': qpm, 'accuracy': 90, 'mode': 'time',
+            'difficulty': difficulty, 'number': 0, 'time': 60000,
+        }, format='json')
+
+    def test_hits_until_best_changes(self):
+        """Only a new best invalidates the cached board"""
+        self.submit(50)
+        self.assertEqual(self.client.get('/leaderboard/')['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/leaderboard/')['X-Cache'], 'HIT')
+
+        self.submit(40)
+        response = self.client.get('/leaderboard/')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.data['results'][0]['qpm'], 50)
+
+        self.submit(60)
+        response = self.client.get('/leaderboard/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['qpm'], 60)
+
+        self.assertEqual(response_cache.stats.snapshot()['leaderboard'], {'hits': 2, 'misses': 2})
+
+    def test_filtered_boards_follow_bucket_bests(self):
+        """Filtered boards are invalidated by bests within their own filter only"""
+        self.submit(80, difficulty=3)
+        self.client.get('/leaderboard/', {'time': 60, 'difficulty': 2})
+
+        self.submit(70, difficulty=3)
+        self.assertEqual(self.client.get('/leaderboard/', {'time': 60, 'difficulty': 2})['X-Cache'], 'HIT')
+
+        self.submit(30, difficulty=2)
+        response = self.client.get('/leaderboard/', {'time': 60, 'difficulty': 2})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['qpm'], 30)
+
+        # each filter has its own version: a best at difficulty 3 leaves this board cached
+        self.submit(95, difficulty=3)
+        self.assertEqual(self.client.get('/leaderboard/', {'time': 60, 'difficulty': 2})['X-Cache'], 'HIT')
+        self.assertEqual(self.client.get('/leaderboard/', {'time': 60})['X-Cache'], 'MISS')
+
+    def test_user_rank_cached(self):
+        """Rank lookups are cached under the leaderboard version"""
+        self.submit(50)
+        self.assertEqual(self.client.get('/userrank/', {'user': 'cacheuser'})['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/userrank/', {'user': 'cacheuser'})['X-Cache'], 'HIT')
+
+    def test_file_based_backend(self):
+        """The cache works with the file-based backend"""
+        with tempfile.TemporaryDirectory() as directory:
+            backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory}
+            with override_settings(CACHES={'default': backend}):
+                self.submit(50)
+                self.assertEqual(self.client.get('/leaderboard/')['X-Cache'], 'MISS')
+                response = self.client.get('/leaderboard/')
+                self.assertEqual(response['X-Cache'], 'HIT')
+                self.assertEqual(response.data['results'][0]['username'], 'cacheuser')
+
+
+class BatchSubmitTests(APITestCase):
+    """Tests for POST /test/batch/"""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user(username='batchuser', password='testpassword123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def item(self, qpm, **overrides):
+        return {'qpm': qpm, 'raw': qpm, 'accuracy': 90, 'mode': 'time',
+                'difficulty': 3, 'number': 0, 'time': 60000, **overrides}
+
+    def test_batch_inserts_and_updates_state_once(self):
+        """All rows are inserted and derived state reflects the batch best"""
+        items = [self.item(qpm) for qpm in [40, 75, 60]] + [self.item(30, mode='questions', number=10, time=0)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/test/batch/', items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 4)
+        self.assertTrue(all(row['user'] == self.user.id for row in response.data))
+        self.assertEqual(Test.objects.filter(user=self.user).count(), 4)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "core_test"')]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual(response.data, TestSerializer(Test.objects.filter(user=self.user).order_by('id'), many=True).data)
+
+        best = UserBest.objects.get(user=self.user)
+        self.assertEqual(best.qpm, 75)
+        self.assertEqual(UserStats.objects.get(user=self.user).current_streak, 1)
+
+    def test_per_item_errors(self):
+        """An invalid item rejects the batch and is reported by position"""
+        response = self.client.post('/test/batch/', [self.item(50), {'qpm': 20}], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['errors'][0], {})
+        self.assertIn('raw', response.data['errors'][1])
+        self.assertFalse(Test.objects.filter(user=self.user).exists())
+
+    def test_rejects_non_list_and_oversized(self):
+        """The body must be a list within the size limit"""
+        response = self.client.post('/test/batch/', self.item(50), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with override_settings(TEST_BATCH_MAX_SIZE=2):
+            response = self.client.post('/test/batch/', [self.item(50)] * 3, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class WriteBehindTests(APITestCase):
+    """Tests for the write-behind ingestion queue"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='queueuser', password='testpassword123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        self.writer = ingest.writer
+        # flushed explicitly on the test thread instead of by the background worker
+        ingest.writer = ingest.WriteBehindQueue(max_size=2, batch_size=10, autostart=False)
+
+    def tearDown(self):
+        ingest.writer = self.writer
+
+    def payload(self, qpm):
+        return {'qpm': qpm, 'raw': qpm, 'accuracy': 90, 'mode': 'time', 'difficulty': 3, 'number': 0, 'time': 60000}
+
+    def submit(self, qpm):
+        return self.client.post('/test/', {
+            'qpm': qpm, 'raw': qpm, 'accuracy': 90, 'mode': 'time',
+            'difficulty': 3, 'number': 0, 'time': 60000,
+        }, format='json')
+
+    @override_settings(TEST_WRITE_BEHIND={'ENABLED': True})
+    def test_queue_then_flush(self):
+        """Accepted submissions are written by the next flush"""
+        self.assertEqual(self.submit(50).status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.submit(70).status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(Test.objects.exists())
+        self.assertEqual(ingest.writer.depth(), 2)
+
+        ingest.writer.flush()
+
+        self.assertEqual(Test.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(UserBest.objects.get(user=self.user).qpm, 70)
+        stats = ingest.writer.stats()
+        self.assertEqual((stats['depth'], stats['flushed'], stats['flushes']), (0, 2, 1))
+
+    @override_settings(TEST_WRITE_BEHIND={'ENABLED': True})
+    def test_full_queue_writes_synchronously(self):
+        """Backpressure: a full queue falls back to a direct insert"""
+        self.submit(50)
+        self.submit(60)
+        response = self.submit(80)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Test.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(ingest.writer.stats()['rejected'], 1)
+
+    def test_disabled_by_default(self):
+        """Without the setting submissions are written immediately"""
+        self.assertEqual(self.submit(50).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(ingest.writer.depth(), 0)
+
+    def test_failed_flush_is_retried(self):
+        """A transient failure is retried instead of dropping the batch"""
+        writer = ingest.WriteBehindQueue(batch_size=10, retries=2, retry_backoff=0, autostart=False)
+        record, calls = submissions.record, []
+
+        def flaky(tests):
+            calls.append(len(tests))
+            if len(calls) == 1:
+                raise DatabaseError('database is locked')
+            record(tests)
+
+        submissions.record = flaky
+        try:
+            writer.put(self.user, self.payload(50))
+            writer.put(self.user, self.payload(70))
+            with self.assertLogs('core.ingest', 'WARNING'):
+                writer.flush()
+        finally:
+            submissions.record = record
+
+        self.assertEqual(calls, [2, 2])
+        self.assertEqual(Test.objects.filter(user=self.user).count(), 2)
+        stats = writer.stats()
+        self.assertEqual((stats['flushed'], stats['failed'], stats['retries']), (2, 0, 1))
+
+    def test_bad_item_does_not_sink_the_batch(self):
+        """A batch that keeps failing is written item by item"""
+        writer = ingest.WriteBehindQueue(batch_size=10, retries=1, retry_backoff=0, autostart=False)
+        writer.put(self.user, self.payload(50))
+        writer.put(self.user, {**self.payload(60), 'qpm': None})
+        writer.put(self.user, self.payload(70))
+        with self.assertLogs('core.ingest', 'ERROR'):
+            writer.flush()
+
+        self.assertEqual(sorted(Test.objects.filter(user=self.user).values_list('qpm', flat=True)), [50, 70])
+        self.assertEqual(UserBest.objects.get(user=self.user).qpm, 70)
+        stats = writer.stats()
+        self.assertEqual((stats['flushed'], stats['failed'], stats['retries']), (2, 1, 1))
+
+
+
+class AsyncViewTests(TestCase):
+    """Tests for the async read endpoints"""
+
+    def setUp(self):
+        caches['default'].clear()
+        ranking.index = ranking.RankingIndex()
+        self.user = User.objects.create_user(username='asyncuser', password='testpassword123')
+        Settings.objects.create(theme='dark', font='Arial', user=self.user)
+        test = Test.objects.create(qpm=70, raw=70, accuracy=90, mode='time', difficulty=3,
+                                   number=0, time=60000, user=self.user)
+        leaderboard.record_test(test)
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+
+    async def test_hi(self):
+        response = await self.async_client.get('/async/hi/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), 'hi')
+
+    async def test_leaderboard_matches_sync(self):
+        """The async board returns the same payload as the DRF view"""
+        response = await self.async_client.get('/async/leaderboard/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['results'][0]['username'], 'asyncuser')
+        self.assertEqual(response.json()['count'], 1)
+
+        response = await self.async_client.get('/async/leaderboard/', {'mode': 'nope'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_user_rank(self):
+        response = await self.async_client.get('/async/userrank/', {'user': 'asyncuser'})
+        self.assertEqual(response.json()['result'][0]['index'], 1)
+
+    async def test_user_data_requires_token(self):
+        """The async profile uses the JWT in the Authorization header"""
+        response = await self.async_client.get('/async/user/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = await self.async_client.get('/async/user/', headers={'Authorization': 'Bearer nonsense'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = await self.async_client.get('/async/user/', headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['username'], 'asyncuser')
+        self.assertEqual(response.json()['theme'], 'dark')
+
+    def test_middleware_chain_stays_async(self):
+        """Under ASGI no middleware makes Django run the chain in a thread"""
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    async def test_middleware_in_async_mode(self):
+        """Metrics and the concurrency limit also apply to async requests"""
+        metrics.registry.reset()
+        response = await self.async_client.get('/async/leaderboard/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        counters = metrics.registry.snapshot()['counters']
+        self.assertEqual(counters.get(
+            'brainsmath_requests_total{method="GET",route="/async/leaderboard/",status="200"}'), 1)
+
+        self.assertTrue(throttling.limiter.acquire('requests', 1, 0))
+        try:
+            with override_settings(ADMISSION={**settings.ADMISSION, 'MAX_REQUESTS': 1, 'QUEUE_TIMEOUT': 0.01}):
+                response = await self.async_client.get('/async/leaderboard/')
+        finally:
+            throttling.limiter.release('requests')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class SeedingTests(TestCase):
+    """Tests for the synthetic data generator"""
+
+    def test_deterministic(self):
+        """The same seed produces the same dataset"""
+        first = seeding.seed(5, 200, seed=7, prefix='alpha', batch_size=50)
+        second = seeding.seed(5, 200, seed=7, prefix='beta', batch_size=50)
+
+        def dataset(user_ids):
+            offset = {user_id: i for i, user_id in enumerate(user_ids)}
+            return sorted(
+                (offset[user_id], qpm, mode, difficulty, time, number)
+                for user_id, qpm, mode, difficulty, time, number in Test.objects.filter(user_id__in=user_ids)
+                .values_list('user_id', 'qpm', 'mode', 'difficulty', 'time', 'number')
+            )
+
+        self.assertEqual(len(dataset(first)), 200)
+        self.assertEqual(dataset(first), dataset(second))
+        self.assertEqual(UserBest.objects.count(), len(set(Test.objects.values_list('user_id', flat=True))))
+        self.assertEqual(Settings.objects.filter(user_id__in=first).count(), 5)
+
+
+@override_settings(PROFILING={**settings.PROFILING, 'ENABLED': True, 'SAMPLE_RATE': 0, 'SLOW_MS': None})
+class SampledProfilingTests(APITestCase):
+    """Tests for sampled request profiling"""
+
+    def setUp(self):
+        caches['default'].clear()
+        profiling.config.invalidate()
+        self.original_buffer = profiling.buffer
+        profiling.buffer = profiling.ProfileBuffer(autostart=False)
+
+    def tearDown(self):
+        profiling.buffer = self.original_buffer
+        caches['default'].clear()
+        profiling.config.invalidate()
+
+    def test_unsampled_requests_are_not_recorded(self):
+        """A zero sample rate with no slow threshold records nothing"""
+        self.client.get('/hi/')
+        self.assertEqual(len(profiling.buffer), 0)
+
+    def test_sampled_request_is_buffered_then_flushed(self):
+        """Sampled requests are buffered with their queries and written in one flush"""
+        profiling.set_endpoint('/leaderboard/', sample_rate=1)
+        self.client.get('/leaderboard/')
+        self.client.get('/hi/')
+        self.assertEqual(len(profiling.buffer), 1)
+        self.assertEqual(RequestProfile.objects.count(), 0)
+
+        self.assertEqual(profiling.buffer.flush(), 1)
+        profile = RequestProfile.objects.get()
+        self.assertEqual(profile.path, '/leaderboard/')
+        self.assertEqual(profile.reason, 'sampled')
+        self.assertEqual(profile.status_code, 200)
+        self.assertGreater(profile.query_count, 0)
+        self.assertEqual(len(profile.queries), profile.query_count)
+
+    def test_slow_threshold_keeps_unsampled_requests(self):
+        """Requests over slow_ms are kept even when not sampled"""
+        profiling.set_endpoint('/hi/', slow_ms=0)
+        self.client.get('/hi/')
+        profiling.buffer.flush()
+        self.assertEqual(RequestProfile.objects.get().reason, 'slow')
+
+    def test_disabled_endpoint_is_skipped(self):
+        """A runtime override can switch one endpoint off"""
+        with override_settings(PROFILING={**settings.PROFILING, 'ENABLED': True, 'SAMPLE_RATE': 1}):
+            profiling.set_endpoint('/hi/', enabled=False)
+            self.client.get('/hi/')
+            self.assertEqual(len(profiling.buffer), 0)
+            self.client.get('/leaderboard/')
+            self.assertEqual(len(profiling.buffer), 1)
+
+    def test_set_endpoint_validates_and_clears(self):
+        """Bad values are rejected and None removes an override"""
+        with self.assertRaises(ValueError):
+            profiling.set_endpoint('/hi/', sample_rate=2)
+        with self.assertRaises(ValueError):
+            profiling.set_endpoint('/hi/', rate=1)
+        profiling.set_endpoint('/hi/', sample_rate=0.5)
+        self.assertEqual(profiling.get_overrides(), {'/hi/': {'sample_rate': 0.5}})
+        profiling.set_endpoint('/hi/', sample_rate=None)
+        self.assertEqual(profiling.get_overrides(), {})
+
+    def test_overrides_reach_every_worker(self):
+        """Overrides live in the database, so another worker's config picks them up after OVERRIDES_TTL"""
+        other_worker = profiling.ProfilingConfig()
+        self.assertEqual(other_worker.for_path('/hi/')['sample_rate'], 0)
+        profiling.set_endpoint('/hi/', sample_rate=1)
+        self.assertEqual(other_worker.for_path('/hi/')['sample_rate'], 0)
+        with override_settings(PROFILING={**settings.PROFILING, 'ENABLED': True, 'SAMPLE_RATE': 0, 'OVERRIDES_TTL': 0}):
+            self.assertEqual(other_worker.for_path('/hi/')['sample_rate'], 1)
+        self.assertEqual(ProfilingOverride.objects.get().sample_rate, 1)
+
+    def test_disabled_profiling_ignores_overrides(self):
+        """ENABLED False turns every endpoint off without reading the overrides"""
+        profiling.set_endpoint('/hi/', enabled=True, sample_rate=1)
+        with override_settings(PROFILING={**settings.PROFILING, 'ENABLED': False}):
+            with self.assertNumQueries(0):
+                self.assertFalse(profiling.config.for_path('/hi/')['enabled'])
+                self.client.get('/hi/')
+        self.assertEqual(len(profiling.buffer), 0)
+
+    def test_toggle_view_is_staff_only(self):
+        """Only staff can read or change the profiling overrides"""
+        user = User.objects.create_user(username='profiler', password='testpassword123')
+        self.client.force_authenticate(user)
+        response = self.client.put('/profiling/', {'path': '/hi/', 'sample_rate': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        user.is_staff = True
+        user.save()
+        response = self.client.put('/profiling/', {'path': '/hi/', 'sample_rate': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['effective']['/hi/']['sample_rate'], 1)
+
+        response = self.client.put('/profiling/', {'path': '/hi/', 'sample_rate': 'lots'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+SCRAPE = {'HTTP_AUTHORIZATION': 'Bearer scrape-token'}
+scrape_token = override_settings(METRICS={**settings.METRICS, 'TOKEN': 'scrape-token'})
+
+
+@scrape_token
+class MetricsTests(APITestCase):
+    """Tests for the Prometheus metrics middleware and endpoint"""
+
+    def setUp(self):
+        caches['default'].clear()
+        metrics.registry.reset()
+        response_cache.stats.reset()
+
+    def sample(self, body, series):
+        for line in body.splitlines():
+            if line.startswith(series + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return None
+
+    def test_endpoint_needs_the_token_or_staff(self):
+        """Anonymous and wrong-token scrapes are refused, staff sessions may read"""
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer guess').status_code,
+                         status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.get('/metrics', **SCRAPE).status_code, status.HTTP_200_OK)
+        with override_settings(METRICS={**settings.METRICS, 'TOKEN': None}):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code,
+                             status.HTTP_403_FORBIDDEN)
+        self.client.force_login(User.objects.create_user(username='ops', password='testpassword123', is_staff=True))
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_200_OK)
+
+    def test_requests_are_recorded_per_route(self):
+        """Status counts, latency and query counts are labelled by route"""
+        self.client.get('/leaderboard/')
+        self.client.get('/leaderboard/')
+        self.client.get('/user/')
+        body = self.client.get('/metrics', **SCRAPE).content.decode()
+
+        self.assertEqual(self.sample(body, 'brainsmath_requests_total{method="GET",route="/leaderboard/",status="200"}'), 2)
+        self.assertEqual(self.sample(body, 'brainsmath_requests_total{method="GET",route="/user/",status="401"}'), 1)
+        self.assertEqual(self.sample(body, 'brainsmath_request_duration_seconds_count{method="GET",route="/leaderboard/"}'), 2)
+        self.assertEqual(
+            self.sample(body, 'brainsmath_request_duration_seconds_bucket{method="GET",route="/leaderboard/",le="+Inf"}'), 2)
+        self.assertGreater(self.sample(body, 'brainsmath_db_queries_total{route="/leaderboard/"}'), 0)
+        self.assertEqual(self.sample(body, 'brainsmath_response_cache_requests_total{namespace="leaderboard",result="hit"}'), 1)
+        self.assertIn('# TYPE brainsmath_request_duration_seconds histogram', body)
+
+    def test_unknown_paths_share_a_label(self):
+        """Unmatched URLs don't create a series per path"""
+        self.client.get('/nope-1')
+        self.client.get('/nope-2')
+        body = self.client.get('/metrics', **SCRAPE).content.decode()
+        self.assertEqual(self.sample(body, 'brainsmath_requests_total{method="GET",route="<unmatched>",status="404"}'), 2)
+
+    def test_threads_are_merged(self):
+        """Each thread records into its own shard and snapshots add them up"""
+        registry = metrics.Registry(buckets=(1, 2))
+
+        def work():
+            for value in (0.5, 1.5, 3):
+                registry.inc('brainsmath_requests_total', {'route': '/x'})
+                registry.observe('brainsmath_request_duration_seconds', {'route': '/x'}, value)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['counters']['brainsmath_requests_total{route="/x"}'], 12)
+        self.assertEqual(snapshot['histograms']['brainsmath_request_duration_seconds{route="/x"}'], [4, 4, 4, 20.0, 12])
+
+    def test_worker_files_are_merged(self):
+        """With a shared directory a scrape includes every worker's snapshot"""
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(METRICS={**settings.METRICS, 'DIR': directory}):
+            other = metrics.Registry()
+            other.inc('brainsmath_requests_total', {'method': 'GET', 'route': '/hi/', 'status': 200}, 5)
+            metrics.FileStore(directory).write(other.snapshot())
+            os.rename(os.path.join(directory, f'metrics-{os.getpid()}.json'), os.path.join(directory, 'metrics-1.json'))
+
+            self.client.get('/hi/')
+            body = self.client.get('/metrics', **SCRAPE).content.decode()
+            self.assertEqual(self.sample(body, 'brainsmath_requests_total{method="GET",route="/hi/",status="200"}'), 6)
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_exited_workers_are_folded_into_the_aggregate(self):
+        """Counters of exited workers are kept once, their gauges dropped"""
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(METRICS={**settings.METRICS, 'DIR': directory}):
+            with open(os.path.join(directory, f'metrics-{exited.pid}.json'), 'w') as file:
+                json.dump({
+                    'buckets': list(metrics.LATENCY_BUCKETS),
+                    'counters': {'brainsmath_admission_rejected_total{limit="exited"}': 3},
+                    'gauges': {'brainsmath_write_behind_depth': 7},
+                    'histograms': {},
+                    'process': 'exited',
+                }, file)
+
+            for _ in range(2):
+                body = self.client.get('/metrics', **SCRAPE).content.decode()
+                self.assertEqual(self.sample(body, 'brainsmath_admission_rejected_total{limit="exited"}'), 3)
+                self.assertEqual(self.sample(body, 'brainsmath_write_behind_depth'), 0)
+            self.assertEqual(sorted(os.listdir(directory)), sorted(['metrics-aggregate.json', f'metrics-{os.getpid()}.json']))
+
+    def test_reused_pid_does_not_reset_counters(self):
+        """A worker that reuses a dead worker's pid folds the old file in first"""
+        with tempfile.TemporaryDirectory() as directory:
+            store = metrics.FileStore(directory)
+            with open(store.path(), 'w') as file:
+                json.dump({'counters': {'brainsmath_requests_total{route="/x"}': 5}, 'gauges': {}, 'histograms': {},
+                           'process': 'an earlier worker'}, file)
+
+            current = metrics.Registry()
+            current.inc('brainsmath_requests_total', {'route': '/x'}, 2)
+            store.write(current.snapshot())
+            store.write(current.snapshot())
+
+            merged = metrics.merge(store.read_all())
+            self.assertEqual(merged['counters']['brainsmath_requests_total{route="/x"}'], 7)
+
+
+class CachedAuthenticationTests(APITestCase):
+    """Tests for the cached JWT user lookup"""
+
+    def setUp(self):
+        authentication.user_cache.clear()
+        self.user = User.objects.create_user(username='cacheduser', password='testpassword123')
+        Settings.objects.create(theme='dark', font='Arial', user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        self.item = {'qpm': 50, 'raw': 55, 'accuracy': 90, 'mode': 'time', 'difficulty': 3, 'number': 0, 'time': 60000}
+
+    def auth_queries(self, request):
+        with CaptureQueriesContext(connection) as queries:
+            response = request()
+        return response, [q['sql'] for q in queries.captured_queries if 'FROM "auth_user"' in q['sql']]
+
+    def test_second_request_skips_user_lookup(self):
+        """Only the first authenticated request loads the user row"""
+        response, lookups = self.auth_queries(lambda: self.client.post('/test/', self.item, format='json'))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(lookups), 1)
+
+        response, lookups = self.auth_queries(lambda: self.client.post('/test/', self.item, format='json'))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(lookups, [])
+        self.assertEqual(Test.objects.filter(user=self.user).count(), 2)
+
+        response, lookups = self.auth_queries(lambda: self.client.put('/user/', {'font': 'mono'}, format='json'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(lookups, [])
+
+    def test_user_changes_invalidate_the_cache(self):
+        """Saving or deleting the user drops the cached row"""
+        self.client.get('/user/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/user/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.client.get('/user/').status_code, status.HTTP_200_OK)
+        self.user.delete()
+        self.assertEqual(self.client.get('/user/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_entries_expire(self):
+        """Rows changed behind the cache's back are reloaded after the TTL"""
+        with override_settings(AUTH_USER_CACHE={'TTL': 60}):
+            self.client.get('/user/')
+            User.objects.filter(pk=self.user.pk).update(is_active=False)
+            self.assertEqual(self.client.get('/user/').status_code, status.HTTP_200_OK)
+        with override_settings(AUTH_USER_CACHE={'TTL': -1}):
+            authentication.user_cache.put(self.user)
+            self.assertEqual(self.client.get('/user/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cached_users_are_separate_instances(self):
+        """Every hit builds its own User"""
+        authentication.user_cache.put(self.user)
+        first = authentication.user_cache.get(self.user.pk)
+        first.username = 'changed'
+        self.assertEqual(authentication.user_cache.get(self.user.pk).username, 'cacheduser')
+        self.assertFalse(first._state.adding)
+
+
+class ProfileCacheTests(APITestCase):
+    """Tests for the versioned /user/ payload cache and its ETag"""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user(username='profileuser', password='testpassword123')
+        Settings.objects.create(theme='dark', font='Arial', user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        self.item = {'qpm': 50, 'raw': 55, 'accuracy': 90, 'mode': 'time', 'difficulty': 3, 'number': 0, 'time': 60000}
+
+    def test_payload_is_cached_until_a_write(self):
+        """Submitting a test or changing settings invalidates the cached payload"""
+        first = self.client.get('/user/')
+        self.assertEqual(first['X-Cache'], 'MISS')
+        second = self.client.get('/user/')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first['ETag'], second['ETag'])
+
+        self.client.post('/test/', self.item, format='json')
+        response = self.client.get('/user/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertEqual(len(response.data['tests']), 1)
+
+        self.client.put('/user/', {'font': 'mono'}, format='json')
+        response = self.client.get('/user/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['font'], 'mono')
+
+    def test_matching_etag_returns_304(self):
+        """A current ETag is answered with 304 after only the version read"""
+        etag = self.client.get('/user/')['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/user/', HTTP_IF_NONE_MATCH=f'"other", W/{etag}')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len([q for q in queries.captured_queries if 'core_counter' not in q['sql']]), 0)
+
+        self.client.post('/test/batch/', [self.item, self.item], format='json')
+        response = self.client.get('/user/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['tests']), 2)
+
+    def test_rebuild_invalidates_every_profile(self):
+        """rebuild_user_stats bumps the global profile version"""
+        etag = self.client.get('/user/')['ETag']
+        call_command('rebuild_user_stats', stdout=StringIO())
+        self.assertEqual(self.client.get('/user/', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_async_view_shares_the_cache(self):
+        """The async endpoint serves the same cached payload and ETag"""
+        etag = self.client.get('/user/')['ETag']
+        response = self.client.get('/async/user/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get('/async/user/')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response['ETag'], etag)
+
+
+class TestRowSerializerTests(TestCase):
+    """The precompiled row serializer matches TestSerializer"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='rowuser', password='testpassword123')
+        for qpm in [40, 55.5]:
+            Test.objects.create(qpm=qpm, raw=60, accuracy=90, mode='time', difficulty=2, number=0,
+                                time=60000, user=self.user)
+
+    def rows(self):
+        return TEST_ROWS.many(Test.objects.order_by('id').values_list(*TEST_ROWS.columns))
+
+    def test_matches_model_serializer(self):
+        """Same keys, order and values as TestSerializer, in UTC and in other timezones"""
+        expected = TestSerializer(Test.objects.order_by('id'), many=True).data
+        self.assertEqual(json.dumps(self.rows()), json.dumps(expected))
+        with timezone.override('Europe/Berlin'):
+            expected = TestSerializer(Test.objects.order_by('id'), many=True).data
+            self.assertEqual(self.rows(), expected)
+            self.assertTrue(self.rows()[0]['creation'].endswith(('+01:00', '+02:00')))
+
+    def test_raw_values_are_normalized(self):
+        """Naive and string datetimes from raw SQL render like aware ones"""
+        test = Test.objects.first()
+        expected = TestSerializer(test).data['creation']
+        naive = test.creation.replace(tzinfo=None)
+        self.assertEqual(serialize_datetime(naive), expected)
+        self.assertEqual(serialize_datetime(naive.isoformat(sep=' ')), expected)
+
+    def test_passes_other_columns_through(self):
+        """Unknown columns are kept and can be renamed"""
+        rows = row_serializer(('test_id', 'qpm', 'username'), ('id', 'qpm', 'username'))
+        self.assertEqual(rows.row((7, 50, 'someone')), {'id': 7, 'qpm': 50.0, 'username': 'someone'})
+
+    def test_leaderboard_rows_match_profile_format(self):
+        """Raw SQL leaderboard rows format creation like the serializer"""
+        call_command('backfill_user_best', stdout=StringIO())
+        row = leaderboard.page(10, 0)['results'][0]
+        self.assertEqual(row['creation'], TestSerializer(Test.objects.get(pk=row['id'])).data['creation'])
+
+
+class PeriodLeaderboardTests(APITestCase):
+    """Tests for the daily, weekly and monthly boards"""
+
+    def setUp(self):
+        caches['default'].clear()
+        ranking.index = ranking.RankingIndex()
+        self.users = [User.objects.create_user(username=f'period{i}', password='testpassword123') for i in range(3)]
+
+    def submit(self, user, qpm, days_ago=0):
+        with seeding.explicit_creation():
+            test = Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time', difficulty=3, number=0,
+                                       time=60000, user=user, creation=timezone.now() - timedelta(days=days_ago))
+        submissions.record([test])
+        return test
+
+    def test_period_math(self):
+        """Weeks start on Monday and months roll over years"""
+        day = datetime(2025, 1, 15).date()
+        self.assertEqual(periods.period_start('week', day), datetime(2025, 1, 13).date())
+        self.assertEqual(periods.period_start('month', day), datetime(2025, 1, 1).date())
+        self.assertEqual(periods.previous_start('month', datetime(2025, 1, 1).date(), 2), datetime(2024, 11, 1).date())
+        self.assertEqual(periods.previous_start('week', datetime(2025, 1, 13).date()), datetime(2025, 1, 6).date())
+
+    def test_rows_track_the_best_per_period(self):
+        """A new best updates every period it falls in, a worse test changes nothing"""
+        self.submit(self.users[0], 50)
+        self.assertEqual(PeriodBest.objects.filter(user=self.users[0]).count(), 3)
+        self.submit(self.users[0], 40)
+        self.assertEqual(set(PeriodBest.objects.values_list('qpm', flat=True)), {50})
+        best = self.submit(self.users[0], 70)
+        self.assertEqual(set(PeriodBest.objects.values_list('test_id', flat=True)), {best.pk})
+
+    def test_concurrent_first_submission_of_a_period(self):
+        """Losing the race to insert a period's row retries against the committed row instead of failing"""
+        self.submit(self.users[0], 60)
+        for qpm, improved in [(50, False), (70, True)]:
+            with seeding.explicit_creation():
+                test = Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time', difficulty=3, number=0,
+                                           time=60000, user=self.users[0], creation=timezone.now())
+            with hide_rows_once(PeriodBest):
+                self.assertEqual(periods.record_tests([test]), improved)
+        self.assertEqual(PeriodBest.objects.filter(user=self.users[0]).count(), 3)
+        self.assertEqual(set(PeriodBest.objects.values_list('qpm', flat=True)), {70})
+
+    def test_window_boards(self):
+        """?window= ranks only the tests of the current period"""
+        self.submit(self.users[0], 90, days_ago=40)
+        self.submit(self.users[0], 30)
+        self.submit(self.users[1], 60)
+        self.submit(self.users[2], 45, days_ago=40)
+
+        response = self.client.get('/leaderboard/', {'window': 'day'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['username'] for row in response.data['results']], ['period1', 'period0'])
+        self.assertEqual(response.data['results'][1]['qpm'], 30)
+        self.assertEqual(response.data['count'], 2)
+
+        past = (timezone.localdate() - timedelta(days=40)).isoformat()
+        response = self.client.get('/leaderboard/', {'window': 'month', 'date': past})
+        self.assertEqual([row['username'] for row in response.data['results']], ['period0', 'period2'])
+
+        response = self.client.get('/leaderboard/')
+        self.assertEqual(response.data['results'][0]['qpm'], 90)
+
+        response = self.client.get('/userrank/', {'window': 'week', 'user': 'period0'})
+        self.assertEqual(response.data['result'][0]['index'], 2)
+        response = self.client.get('/userrank/', {'window': 'week', 'rank': 1})
+        self.assertEqual(response.data['result'][0]['username'], 'period1')
+        response = self.client.get('/async/userrank/', {'window': 'week', 'user': 'period0'})
+        self.assertEqual(response.json()['result'][0]['index'], 2)
+
+    def test_invalid_windows(self):
+        """Unknown windows, bad dates and filter combinations are rejected"""
+        for params in [{'window': 'year'}, {'window': 'day', 'date': 'soon'}, {'window': 'week', 'mode': 'time'}]:
+            self.assertEqual(self.client.get('/leaderboard/', params).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/userrank/', {'window': 'year'}).status_code, status.HTTP_400_BAD_REQUEST)
+        for rank in ('0', '-2', 'first'):
+            for path in ('/userrank/', '/async/userrank/'):
+                response = self.client.get(path, {'window': 'week', 'rank': rank})
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, (path, rank))
+
+    def test_new_best_invalidates_cached_board(self):
+        """The cached window board is refreshed after a submission"""
+        self.submit(self.users[0], 50)
+        self.client.get('/leaderboard/', {'window': 'day'})
+        self.submit(self.users[1], 60)
+        response = self.client.get('/leaderboard/', {'window': 'day'})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['count'], 2)
+
+    def test_compaction_keeps_recent_periods_and_old_top_rows(self):
+        """Ended periods beyond the retention keep only their top rows"""
+        for i, user in enumerate(self.users):
+            self.submit(user, 50 + i, days_ago=20)
+            self.submit(user, 40 + i)
+        deleted = periods.compact({'day': 7, 'week': 1, 'month': 12}, keep_top=1)
+        self.assertEqual(deleted, 4)  # 2 of the old day and 2 of the old week
+        self.assertEqual(PeriodBest.objects.filter(period='day').count(), 4)
+        old_day = PeriodBest.objects.filter(period='day', period_start__lt=timezone.localdate())
+        self.assertEqual(list(old_day.values_list('username', flat=True)), ['period2'])
+
+    def test_rebuild_matches_incremental_rows(self):
+        """Rebuilding from core_test gives the rows submissions produced"""
+        for i, user in enumerate(self.users):
+            self.submit(user, 50 + i, days_ago=3)
+            self.submit(user, 45 + i)
+
+        def rows():
+            return sorted(PeriodBest.objects.values_list('period', 'period_start', 'user_id', 'test_id', 'qpm'))
+
+        incremental = rows()
+        periods.rebuild()
+        self.assertEqual(rows(), incremental)
+
+
+class PercentileTests(APITestCase):
+    """Tests for the qpm histogram and /percentile/"""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.users = [User.objects.create_user(username=f'pct{i}', password='testpassword123') for i in range(4)]
+
+    def submit(self, user, qpm, mode='time', difficulty=3):
+        test = Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode=mode, difficulty=difficulty, number=0,
+                                   time=60000, user=user)
+        submissions.record([test])
+        return test
+
+    def buckets(self, scope='*:*'):
+        return dict(QpmBucket.objects.filter(scope=scope, users__gt=0).values_list('bucket', 'users'))
+
+    def test_concurrent_first_submission_of_a_scope(self):
+        """Losing the race to insert a scope's best retries against the committed row, counting the user once"""
+        self.submit(self.users[0], 42)
+        for qpm, improved in [(40, False), (57, True)]:
+            test = Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time', difficulty=3, number=0,
+                                       time=60000, user=self.users[0])
+            with hide_rows_once(QpmBest):
+                self.assertEqual(histogram.record_tests([test]), improved)
+        self.assertEqual(self.buckets(), {histogram.bucket_of(57): 1})
+        self.assertEqual(set(QpmBest.objects.values_list('qpm', flat=True)), {57})
+
+    def test_best_moves_between_buckets(self):
+        """A new best moves the user to its bucket in every scope, a worse test changes nothing"""
+        self.submit(self.users[0], 42)
+        self.assertEqual(self.buckets(), {8: 1})
+        self.assertEqual(QpmBest.objects.filter(user=self.users[0]).count(), 4)
+        self.submit(self.users[0], 30)
+        self.assertEqual(self.buckets(), {8: 1})
+        self.submit(self.users[0], 61)
+        self.assertEqual(self.buckets(), {12: 1})
+        self.assertEqual(self.buckets('time:3'), {12: 1})
+        self.submit(self.users[0], 50, difficulty=1)
+        self.assertEqual(self.buckets(), {12: 1})
+        self.assertEqual(self.buckets('*:1'), {10: 1})
+
+    def test_percentile(self):
+        """?user= is compared with everyone else, ?qpm= with everyone"""
+        for user, qpm in zip(self.users, [20, 40, 60, 80]):
+            self.submit(user, qpm)
+        response = self.client.get('/percentile/', {'user': 'pct2'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['qpm'], 60)
+        self.assertEqual(response.data['percentile'], 66.7)
+        self.assertEqual(response.data['players'], 4)
+        self.assertEqual(len(response.data['distribution']), 17)
+        self.assertEqual(response.data['distribution'][4], {'qpm': 20, 'users': 1})
+
+        self.assertEqual(self.client.get('/percentile/', {'qpm': 100}).data['percentile'], 100.0)
+        self.assertEqual(self.client.get('/percentile/', {'qpm': 0}).data['percentile'], 0.0)
+        response = self.client.get('/percentile/', {'user': 'nobody'})
+        self.assertIsNone(response.data['percentile'])
+
+    def test_scopes(self):
+        """mode and difficulty pick the histogram of matching tests"""
+        self.submit(self.users[0], 80, mode='questions', difficulty=1)
+        self.submit(self.users[0], 30)
+        self.submit(self.users[1], 50)
+        response = self.client.get('/percentile/', {'user': 'pct0', 'mode': 'time', 'difficulty': 3})
+        self.assertEqual(response.data['qpm'], 30)
+        self.assertEqual(response.data['percentile'], 0.0)
+        self.assertEqual(self.client.get('/percentile/', {'user': 'pct0'}).data['percentile'], 100.0)
+        for params in [{'mode': 'sprint'}, {'difficulty': 'hard'}, {'qpm': 'fast'}, {'qpm': 'inf'}]:
+            self.assertEqual(self.client.get('/percentile/', params).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cached_percentile_follows_new_bests(self):
+        """The cached payload is refreshed after a best changes, even within a bucket"""
+        self.submit(self.users[0], 41)
+        self.client.get('/percentile/', {'user': 'pct0'})
+        self.submit(self.users[0], 42)
+        response = self.client.get('/percentile/', {'user': 'pct0'})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['qpm'], 42)
+
+    def test_rebuild_matches_incremental_rows(self):
+        """Rebuilding from core_test gives the counts submissions produced"""
+        for i, user in enumerate(self.users):
+            self.submit(user, 30 + i * 7, difficulty=1 + i % 2)
+            self.submit(user, 45 - i, mode='questions')
+
+        def rows():
+            return (sorted(QpmBest.objects.values_list('user_id', 'scope', 'qpm')),
+                    sorted(QpmBucket.objects.filter(users__gt=0).values_list('scope', 'bucket', 'users')))
+
+        incremental = rows()
+        self.assertEqual(histogram.rebuild(), 4)
+        self.assertEqual(rows(), incremental)
+
+
+class HistoryTests(APITestCase):
+    """Tests for /history/"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='historian', password='testpassword123')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        now = timezone.now().replace(hour=12)
+        with seeding.explicit_creation():
+            # two tests per day over five days, the second one of each day at the same instant as the first
+            self.tests = Test.objects.bulk_create([
+                Test(qpm=40 + day * 10 + i, raw=50, accuracy=80 + i * 10, mode='time', difficulty=3, number=0,
+                     time=60000, user=self.user, creation=now - timedelta(days=day))
+                for day in range(5) for i in range(2)
+            ])
+        Test.objects.create(qpm=99, raw=99, accuracy=99, mode='time', difficulty=3, number=0, time=60000,
+                            user=User.objects.create_user(username='other', password='testpassword123'))
+
+    def test_pages_follow_creation_then_id(self):
+        """Cursor pages are newest first, don't skip tests sharing a timestamp and end with next=None"""
+        seen, params = [], {'limit': 3}
+        while True:
+            response = self.client.get('/history/', params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(row['id'] for row in response.data['results'])
+            if response.data['next'] is None:
+                break
+            params = {'limit': 3, 'cursor': response.data['next']}
+        expected = [test.pk for test in sorted(self.tests, key=lambda test: (test.creation, test.pk), reverse=True)]
+        self.assertEqual(seen, expected)
+
+    def test_daily_aggregates(self):
+        """aggregate=day returns one point per day with averages and maxima"""
+        response = self.client.get('/history/', {'aggregate': 'day', 'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        latest = response.data['results'][0]
+        self.assertEqual(latest['tests'], 2)
+        self.assertEqual(latest['qpm_avg'], 40.5)
+        self.assertEqual(latest['qpm_max'], 41)
+        self.assertEqual(latest['accuracy_avg'], 85)
+        self.assertEqual(len(response.data['results']), 2)
+
+        rest = self.client.get('/history/', {'aggregate': 'day', 'cursor': response.data['next']})
+        self.assertEqual([row['qpm_max'] for row in rest.data['results']], [61, 71, 81])
+        self.assertIsNone(rest.data['next'])
+
+        weeks = self.client.get('/history/', {'aggregate': 'week'}).data['results']
+        self.assertEqual(sum(row['tests'] for row in weeks), 10)
+
+    def test_invalid_parameters(self):
+        """Bad cursors, limits and aggregates are rejected; anonymous users are not let in"""
+        for params in [{'cursor': 'nope'}, {'limit': 0}, {'limit': 'all'}, {'aggregate': 'year'}]:
+            self.assertEqual(self.client.get('/history/', params).status_code, status.HTTP_400_BAD_REQUEST)
+        daily = self.client.get('/history/', {'aggregate': 'day', 'limit': 1}).data['next']
+        self.assertEqual(self.client.get('/history/', {'cursor': daily}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.credentials()
+        self.assertEqual(self.client.get('/history/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ConditionalGetTests(APITestCase):
+    """Tests for ETags on the leaderboard, userrank and percentile endpoints"""
+
+    def setUp(self):
+        caches['default'].clear()
+        ranking.index = ranking.RankingIndex()
+        self.users = [User.objects.create_user(username=f'etag{i}', password='testpassword123') for i in range(3)]
+        for i, user in enumerate(self.users):
+            self.submit(user, 40 + i)
+
+    def submit(self, user, qpm):
+        test = Test.objects.create(qpm=qpm, raw=qpm, accuracy=90, mode='time', difficulty=3, number=0,
+                                   time=60000, user=user)
+        submissions.record([test])
+
+    @override_settings(RESPONSE_CACHE={'ENABLED': False})
+    def test_matching_etag_returns_304_after_the_version_read(self):
+        """An unchanged board is answered from its version stamp alone, without ranking SQL"""
+        for path, params in [('/leaderboard/', {}), ('/leaderboard/', {'time': 60}), ('/userrank/', {'user': 'etag1'}),
+                             ('/leaderboard/', {'window': 'week'}), ('/percentile/', {'user': 'etag1'})]:
+            with self.subTest(path=path, params=params):
+                etag = self.client.get(path, params)['ETag']
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(path, params, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(response['ETag'], etag)
+                self.assertEqual(len(queries), 1)
+
+    def test_etag_changes_with_data_and_parameters(self):
+        """A new best or different parameters make the old ETag stale"""
+        etag = self.client.get('/leaderboard/')['ETag']
+        self.assertNotEqual(self.client.get('/leaderboard/', {'page': 2})['ETag'], etag)
+        self.submit(self.users[0], 90)
+        response = self.client.get('/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['results'][0]['username'], 'etag0')
+
+    def test_async_views_share_the_etags(self):
+        """The async views answer the same ETags with 304"""
+        etag = self.client.get('/leaderboard/')['ETag']
+        self.assertEqual(self.client.get('/async/leaderboard/', HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get('/async/userrank/', {'user': 'etag2'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get('/userrank/', {'user': 'etag2'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class ReplicaStickinessTests(TestCase):
+    """Tests for remembering clients that just wrote"""
+
+    def setUp(self):
+        caches['default'].clear()
+        routing._cache().clear()
+
+    def test_writers_stick_to_the_primary(self):
+        """A write marks the client's token for STICKY_SECONDS"""
+        factory = RequestFactory()
+        writer = factory.post('/test/', HTTP_AUTHORIZATION='Bearer a', REMOTE_ADDR='10.0.0.1')
+        routing.mark_written(writer)
+        self.assertTrue(routing.is_sticky(factory.get('/user/', HTTP_AUTHORIZATION='Bearer a', REMOTE_ADDR='10.0.0.9')))
+        self.assertFalse(routing.is_sticky(factory.get('/user/', HTTP_AUTHORIZATION='Bearer b', REMOTE_ADDR='10.0.0.2')))
+        with override_settings(DATABASE_REPLICA={'STICKY_SECONDS': 0}):
+            routing.mark_written(factory.post('/test/', HTTP_AUTHORIZATION='Bearer c'))
+        self.assertFalse(routing.is_sticky(factory.get('/user/', HTTP_AUTHORIZATION='Bearer c')))
+
+    def test_shared_address_does_not_pin_other_clients(self):
+        """Behind a proxy one client's write leaves everyone else on the replica"""
+        factory = RequestFactory()
+        routing.mark_written(factory.post('/test/', HTTP_AUTHORIZATION='Bearer a', REMOTE_ADDR='10.0.0.1'))
+        routing.mark_written(factory.post('/register/', REMOTE_ADDR='10.0.0.1'))
+        self.assertFalse(routing.is_sticky(factory.get('/leaderboard/', REMOTE_ADDR='10.0.0.1')))
+        self.assertFalse(routing.is_sticky(factory.get('/user/', HTTP_AUTHORIZATION='Bearer b', REMOTE_ADDR='10.0.0.1')))
+
+    def test_replica_needs_a_shared_cache(self):
+        """A replica with a per-process stickiness cache is refused at startup"""
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(routing, 'replica_alias', return_value='replica'):
+            with override_settings(DATABASE_REPLICA={**settings.DATABASE_REPLICA, 'CACHE_ALIAS': 'default'}):
+                with self.assertRaises(ImproperlyConfigured):
+                    routing.check()
+            shared = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory}
+            with override_settings(CACHES={**settings.CACHES, 'shared': shared},
+                                   DATABASE_REPLICA={**settings.DATABASE_REPLICA, 'CACHE_ALIAS': 'shared'}):
+                routing.check()
+
+    def test_execute_wrapper_covers_every_alias(self):
+        """Metrics and profiles see the queries of every database, the replica's included"""
+        def wrapper(execute, sql, params, many, context):
+            return execute(sql, params, many, context)
+        with routing.execute_wrapper(wrapper):
+            for alias in connections:
+                self.assertIn(wrapper, connections[alias].execute_wrappers)
+        for alias in connections:
+            self.assertNotIn(wrapper, connections[alias].execute_wrappers)
+
+    def test_without_a_replica_everything_reads_from_default(self):
+        """No replica configured: the router and raw SQL use the default database"""
+        if routing.replica_alias() is not None:
+            self.skipTest('a replica is configured')
+        with routing.replica_reads():
+            self.assertEqual(routing.read_connection().alias, 'default')
+            self.assertEqual(routing.ReplicaRouter().db_for_read(Test), None)
+
+
+# REPLICA_DATABASE_URL=sqlite:///replica.sqlite3 SHARED_CACHE_DIR=/tmp/brainsmath-cache \
+#     python manage.py test core.tests.ReplicaRoutingTests
+@skipUnless('replica' in settings.DATABASES, 'set REPLICA_DATABASE_URL to run the replica tests')
+class ReplicaRoutingTests(APITestCase):
+    """Tests for reads going to the replica; its test database is separate, so it stays empty"""
+
+    databases = {'default', 'replica'} if 'replica' in settings.DATABASES else {'default'}
+
+    def setUp(self):
+        caches['default'].clear()
+        routing._cache().clear()
+        ranking.index = ranking.RankingIndex()
+        self.user = User.objects.create_user(username='writer', password='testpassword123')
+        self.token = f'Bearer {RefreshToken.for_user(self.user).access_token}'
+        submissions.record([Test.objects.create(qpm=50, raw=50, accuracy=90, mode='time', difficulty=3,
+                                                number=0, time=60000, user=self.user)])
+
+    def test_reads_go_to_the_replica(self):
+        """ORM and raw SQL reads of GET requests come from the replica"""
+        self.assertEqual(self.client.get('/leaderboard/', REMOTE_ADDR='10.0.0.1').data['results'], [])
+        self.assertEqual(self.client.get('/percentile/', {'user': 'writer'}, REMOTE_ADDR='10.0.0.1').data['players'], 0)
+        with routing.replica_reads():
+            self.assertEqual(routing.read_connection().alias, 'replica')
+            with routing.primary():
+                self.assertEqual(routing.read_connection().alias, 'default')
+
+    def test_writers_read_their_writes(self):
+        """After a write the same client reads from the primary, other clients still from the replica"""
+        response = self.client.post('/test/', {'qpm': 60, 'raw': 60, 'accuracy': 90, 'mode': 'time', 'difficulty': 3,
+                                               'number': 0, 'time': 60000},
+                                    format='json', HTTP_AUTHORIZATION=self.token, REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get('/leaderboard/', HTTP_AUTHORIZATION=self.token, REMOTE_ADDR='10.0.0.6')
+        self.assertEqual(response.data['results'][0]['qpm'], 60)
+        self.assertEqual(self.client.get('/leaderboard/', REMOTE_ADDR='10.0.0.7').data['results'], [])
+
+    def test_ranking_index_refreshes_from_the_primary(self):
+        """The per-process index never loads the lagging replica"""
+        response = self.client.get('/userrank/', {'user': 'writer'}, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.data['result'][0]['index'], 1)
+
+
+class SqliteTuningTests(TestCase):
+    """Tests for the SQLite connection hook"""
+
+    def test_pragmas_follow_settings(self):
+        """Configured values become PRAGMA statements, None and "" keep the defaults"""
+        with override_settings(SQLITE={'JOURNAL_MODE': 'WAL', 'SYNCHRONOUS': '', 'BUSY_TIMEOUT': '250',
+                                       'CACHE_SIZE': None}):
+            self.assertEqual(sqlite.pragmas(), ['PRAGMA journal_mode = WAL', 'PRAGMA busy_timeout = 250'])
+        for options in [{'JOURNAL_MODE': 'fast'}, {'BUSY_TIMEOUT': 'long'}]:
+            with self.subTest(options=options), override_settings(SQLITE=options):
+                with self.assertRaises(ImproperlyConfigured):
+                    sqlite.pragmas()
+        with override_settings(SQLITE={'TRANSACTION_MODE': 'eager'}):
+            with self.assertRaises(ImproperlyConfigured):
+                sqlite.transaction_mode()
+
+    def test_new_connections_are_tuned(self):
+        """The hook sets the pragmas and the transaction mode on a new connection"""
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        fresh = connections.create_connection('default')
+        self.addCleanup(fresh.close)
+        with override_settings(SQLITE={'SYNCHRONOUS': 'off', 'BUSY_TIMEOUT': 1234, 'CACHE_SIZE': -4096,
+                                       'TRANSACTION_MODE': 'immediate'}):
+            fresh.ensure_connection()
+        current = sqlite.current(fresh)
+        self.assertEqual(current['synchronous'], 0)
+        self.assertEqual(current['busy_timeout'], 1234)
+        self.assertEqual(current['cache_size'], -4096)
+        self.assertEqual(current['transaction_mode'], 'IMMEDIATE')
+
+
+def throttle_rates(**rates):
+    return override_settings(THROTTLING={'ENABLED': True, 'RATES': {
+        scope: {'RATE': rate, 'BURST': burst} for scope, (rate, burst) in rates.items()
+    }})
+
+
+class ThrottlingTests(APITestCase):
+    """Tests for the token-bucket throttles and the concurrency limit"""
+
+    def setUp(self):
+        caches['default'].clear()
+        throttling.memory_store.clear()
+        throttling.stats.reset()
+        self.user = User.objects.create_user(username='flooder', password='testpassword123')
+        self.other = User.objects.create_user(username='neighbour', password='testpassword123')
+
+    def submit(self, user):
+        token = RefreshToken.for_user(user).access_token
+        return self.client.post('/test/', {'qpm': 50, 'raw': 55, 'accuracy': 90, 'mode': 'time', 'difficulty': 3,
+                                           'number': 0, 'time': 60000},
+                                format='json', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_bucket_refills_over_time(self):
+        """A bucket allows BURST requests at once, then one per refill interval"""
+        state = None
+        for _ in range(2):
+            allowed, state, wait = throttling.refill(state, rate=0.5, capacity=2, now=100)
+            self.assertTrue(allowed)
+        allowed, state, wait = throttling.refill(state, rate=0.5, capacity=2, now=100)
+        self.assertFalse(allowed)
+        self.assertEqual(wait, 2)
+        self.assertTrue(throttling.refill(state, rate=0.5, capacity=2, now=102)[0])
+        self.assertEqual(throttling.parse_rate('30/min'), 0.5)
+
+    def test_submissions_are_throttled_per_user(self):
+        """Past the burst a user gets 429 with Retry-After, other users are unaffected"""
+        with throttle_rates(submit=('1/min', 2)):
+            self.assertEqual(self.submit(self.user).status_code, status.HTTP_201_CREATED)
+            self.assertEqual(self.submit(self.user).status_code, status.HTTP_201_CREATED)
+            response = self.submit(self.user)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertGreater(int(response['Retry-After']), 0)
+            self.assertEqual(self.submit(self.other).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Test.objects.count(), 3)
+
+    def test_submissions_are_throttled_per_address(self):
+        """Many accounts behind one address share its bucket"""
+        with throttle_rates(submit_ip=('1/min', 1)):
+            self.assertEqual(self.submit(self.user).status_code, status.HTTP_201_CREATED)
+            self.assertEqual(self.submit(self.other).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_register_and_login_are_throttled(self):
+        """Password hashing endpoints are limited per address"""
+        with throttle_rates(register=('1/hour', 1), login=('1/hour', 1)):
+            data = {'username': 'first', 'email': 'first@example.com', 'password': 'testpassword123'}
+            self.assertEqual(self.client.post('/register/', data, format='json').status_code, status.HTTP_201_CREATED)
+            data['username'] = 'second'
+            self.assertEqual(self.client.post('/register/', data, format='json').status_code,
+                             status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(self.client.post('/register/', data, format='json', REMOTE_ADDR='10.0.0.2').status_code,
+                             status.HTTP_201_CREATED)
+
+            credentials = {'username': 'flooder', 'password': 'testpassword123'}
+            self.assertEqual(self.client.post('/api/token/', credentials).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.post('/api/token/', credentials).status_code,
+                             status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_forwarded_for_does_not_pick_the_bucket(self):
+        """A client rotating X-Forwarded-For still shares its address's bucket"""
+        data = {'email': 'spoof@example.com', 'password': 'testpassword123'}
+        with throttle_rates(register=('1/hour', 2)):
+            for n in range(2):
+                response = self.client.post('/register/', {**data, 'username': f'spoof{n}'}, format='json',
+                                            HTTP_X_FORWARDED_FOR=f'203.0.113.{n}')
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.post('/register/', {**data, 'username': 'spoof2'}, format='json',
+                                        HTTP_X_FORWARDED_FOR='203.0.113.2')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1})
+    def test_behind_a_proxy_the_last_forwarded_address_counts(self):
+        """With NUM_PROXIES 1 addresses the client prepends to X-Forwarded-For are ignored"""
+        data = {'email': 'proxied@example.com', 'password': 'testpassword123'}
+        with throttle_rates(register=('1/hour', 1)):
+            response = self.client.post('/register/', {**data, 'username': 'proxied0'}, format='json',
+                                        HTTP_X_FORWARDED_FOR='203.0.113.1')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.post('/register/', {**data, 'username': 'proxied1'}, format='json',
+                                        HTTP_X_FORWARDED_FOR='198.51.100.7, 203.0.113.1')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            response = self.client.post('/register/', {**data, 'username': 'proxied2'}, format='json',
+                                        HTTP_X_FORWARDED_FOR='203.0.113.2')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_cache_store_shares_buckets(self):
+        """With STORE "cache" every store instance sees the same buckets"""
+        with override_settings(THROTTLING={'STORE': 'cache'}):
+            self.assertTrue(throttling.store().take('throttle:test:1', 1 / 60, 1)[0])
+            self.assertFalse(throttling.store().take('throttle:test:1', 1 / 60, 1)[0])
+            self.assertTrue(throttling.store().take('throttle:test:2', 1 / 60, 1)[0])
+
+    def test_disabled_throttles_let_everything_through(self):
+        """THROTTLING ENABLED False skips the buckets"""
+        with override_settings(THROTTLING={'ENABLED': False, 'RATES': {'submit': {'RATE': '1/hour', 'BURST': 1}}}):
+            for _ in range(3):
+                self.assertEqual(self.submit(self.user).status_code, status.HTTP_201_CREATED)
+
+    @override_settings(ADMISSION={'MAX_REQUESTS': 1, 'MAX_WRITES': 1, 'QUEUE_TIMEOUT': 0, 'RETRY_AFTER': 2,
+                                  'EXEMPT_PATHS': ['/hi/', '/metrics']})
+    def test_concurrency_limit_sheds_load(self):
+        """Requests over the cap get 503 with Retry-After, exempt paths still pass"""
+        self.assertTrue(throttling.limiter.acquire('requests', 1, 0))
+        try:
+            response = self.client.get('/leaderboard/')
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response['Retry-After'], '2')
+            self.assertEqual(self.client.get('/hi/').status_code, status.HTTP_200_OK)
+        finally:
+            throttling.limiter.release('requests')
+        self.assertEqual(self.client.get('/leaderboard/').status_code, status.HTTP_200_OK)
+
+        self.assertTrue(throttling.limiter.acquire('writes', 1, 0))
+        try:
+            self.assertEqual(self.submit(self.user).status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(self.client.get('/leaderboard/').status_code, status.HTTP_200_OK)
+        finally:
+            throttling.limiter.release('writes')
+        self.assertEqual(throttling.limiter.in_flight['requests'], 0)
+
+    @scrape_token
+    def test_counters_are_exported(self):
+        """Throttle decisions and shed requests show up in /metrics"""
+        with throttle_rates(submit=('1/min', 1)):
+            self.submit(self.user)
+            self.submit(self.user)
+        throttling.stats.reject('writes')
+        body = self.client.get('/metrics', **SCRAPE).content.decode()
+        self.assertIn('brainsmath_throttle_requests_total{result="allowed",scope="submit"} 1', body)
+        self.assertIn('brainsmath_throttle_requests_total{result="throttled",scope="submit"} 1', body)
+        self.assertIn('brainsmath_admission_rejected_total{limit="writes"} 1', body)
@@ -0,0 +1,263 @@
+"""Query-count and latency budgets for every endpoint.
+
+tests.py checks what the endpoints return; these tests check what they cost
+against a seeded mid-sized dataset, so an N+1 query or an accidental full scan
+fails the build instead of showing up in production. Query budgets are exact
+upper bounds. Latency ceilings are multiples of GET /hi/, timed on the same
+machine at the start of the run, so they hold on slow and fast hardware alike;
+set PERF_LATENCY_SLACK (default 1) to loosen them on a noisy machine, or 0 to
+skip them.
+"""
+import difflib
+import os
+import re
+import statistics
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import authentication, metrics, ranking, seeding
+
+
+USERS = 200
+TESTS = 5000
+LATENCY_RUNS = 15
+LATENCY_SLACK = float(os.getenv("PERF_LATENCY_SLACK", "1"))
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SAVEPOINTS = re.compile(r'"s\d+_x\d+"')
+
+
+def normalize(sql):
+    """Replace literals with ? so repeated statements with different arguments compare equal."""
+    return LITERALS.sub("?", SAVEPOINTS.sub('"?"', " ".join(sql.split())))
+
+
+def describe_queries(queries, budget):
+    """Executed SQL as a diff against "every statement once"; + lines are repeats, the usual N+1 shape."""
+    executed = [normalize(query["sql"]) for query in queries]
+    distinct = list(dict.fromkeys(executed))
+    repeats = Counter(executed)
+    lines = [f"{len(executed)} queries executed, budget is {budget}."]
+    if any(count > 1 for count in repeats.values()):
+        lines.append("Repeated statements:")
+        lines.extend(f"  {count}x {sql}" for sql, count in repeats.most_common() if count > 1)
+    lines.append("Executed SQL:")
+    lines.extend(
+        line.rstrip("\n")
+        for line in difflib.unified_diff(distinct, executed, "distinct statements", "executed", lineterm="", n=len(executed))
+    )
+    if len(lines) <= 3:
+        lines.extend(f"  {sql}" for sql in executed)
+    return "\n".join(lines)
+
+
+# random profile samples would be flushed by a background thread after the test database is gone,
+# and the budgets measure the views, not the throttles
+@override_settings(PROFILING={**settings.PROFILING, "ENABLED": False},
+                   THROTTLING={**settings.THROTTLING, "ENABLED": False})
+class PerformanceTestCase(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user_ids = seeding.seed(USERS, TESTS, seed=11, prefix="perf", batch_size=1000)
+        cls.user = User.objects.get(pk=user_ids[0])
+        cls.token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def setUp(self):
+        caches["default"].clear()
+        ranking.index = ranking.RankingIndex()
+        metrics.registry.reset()
+        authentication.user_cache.clear()
+
+    def authenticate(self):
+        """Send the token, with the user already in the auth cache as it is for an active client."""
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        authentication.user_cache.put(self.user)
+
+    def assertQueryBudget(self, budget, request):
+        """Run ``request`` and fail with the executed SQL if it needs more than ``budget`` queries."""
+        with CaptureQueriesContext(connection) as captured:
+            response = request()
+        if len(captured.captured_queries) > budget:
+            self.fail(describe_queries(captured.captured_queries, budget))
+        return response
+
+
+class QueryBudgetTests(PerformanceTestCase):
+    """Every endpoint runs a fixed number of queries, however much data there is"""
+
+    def item(self, i=0):
+        return {"qpm": 50 + i, "raw": 55, "accuracy": 90, "mode": "time", "difficulty": 3, "number": 0, "time": 60000}
+
+    def test_user_data(self):
+        self.authenticate()
+        # version stamp, user + settings + stats, best scores, recent tests
+        response = self.assertQueryBudget(4, lambda: self.client.get("/user/"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["tests"]), 10)
+
+        # unchanged profile: only the version stamp is read
+        response = self.assertQueryBudget(1, lambda: self.client.get("/user/"))
+        self.assertEqual(response["X-Cache"], "HIT")
+        response = self.assertQueryBudget(
+            1, lambda: self.client.get("/user/", HTTP_IF_NONE_MATCH=response["ETag"]))
+        self.assertEqual(response.status_code, 304)
+
+    def test_user_settings_update(self):
+        self.authenticate()
+        self.client.put("/user/", {"font": "ubuntu"}, format="json")
+        # settings read and update, profile version bump, plus the savepoint pair
+        response = self.assertQueryBudget(5, lambda: self.client.put("/user/", {"font": "mono"}, format="json"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_leaderboard(self):
+        with override_settings(RESPONSE_CACHE={"ENABLED": False}):
+            response = self.assertQueryBudget(3, lambda: self.client.get("/leaderboard/"))
+            self.assertEqual(len(response.data["results"]), 50)
+            response = self.assertQueryBudget(3, lambda: self.client.get("/leaderboard/", {"cursor": response.data["next"]}))
+            self.assertEqual(response.status_code, 200)
+            response = self.assertQueryBudget(
+                3, lambda: self.client.get("/leaderboard/", {"time": 60, "difficulty": 3}))
+            self.assertEqual(response.status_code, 200)
+
+    def test_leaderboard_cached(self):
+        self.client.get("/leaderboard/")
+        # only the version stamp is read on a hit
+        response = self.assertQueryBudget(1, lambda: self.client.get("/leaderboard/"))
+        self.assertEqual(response["X-Cache"], "HIT")
+
+    def test_conditional_get(self):
+        with override_settings(RESPONSE_CACHE={"ENABLED": False}):
+            # only the version stamp is read when the client's ETag is current
+            for path, params in [("/leaderboard/", {}), ("/userrank/", {"user": self.user.username})]:
+                etag = self.client.get(path, params)["ETag"]
+                response = self.assertQueryBudget(1, lambda: self.client.get(path, params, HTTP_IF_NONE_MATCH=etag))
+                self.assertEqual(response.status_code, 304)
+
+    def test_user_rank(self):
+        with override_settings(RESPONSE_CACHE={"ENABLED": False}):
+            response = self.assertQueryBudget(
+                3, lambda: self.client.get("/userrank/", {"user": self.user.username}))
+            self.assertEqual(response.status_code, 200)
+            response = self.assertQueryBudget(3, lambda: self.client.get("/userrank/", {"rank": 10}))
+            self.assertEqual(response.status_code, 200)
+
+    def test_submit(self):
+        self.authenticate()
+        # the first submission creates the user's counters; measure a returning player
+        self.client.post("/test/", self.item(), format="json")
+        # qpm histogram: bests read and update, one UPDATE moving the user between buckets
+        # filtered bests: locked read, one UPDATE for the scopes the test tops, one version bump
+        response = self.assertQueryBudget(18, lambda: self.client.post("/test/", self.item(1), format="json"))
+        self.assertEqual(response.status_code, 201)
+
+    def test_submit_batch(self):
+        self.authenticate()
+        self.client.post("/test/", self.item(), format="json")
+        items = [self.item(i) for i in range(20)]
+        # one statement per derived table, not one per item
+        response = self.assertQueryBudget(19, lambda: self.client.post("/test/batch/", items, format="json"))
+        self.assertEqual(response.status_code, 201)
+
+    def test_register(self):
+        response = self.assertQueryBudget(3, lambda: self.client.post(
+            "/register/", {"username": "perf-new", "email": "new@example.com", "password": "perf-password"}, format="json"))
+        self.assertEqual(response.status_code, 201)
+
+    def test_hi(self):
+        self.assertQueryBudget(0, lambda: self.client.get("/hi/"))
+
+    def test_async_endpoints(self):
+        self.authenticate()
+        self.assertQueryBudget(4, lambda: self.client.get("/async/user/"))
+        with override_settings(RESPONSE_CACHE={"ENABLED": False}):
+            self.assertQueryBudget(3, lambda: self.client.get("/async/leaderboard/"))
+            self.assertQueryBudget(3, lambda: self.client.get("/async/userrank/", {"user": self.user.username}))
+        self.assertQueryBudget(0, lambda: self.client.get("/async/hi/"))
+
+    def test_percentile(self):
+        with override_settings(RESPONSE_CACHE={"ENABLED": False}):
+            # version stamp, buckets of the scope and the user's best, whatever the number of players
+            response = self.assertQueryBudget(
+                3, lambda: self.client.get("/percentile/", {"user": self.user.username, "mode": "time"}))
+            self.assertIsNotNone(response.data["percentile"])
+
+    def test_history(self):
+        self.authenticate()
+        response = self.assertQueryBudget(1, lambda: self.client.get("/history/", {"limit": 5}))
+        self.assertQueryBudget(1, lambda: self.client.get("/history/", {"cursor": response.data["next"]}))
+        self.assertQueryBudget(1, lambda: self.client.get("/history/", {"aggregate": "week"}))
+
+    def test_profiling_settings(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.authenticate()
+        # the overrides table; profiling is off here, so the middleware reads nothing
+        self.assertQueryBudget(1, lambda: self.client.get("/profiling/"))
+
+    def test_metrics(self):
+        with override_settings(METRICS={**settings.METRICS, "TOKEN": "scrape-token"}):
+            self.assertQueryBudget(0, lambda: self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-token"))
+
+    def test_budget_failure_shows_repeated_sql(self):
+        """An exceeded budget reports the repeated statements as a diff"""
+        def n_plus_one():
+            for user in User.objects.filter(username__startswith="perf")[:3]:
+                user.settings.theme
+
+        with self.assertRaises(AssertionError) as raised:
+            self.assertQueryBudget(2, n_plus_one)
+        message = str(raised.exception)
+        self.assertIn("4 queries executed, budget is 2.", message)
+        self.assertIn("3x SELECT", message)
+        self.assertIn('+SELECT "core_settings"', message)
+
+
+@override_settings(RESPONSE_CACHE={"ENABLED": False})
+class LatencyTests(PerformanceTestCase):
+    """Endpoint latency stays within a multiple of the cheapest request"""
+
+    # ceiling as a multiple of the median GET /hi/ time, with the response cache off
+    CEILINGS = {
+        "/user/": 40,
+        "/leaderboard/": 40,
+        "/leaderboard/?time=60&difficulty=3": 40,
+        "/userrank/?rank=10": 40,
+        "/async/leaderboard/": 40,
+    }
+
+    def setUp(self):
+        super().setUp()
+        if not LATENCY_SLACK:
+            self.skipTest("PERF_LATENCY_SLACK=0")
+        self.authenticate()
+
+    def median_ms(self, path):
+        self.client.get(path)
+        timings = []
+        for _ in range(LATENCY_RUNS):
+            started = time.perf_counter()
+            self.client.get(path)
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
+
+    def test_latency_ceilings(self):
+        baseline = self.median_ms("/hi/")
+        for path, factor in self.CEILINGS.items():
+            with self.subTest(path=path):
+                elapsed = self.median_ms(path)
+                ceiling = baseline * factor * LATENCY_SLACK
+                self.assertLessEqual(
+                    elapsed, ceiling,
+                    f"{path} took {elapsed:.2f}ms (median of {LATENCY_RUNS}), ceiling is {ceiling:.2f}ms "
+                    f"({factor}x the {baseline:.2f}ms GET /hi/ baseline)",
+                )
@@ -0,0 +1,271 @@
+"""Token-bucket throttles and a global concurrency limit.
+
+The throttles are DRF throttle classes for the endpoints that are expensive
+to abuse: submitTest inserts rows, register and /api/token/ hash passwords.
+Each scope in THROTTLING["RATES"] is a bucket of BURST tokens refilled at
+RATE; a request takes one token or gets a 429 with Retry-After set to the
+time until the next token. Buckets live in this process's memory by default,
+or in the Django cache (STORE "cache") so every worker shares them.
+
+AdmissionMiddleware caps the requests, and separately the writes, that a
+worker runs at once. A request over the cap waits up to QUEUE_TIMEOUT for a
+slot and is then turned away with a 503, so a burst is shed at the door
+instead of piling up on the database.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from rest_framework.throttling import BaseThrottle
+
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def _setting(name, default):
+    return getattr(settings, "THROTTLING", {}).get(name, default)
+
+
+def _admission_setting(name, default):
+    return getattr(settings, "ADMISSION", {}).get(name, default)
+
+
+def parse_rate(rate):
+    """Tokens per second for a DRF-style rate such as "30/min"."""
+    count, period = rate.split("/")
+    return int(count) / PERIODS[period[0]]
+
+
+def refill(state, rate, capacity, now):
+    """Take a token from the bucket ``state`` = (tokens, updated); returns (allowed, new state, wait)."""
+    tokens, updated = state if state is not None else (capacity, now)
+    tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+    if tokens >= 1:
+        return True, (tokens - 1, now), 0
+    return False, (tokens, now), (1 - tokens) / rate
+
+
+class MemoryStore:
+    """Buckets of this process, least recently used dropped beyond MAX_BUCKETS."""
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity):
+        with self._lock:
+            allowed, state, wait = refill(self._buckets.pop(key, None), rate, capacity, time.monotonic())
+            self._buckets[key] = state
+            while len(self._buckets) > _setting("MAX_BUCKETS", 100000):
+                self._buckets.popitem(last=False)
+        return allowed, wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheStore:
+    """Buckets in the Django cache, shared by every worker using it.
+
+    Read-modify-write without a lock: two workers racing on one bucket can
+    both take the last token, which a throttle can live with.
+    """
+
+    def take(self, key, rate, capacity):
+        cache = caches[_setting("CACHE_ALIAS", "default")]
+        now = time.time()
+        allowed, state, wait = refill(cache.get(key), rate, capacity, now)
+        # a full bucket is the same as no bucket, so entries can expire once refilled
+        cache.set(key, state, math.ceil(capacity / rate) + 1)
+        return allowed, wait
+
+
+memory_store = MemoryStore()
+
+
+def store():
+    return CacheStore() if _setting("STORE", "memory") == "cache" else memory_store
+
+
+class Stats:
+    """Per-process counts of throttle decisions and shed requests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.throttle = defaultdict(int)
+        self.rejected = defaultdict(int)
+
+    def record(self, scope, allowed):
+        with self._lock:
+            self.throttle[(scope, "allowed" if allowed else "throttled")] += 1
+
+    def reject(self, limit):
+        with self._lock:
+            self.rejected[limit] += 1
+
+    def reset(self):
+        with self._lock:
+            self.throttle.clear()
+            self.rejected.clear()
+
+
+stats = Stats()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Throttle on the THROTTLING["RATES"][scope] bucket of the key get_key() returns."""
+
+    scope = None
+
+    def get_key(self, request):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        self._wait = 0
+        config = _setting("RATES", {}).get(self.scope)
+        if not _setting("ENABLED", True) or not config:
+            return True
+        key = self.get_key(request)
+        if key is None:
+            return True
+        rate = parse_rate(config["RATE"])
+        allowed, self._wait = store().take(f"throttle:{self.scope}:{key}", rate, config.get("BURST", 1))
+        stats.record(self.scope, allowed)
+        return allowed
+
+    def wait(self):
+        return self._wait
+
+
+class UserThrottle(TokenBucketThrottle):
+    """One bucket per authenticated user; anonymous requests pass."""
+
+    def get_key(self, request):
+        return request.user.pk if request.user and request.user.is_authenticated else None
+
+
+class AddressThrottle(TokenBucketThrottle):
+    """One bucket per client address (honouring NUM_PROXIES like DRF's throttles)."""
+
+    def get_key(self, request):
+        return self.get_ident(request)
+
+
+class SubmitThrottle(UserThrottle):
+    scope = "submit"
+
+
+class SubmitAddressThrottle(AddressThrottle):
+    scope = "submit_ip"
+
+
+class RegisterThrottle(AddressThrottle):
+    scope = "register"
+
+
+class LoginThrottle(AddressThrottle):
+    scope = "login"
+
+
+class Limiter:
+    """Counts requests in flight per named limit and lets callers wait for a free slot."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.in_flight = defaultdict(int)
+
+    def acquire(self, name, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.in_flight[name] >= limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight[name] += 1
+            return True
+
+    async def aacquire(self, name, limit, timeout, poll=0.005):
+        """acquire() for the event loop: polls for a slot instead of blocking the thread on the condition."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self.in_flight[name] < limit:
+                    self.in_flight[name] += 1
+                    return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(poll, remaining))
+
+    def release(self, name):
+        with self._condition:
+            self.in_flight[name] -= 1
+            self._condition.notify()
+
+
+limiter = Limiter()
+
+
+def overloaded():
+    response = JsonResponse({"detail": "Server is busy, try again later."}, status=503)
+    response["Retry-After"] = str(_admission_setting("RETRY_AFTER", 1))
+    return response
+
+
+class AdmissionMiddleware:
+    """Sync or async, whichever the rest of the chain is, so ASGI requests stay on the event loop."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        acquired = []
+        try:
+            for name, limit in self.limits(request):
+                if not limiter.acquire(name, limit, _admission_setting("QUEUE_TIMEOUT", 0.1)):
+                    stats.reject(name)
+                    return overloaded()
+                acquired.append(name)
+            return self.get_response(request)
+        finally:
+            for name in acquired:
+                limiter.release(name)
+
+    async def __acall__(self, request):
+        acquired = []
+        try:
+            for name, limit in self.limits(request):
+                if not await limiter.aacquire(name, limit, _admission_setting("QUEUE_TIMEOUT", 0.1)):
+                    stats.reject(name)
+                    return overloaded()
+                acquired.append(name)
+            return await self.get_response(request)
+        finally:
+            for name in acquired:
+                limiter.release(name)
+
+    def limits(self, request):
+        """The (name, cap) slots ``request`` needs."""
+        if not _admission_setting("ENABLED", True) or request.path_info in _admission_setting("EXEMPT_PATHS", ()):
+            return []
+        limits = [("requests", _admission_setting("MAX_REQUESTS", None))]
+        if request.method not in SAFE_METHODS:
+            limits.append(("writes", _admission_setting("MAX_WRITES", None)))
+        return [(name, limit) for name, limit in limits if limit]
@@ -1,5 +1,6 @@
 from django.urls import path
-from .views import getUserData , getLeaderboard , hi , submitTest , register , getUserRank
+from . import async_views
+from .views import getUserData , getLeaderboard , hi , submitTest , submitTests , register , getUserRank , getPercentile , getHistory , profilingSettings
 
 
 urlpatterns = [
@@ -7,7 +8,17 @@ urlpatterns = [
     path("leaderboard/" , getLeaderboard),
     path("hi/" , hi),
     path("test/" , submitTest),
+    path("test/batch/" , submitTests),
     path("register/" , register),
     path("userrank/" , getUserRank),
+    path("percentile/" , getPercentile),
+    path("history/" , getHistory),
+    path("profiling/" , profilingSettings),
+
+    # async variants of the read endpoints, for ASGI deployments
+    path("async/user/" , async_views.getUserData),
+    path("async/leaderboard/" , async_views.getLeaderboard),
+    path("async/hi/" , async_views.hi),
+    path("async/userrank/" , async_views.getUserRank),
 
 ]
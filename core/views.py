@@ -1,12 +1,15 @@
 from rest_framework.response import Response
-from rest_framework.decorators import api_view , permission_classes
-from .serializers import UserDataSerializer , TestSerializer , SettingsSerializer , LeaderboardEntitySerializer , registerSerializer
+from rest_framework.decorators import api_view , permission_classes , throttle_classes
+from .serializers import UserDataSerializer , TEST_ROWS , TestSubmissionSerializer , SettingsSerializer , LeaderboardEntitySerializer , registerSerializer
 from django.contrib.auth.models import User
 from rest_framework import status
-from .models import Settings , Test
-from rest_framework.permissions import IsAuthenticated
+from .models import Counter , Settings , Test
+from rest_framework.permissions import IsAdminUser , IsAuthenticated
 import math
-from django.db import connection
+from django.db import transaction
+from . import cache , histogram , history , ingest , leaderboard , profiles , profiling , ranking , submissions
+from django.conf import settings as django_settings
+from .throttling import RegisterThrottle , SubmitAddressThrottle , SubmitThrottle
 
 
 # Create your views here.
@@ -14,15 +17,27 @@ from django.db import connection
 @permission_classes([IsAuthenticated])
 def getUserData(request):
     user =  request.user
-    settings = Settings.objects.filter(user=user).first()
 
     if request.method == "GET":
-        serial = UserDataSerializer(user)
-        return Response(serial.data , status=status.HTTP_200_OK)
+        version = profiles.version(user.pk)
+        etag = profiles.etag(user , version)
+        if cache.matches(request , etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED , headers={"ETag": etag})
+
+        data , hit = profiles.get_or_set(user , version , lambda: UserDataSerializer(
+            User.objects.select_related("settings" , "stats").get(pk=user.pk)
+        ).data)
+        response = Response(data , status=status.HTTP_200_OK)
+        response["ETag"] = etag
+        response["X-Cache"] = "HIT" if hit else "MISS"
+        return response
     else:
+        settings = Settings.objects.filter(user=user).first()
         serializer = SettingsSerializer(settings, data=request.data, partial=True)
         if serializer.is_valid():
-            serializer.save()
+            with transaction.atomic():
+                serializer.save()
+                profiles.bump([user.pk])
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -38,107 +53,120 @@ def getUserSettings(request):
     serial = SettingsSerializer(data)
     return Response(serial.data , status=status.HTTP_200_OK)
 
+def cachedResponse(namespace, version, request, compute):
+    params = request.GET.dict()
+    etag = cache.etag(namespace, version, params)
+    # the client already has this version: answer before any ranking SQL runs
+    if cache.matches(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    data, hit = cache.get_or_set(namespace, version, params, compute)
+    response = Response(data)
+    response["ETag"] = etag
+    response["X-Cache"] = "HIT" if hit else "MISS"
+    return response
+
+
 @api_view(["GET"])
 def getLeaderboard(request):
-    page = int(request.GET.get("page", 1))  # Default to page 1 instead of 0
-    limit = 50
-    offset = (page - 1) * limit
-
-    query = """
-        SELECT
-            t.id,
-            t.qpm,
-            t.raw,
-            t.accuracy,
-            t.mode,
-            t.difficulty,
-            t.creation,
-            t.number,
-            t.time,
-            t.user_id,
-            u.username
-        FROM core_test t
-        JOIN auth_user u ON t.user_id = u.id
-        WHERE t.qpm = (
-            SELECT MAX(qpm)
-            FROM core_test
-            WHERE user_id = t.user_id
-        )
-        ORDER BY t.qpm DESC
-        LIMIT %s OFFSET %s
-    """
-
-    with connection.cursor() as cursor:
-        cursor.execute(query, [limit, offset])
-        columns = [col[0] for col in cursor.description]
-        results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-
-    count = len(results)
-    return Response({"results": results , "count": count})
+    try:
+        board = leaderboard.board_from_params(request.GET)
+        return cachedResponse("leaderboard", board.version(), request,
+                              lambda: leaderboard.board_page(board, request.GET))
+    except leaderboard.InvalidCursor:
+        return Response({"detail": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST)
+    except leaderboard.InvalidFilter as error:
+        return Response({"detail": str(error)}, status=status.HTTP_400_BAD_REQUEST)
 
 
 @api_view(["GET"])
 def getUserRank(request):
-    user = request.GET.get("user")
-
-    query = """
-        WITH result as (
-        SELECT
-            t.id,
-            t.qpm,
-            t.raw,
-            t.accuracy,
-            t.mode,
-            t.difficulty,
-            t.creation,
-            t.number,
-            t.time,
-            t.user_id,
-            u.username,
-            ROW_NUMBER() OVER (ORDER BY t.qpm DESC) AS index
-            FROM core_test t
-            JOIN auth_user u ON t.user_id = u.id
-            WHERE t.qpm = (
-                SELECT MAX(qpm)
-                FROM core_test
-                WHERE user_id = t.user_id
-            )
-        ORDER BY t.qpm DESC)
-        SELECT * FROM result
-        WHERE username = %s
-    """
-
-    with connection.cursor() as cursor:
-        cursor.execute(query , [user])
-        columns = [col[0] for col in cursor.description]
-        results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-    return Response({"result": results})
-
+    try:
+        board = leaderboard.window_board(request.GET)
+        ranking.rank_param(request.GET)
+    except leaderboard.InvalidFilter as error:
+        return Response({"detail": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    version = board.version() if board else Counter.get(leaderboard.VERSION_KEY)
+    return cachedResponse("userrank", version, request, lambda: ranking.lookup(request.GET, board))
 
 
+@api_view(["GET"])
+def getPercentile(request):
+    try:
+        return cachedResponse("percentile", Counter.get(histogram.VERSION_KEY), request,
+                              lambda: histogram.lookup(request.GET))
+    except leaderboard.InvalidFilter as error:
+        return Response({"detail": str(error)}, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def getHistory(request):
+    try:
+        return Response(history.lookup(request.user , request.GET) , status=status.HTTP_200_OK)
+    except leaderboard.InvalidCursor:
+        return Response({"detail": "Invalid cursor."}, status=status.HTTP_400_BAD_REQUEST)
+    except leaderboard.InvalidFilter as error:
+        return Response({"detail": str(error)}, status=status.HTTP_400_BAD_REQUEST)
 
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@throttle_classes([SubmitThrottle , SubmitAddressThrottle])
 def submitTest(request):
-    # TODO: replace this with `request.user` when you add authentication
-
     user = request.user
-    serializer = TestSerializer(data=request.data , partial=True)
+    serializer = TestSubmissionSerializer(data=request.data)
     if serializer.is_valid():
-        serializer.save(user=user)
+        # write-behind mode: accept now, insert with the next background batch
+        if ingest.enabled() and ingest.writer.put(user, serializer.validated_data):
+            return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+        with transaction.atomic():
+            test = serializer.save(user=user)
+            submissions.record([test])
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 @api_view(["POST"])
+@permission_classes([IsAuthenticated])
+@throttle_classes([SubmitThrottle , SubmitAddressThrottle])
+def submitTests(request):
+    if not isinstance(request.data, list):
+        return Response({"detail": "Expected a list of test results."}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = TestSubmissionSerializer(data=request.data, many=True, max_length=django_settings.TEST_BATCH_MAX_SIZE)
+    if serializer.is_valid():
+        tests = submissions.save_tests(request.user, serializer.validated_data)
+        return Response(TEST_ROWS.instances(tests), status=status.HTTP_201_CREATED)
+    # one error dict per item, empty for the valid ones
+    return Response({"errors": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+@api_view(["POST"])
+@throttle_classes([RegisterThrottle])
 def register(request):
     serial = registerSerializer(data=request.data)
     if serial.is_valid():
         user = serial.save()
         Settings.objects.create(theme="discord" , font="ubuntu" , user=user)
         return Response(serial.data , status=status.HTTP_201_CREATED)
-    return Response(serial.errors , status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+    return Response(serial.errors , status=status.HTTP_400_BAD_REQUEST)
+
+@api_view(["GET" , "PUT"])
+@permission_classes([IsAdminUser])
+def profilingSettings(request):
+    """Staff-only view of the runtime profiling overrides; PUT changes one endpoint."""
+    if request.method == "PUT":
+        path = request.data.get("path")
+        if not path:
+            return Response({"path": ["This field is required."]} , status=status.HTTP_400_BAD_REQUEST)
+        changes = {name: request.data[name] for name in profiling.ENDPOINT_FIELDS if name in request.data}
+        try:
+            profiling.set_endpoint(path , **changes)
+        except ValueError as exc:
+            return Response({"detail": str(exc)} , status=status.HTTP_400_BAD_REQUEST)
+    overrides = profiling.get_overrides()
+    return Response({
+        "defaults": profiling.config.for_path(""),
+        "overrides": overrides,
+        "effective": {path: profiling.config.for_path(path) for path in overrides},
+        "buffered": len(profiling.buffer),
+        "dropped": profiling.buffer.dropped,
+    } , status=status.HTTP_200_OK)